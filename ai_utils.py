@@ -1,26 +1,762 @@
+import json
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout, as_completed
+from urllib.parse import urlparse
+import httpx
 from dotenv import load_dotenv
 from openai import AzureOpenAI
+from openai.types import CompletionUsage
+from openai.types.completion_usage import PromptTokensDetails
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from budget import BudgetController
+from chat_cache import ChatCache, make_cache_key
+from metrics import MetricsRecorder, serve_prometheus
+from routing import Backend, Router
+from throttle import RateLimiter, SingleFlight, call_with_retries, estimate_tokens
 
 load_dotenv()
 
-endpoint    = os.getenv("AZURE_OPENAI_ENDPOINT")
-deployment  = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-api_key     = os.getenv("AZURE_OPENAI_API_KEY")
-api_version = os.getenv("AZURE_OPENAI_API_VERSION")
+# ストリーミング時に最終チャンクで usage を受け取るか（古い API バージョンでは 0 にする）
+stream_usage = os.getenv("AZURE_OPENAI_STREAM_USAGE", "1") != "0"
+
+# HTTP 接続プールとタイムアウト
+MAX_CONNECTIONS   = int(os.getenv("AZURE_OPENAI_MAX_CONNECTIONS", "20"))
+MAX_KEEPALIVE     = int(os.getenv("AZURE_OPENAI_MAX_KEEPALIVE", "10"))
+KEEPALIVE_EXPIRY  = float(os.getenv("AZURE_OPENAI_KEEPALIVE_EXPIRY", "120"))
+REQUEST_TIMEOUT   = float(os.getenv("AZURE_OPENAI_TIMEOUT", "60"))
+CONNECT_TIMEOUT   = float(os.getenv("AZURE_OPENAI_CONNECT_TIMEOUT", "5"))
+# SDK 自身の再試行。既定では無効にし、下の call_with_retries に任せる（待ち時間を limiter と共有するため）
+MAX_RETRIES       = int(os.getenv("AZURE_OPENAI_MAX_RETRIES", "0"))
+# 起動時に接続を張っておき、最初のリクエストで TLS ハンドシェイクを待たないようにする
+WARMUP            = os.getenv("AZURE_OPENAI_WARMUP", "0") == "1"
+
+_router = None
+_router_lock = threading.Lock()
+
+
+# ----------------------------------------
+# 設定とクライアント（プロセス内で共有）
+# ----------------------------------------
+def get_backend_settings() -> list:
+    """Azure OpenAI の接続設定をバックエンドごとに返す。未設定なら EnvironmentError。
+
+    AZURE_OPENAI_BACKENDS（JSON の配列）があればその各要素を、無ければ AZURE_OPENAI_* の 1 件を使う。
+    配列の要素で省略した項目は AZURE_OPENAI_* の値で補う。
+    import 時ではなく初回利用時に検証するため、テストやツールからは資格情報なしで import できる。
+    """
+    base = {
+        "endpoint":    os.getenv("AZURE_OPENAI_ENDPOINT"),
+        "deployment":  os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+        "api_key":     os.getenv("AZURE_OPENAI_API_KEY"),
+        "api_version": os.getenv("AZURE_OPENAI_API_VERSION"),
+    }
+    raw = os.getenv("AZURE_OPENAI_BACKENDS")
+    try:
+        entries = json.loads(raw) if raw else [{}]
+    except ValueError:
+        raise EnvironmentError("AZURE_OPENAI_BACKENDS を JSON として読めません")
+    if not isinstance(entries, list) or not entries or not all(isinstance(e, dict) for e in entries):
+        raise EnvironmentError("AZURE_OPENAI_BACKENDS はオブジェクトの配列で指定してください")
+
+    backends = []
+    for entry in entries:
+        settings = {key: entry.get(key) or value for key, value in base.items()}
+        if not all(settings.values()):
+            raise EnvironmentError("環境変数が正しく設定されていません")
+        settings["name"] = entry.get("name") or f"{settings['deployment']}@{urlparse(settings['endpoint']).hostname}"
+        settings["weight"] = float(entry.get("weight", 1.0))
+        settings["rpm"] = int(entry.get("rpm", RATE_LIMIT_RPM))
+        settings["tpm"] = int(entry.get("tpm", RATE_LIMIT_TPM))
+        backends.append(settings)
+    return backends
+
+
+def _make_client(settings) -> AzureOpenAI:
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+    )
+    return AzureOpenAI(
+        azure_endpoint=settings["endpoint"],
+        api_key=settings["api_key"],
+        api_version=settings["api_version"],
+        http_client=http_client,
+        max_retries=MAX_RETRIES,
+    )
+
+
+def get_router() -> Router:
+    """共有のルーター（バックエンドごとのクライアント・limiter・健全性）を返す。
+
+    モジュール変数に保持するため、Streamlit の再実行やセッションをまたいで同じ
+    接続プールが使い回される。
+    """
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                backends = [
+                    Backend(
+                        name=settings["name"],
+                        deployment=settings["deployment"],
+                        client=_make_client(settings),
+                        weight=settings["weight"],
+                        limiter=RateLimiter(rpm=settings["rpm"], tpm=settings["tpm"]),
+                    )
+                    for settings in get_backend_settings()
+                ]
+                _router = Router(
+                    backends,
+                    failure_threshold=ROUTE_FAILURE_THRESHOLD,
+                    cooldown=ROUTE_COOLDOWN,
+                    hedge_percentile=HEDGE_PERCENTILE,
+                )
+                if WARMUP:
+                    threading.Thread(target=warm_up, daemon=True).start()
+                _start_metrics_server()
+    return _router
+
+
+def get_client() -> AzureOpenAI:
+    """先頭のバックエンドの AzureOpenAI クライアントを返す（設定の検証にも使う）。"""
+    return get_router().backends[0].client
+
+
+def _model_name() -> str:
+    # キャッシュのキーと再生時の model に使う。バックエンドはすべて同じモデルを配置している前提
+    return get_router().backends[0].deployment
+
+
+def _start_metrics_server():
+    # METRICS_PORT を指定したときだけ、プロセスに 1 つ /metrics を公開する
+    global _metrics_server
+    if METRICS_PORT and _metrics_server is None:
+        try:
+            _metrics_server = serve_prometheus(metrics, METRICS_PORT)
+        except OSError:
+            # 同じホストで別のアプリが既にポートを使っている場合は公開しない
+            pass
+
+
+def warm_up():
+    """各バックエンドに軽量な GET を 1 回送り、DNS 解決と TLS 接続を済ませておく。失敗しても無視する。"""
+    for backend in get_router().backends:
+        try:
+            backend.client.models.list(timeout=CONNECT_TIMEOUT + 5)
+        except Exception:
+            pass
+
+
+# 応答キャッシュ（CHAT_CACHE_ENABLED=0 で無効化）
+cache_enabled = os.getenv("CHAT_CACHE_ENABLED", "1") != "0"
+cache = ChatCache(
+    path=os.getenv("CHAT_CACHE_PATH", ".cache/chat_cache.sqlite3"),
+    ttl=float(os.getenv("CHAT_CACHE_TTL", "86400")),
+    memory_items=int(os.getenv("CHAT_CACHE_MEMORY_ITEMS", "256")),
+    disk_items=int(os.getenv("CHAT_CACHE_DISK_ITEMS", "10000")),
+)
+
+# デプロイのクォータ（0 は無制限。AZURE_OPENAI_BACKENDS では rpm / tpm で個別に指定）と、429/5xx 時の再試行
+RATE_LIMIT_RPM    = int(os.getenv("AZURE_OPENAI_RPM", "0"))
+RATE_LIMIT_TPM    = int(os.getenv("AZURE_OPENAI_TPM", "0"))
+CHAT_MAX_RETRIES  = int(os.getenv("CHAT_MAX_RETRIES", "4"))
+CHAT_RETRY_BASE   = float(os.getenv("CHAT_RETRY_BASE", "1.0"))
+CHAT_RETRY_MAX    = float(os.getenv("CHAT_RETRY_MAX", "30"))
+# 5xx・接続エラーがこの回数続いたバックエンドは、ROUTE_COOLDOWN 秒間選ばない
+ROUTE_FAILURE_THRESHOLD = int(os.getenv("CHAT_ROUTE_FAILURE_THRESHOLD", "3"))
+ROUTE_COOLDOWN    = float(os.getenv("CHAT_ROUTE_COOLDOWN", "30"))
+# 応答の開始がこの分位点（例: 0.95）の時間を超えたら、別のバックエンドにも同じリクエストを送る（0 で無効）
+HEDGE_PERCENTILE  = float(os.getenv("CHAT_HEDGE_PERCENTILE", "0"))
+# 同じ内容のリクエストが同時に来たら上流への呼び出しを 1 本にまとめる
+COALESCE_ENABLED  = os.getenv("CHAT_COALESCE", "1") != "0"
 
-if not all([endpoint, deployment, api_key, api_version]):
-    raise EnvironmentError("環境変数が正しく設定されていません")
+# 呼び出しごとの計測（JSONL・Prometheus 形式）。単価は 1,000 トークンあたり
+metrics = MetricsRecorder(
+    jsonl_path=os.getenv("METRICS_JSONL_PATH", ".cache/metrics.jsonl") or None,
+    prom_path=os.getenv("METRICS_PROM_PATH") or None,
+    jsonl_max_bytes=int(os.getenv("METRICS_JSONL_MAX_MB", "20")) * 1024 * 1024,
+    jsonl_backups=int(os.getenv("METRICS_JSONL_BACKUPS", "3")),
+    prompt_price_per_1k=float(os.getenv("AZURE_OPENAI_PROMPT_PRICE_PER_1K", "0")),
+    completion_price_per_1k=float(os.getenv("AZURE_OPENAI_COMPLETION_PRICE_PER_1K", "0")),
+    cached_prompt_price_per_1k=(
+        float(os.environ["AZURE_OPENAI_CACHED_PROMPT_PRICE_PER_1K"])
+        if os.getenv("AZURE_OPENAI_CACHED_PROMPT_PRICE_PER_1K") else None
+    ),
+)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+_metrics_server = None
 
-client = AzureOpenAI(
-    azure_endpoint=endpoint,
-    api_key=api_key,
-    api_version=api_version,
+# フローごとの max_tokens の初期値。呼び出し側が max_tokens を渡さなければ、計測から学習した予算を使う
+DEFAULT_MAX_TOKENS = {
+    "three_methods": 1000,
+    "followup": 2000,
+    "chat": 1500,
+    "random_problem": 200,
+    "feedback": 800,
+}
+# 同じ生成を別の名前で記録するフロー（予算は元のフローと共有する）。
+# 並列生成の 1 手法分（single_method）は３手法の生成として予算を学習し、集計もまとめる（metrics.FLOW_ALIASES）
+BUDGET_ALIASES = {"followup_prefetch": "followup", "single_method": "three_methods"}
+ADAPTIVE_BUDGET   = os.getenv("CHAT_ADAPTIVE_BUDGET", "1") != "0"
+budgets = BudgetController(
+    metrics,
+    quantile=float(os.getenv("CHAT_BUDGET_QUANTILE", "0.99")),
+    headroom=float(os.getenv("CHAT_BUDGET_HEADROOM", "1.25")),
+    min_samples=int(os.getenv("CHAT_BUDGET_MIN_SAMPLES", "20")),
+    max_factor=float(os.getenv("CHAT_BUDGET_MAX_FACTOR", "2.0")),
 )
+# finish_reason が length で打ち切られたら、続きを依頼して繋げる回数（0 で無効）
+AUTO_CONTINUE     = int(os.getenv("CHAT_AUTO_CONTINUE", "2"))
+CONTINUE_MESSAGE  = {
+    "role": "user",
+    "content": "出力が途中で途切れました。直前の出力の続きだけを、前置きや繰り返しなしでそのまま書いてください。",
+}
+
+single_flight = SingleFlight()
+retry_stats = {"retries": 0, "rate_limited": 0, "failovers": 0}
+# ヘッジ時に、応答の開始を待つ間だけ使うスレッド
+_hedge_pool = ThreadPoolExecutor(max_workers=max(4, MAX_CONNECTIONS * 2), thread_name_prefix="chat-hedge")
+
+# キャッシュ再生時に 1 回で流す文字数
+REPLAY_CHUNK_CHARS = 24
+
+
+class ChatStream:
+    """ストリーミング応答のラッパー。
+
+    イテレートするとテキストの差分（delta）を到着順に返す。
+    最後まで読み切る（または途中で失敗する）と content / usage / finish_reason / error が確定し、
+    on_complete が呼ばれる。ttft は最初の差分が届くまでの秒数。
+    """
+
+    def __init__(self, chunks, on_complete=None, cached=False, started_at=None):
+        self._chunks = chunks
+        self._on_complete = on_complete
+        self.content = ""
+        self.usage = None
+        self.finish_reason = None
+        self.cached = cached
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self.ttft = None
+        self.error = None
+        self.done = False
+
+    @classmethod
+    def replay(cls, entry, on_complete=None, started_at=None):
+        """キャッシュ済みの応答を、通常のストリームと同じ形で再生する。"""
+        return cls(_replay_chunks(entry), on_complete=on_complete, cached=True, started_at=started_at)
+
+    def __iter__(self):
+        parts = []
+        try:
+            for chunk in self._chunks:
+                if getattr(chunk, "usage", None):
+                    self.usage = chunk.usage
+                # Azure はフィルタ結果のみのチャンク（choices が空）を送ってくることがある
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.finish_reason:
+                    self.finish_reason = choice.finish_reason
+                delta = choice.delta.content if choice.delta else None
+                if delta:
+                    if self.ttft is None:
+                        self.ttft = time.perf_counter() - self.started_at
+                    parts.append(delta)
+                    yield delta
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            # 途中で読むのをやめたときも、上流（相乗りの購読）をすぐに手放す
+            close = getattr(self._chunks, "close", None)
+            if close is not None:
+                close()
+            self.content = "".join(parts)
+            self.done = True
+            if self._on_complete:
+                self._on_complete(self)
+
+
+class ContinuingStream(ChatStream):
+    """length で打ち切られたら続きを依頼し、1 つのストリームとして流す。
+
+    usage は各呼び出しの合計、finish_reason は最後の呼び出しのもの。continuations は続きを依頼した回数。
+    """
+
+    def __init__(self, first, make_next, rounds):
+        super().__init__(None, cached=first.cached, started_at=first.started_at)
+        self._first = first
+        self._make_next = make_next
+        self._rounds = rounds
+        self.continuations = 0
+
+    def __iter__(self):
+        parts = []
+        stream = self._first
+        try:
+            while True:
+                deltas = iter(stream)
+                try:
+                    for delta in deltas:
+                        if self.ttft is None:
+                            self.ttft = stream.ttft
+                        parts.append(delta)
+                        yield delta
+                finally:
+                    # 途中で読むのをやめたら、今のストリームもすぐに手放す
+                    deltas.close()
+                self.finish_reason = stream.finish_reason
+                self.usage = _add_usage(self.usage, stream.usage)
+                if stream.finish_reason != "length" or self.continuations >= self._rounds:
+                    break
+                self.continuations += 1
+                stream = self._make_next("".join(parts))
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.content = "".join(parts)
+            self.done = True
+
+
+def _cached_tokens(usage):
+    """サーバー側のプレフィックスキャッシュに当たったプロンプトのトークン数（返ってこなければ None）。"""
+    details = getattr(usage, "prompt_tokens_details", None) if usage else None
+    return getattr(details, "cached_tokens", None) if details else None
+
+
+def _add_usage(total, usage):
+    if usage is None:
+        return total
+    if total is None:
+        return usage
+    cached = [_cached_tokens(u) for u in (total, usage)]
+    return CompletionUsage(
+        prompt_tokens=total.prompt_tokens + usage.prompt_tokens,
+        completion_tokens=total.completion_tokens + usage.completion_tokens,
+        total_tokens=total.total_tokens + usage.total_tokens,
+        prompt_tokens_details=(
+            None if cached == [None, None] else PromptTokensDetails(cached_tokens=sum(c or 0 for c in cached))
+        ),
+    )
+
+
+def _continuation_messages(messages, content):
+    return [*messages, {"role": "assistant", "content": content}, CONTINUE_MESSAGE]
+
+
+def _continue_completion(res, messages, rounds, **kwargs):
+    """非ストリーミングの応答が length で打ち切られていたら、続きを依頼して 1 つの応答にまとめる。"""
+    content = res.choices[0].message.content or ""
+    finish_reason = res.choices[0].finish_reason
+    usage = res.usage
+    continuations = 0
+    while finish_reason == "length" and continuations < rounds:
+        more = call_chat(_continuation_messages(messages, content), auto_continue=0, **kwargs)
+        content += more.choices[0].message.content or ""
+        finish_reason = more.choices[0].finish_reason
+        usage = _add_usage(usage, more.usage)
+        continuations += 1
+    if not continuations:
+        return res
+    return _merged_completion(res, content, finish_reason, usage)
+
+
+def _merged_completion(res, content, finish_reason, usage):
+    return ChatCompletion.model_validate({
+        "id": res.id,
+        "object": "chat.completion",
+        "created": res.created,
+        "model": res.model,
+        "choices": [{
+            "index": 0,
+            "finish_reason": finish_reason,
+            "message": {"role": "assistant", "content": content},
+        }],
+        "usage": usage.model_dump() if usage is not None else None,
+    })
+
+
+def _replay_chunks(entry):
+    content = entry["content"]
+    base = {
+        "id": "cache",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": _model_name(),
+    }
+    for i in range(0, len(content), REPLAY_CHUNK_CHARS):
+        yield ChatCompletionChunk.model_validate({
+            **base,
+            "choices": [{"index": 0, "delta": {"content": content[i:i + REPLAY_CHUNK_CHARS]}, "finish_reason": None}],
+        })
+    yield ChatCompletionChunk.model_validate({
+        **base,
+        "choices": [{"index": 0, "delta": {}, "finish_reason": entry["finish_reason"]}],
+        "usage": entry.get("usage"),
+    })
+
+
+def _completion_from_entry(entry):
+    return ChatCompletion.model_validate({
+        "id": "cache",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": _model_name(),
+        "choices": [{
+            "index": 0,
+            "finish_reason": entry["finish_reason"],
+            "message": {"role": "assistant", "content": entry["content"]},
+        }],
+        "usage": entry.get("usage"),
+    })
+
+
+def _store(key, content, finish_reason, usage):
+    # 途中で打ち切られた応答やフィルタされた応答は再利用しない
+    if finish_reason != "stop":
+        return
+    cache.put(key, {
+        "content": content,
+        "finish_reason": finish_reason,
+        "usage": usage.model_dump() if usage is not None else None,
+    })
+
+
+def _record(flow, started_at, stream, queue_wait, usage=None, finish_reason=None,
+            ttft=None, cache_hit=False, coalesced=False, error=None, served=None, max_tokens=None):
+    served = served or {}
+    backend = served.get("backend")
+    metrics.record({
+        "flow": flow,
+        "stream": stream,
+        "cache_hit": cache_hit,
+        "coalesced": coalesced,
+        "backend": backend.name if backend is not None else None,
+        "hedged": served.get("hedged", False),
+        "queue_wait_s": queue_wait,
+        "ttft_s": ttft,
+        "latency_s": time.perf_counter() - started_at,
+        "prompt_tokens": usage.prompt_tokens if usage else None,
+        "cached_tokens": _cached_tokens(usage),
+        "completion_tokens": usage.completion_tokens if usage else None,
+        "max_tokens": max_tokens,
+        "finish_reason": finish_reason,
+        "error": type(error).__name__ if error is not None else None,
+    })
+
+
+# ----------------------------------------
+# バックエンドへの送信（振り分け・フェイルオーバー・ヘッジ）
+# ----------------------------------------
+class _BackendStream:
+    """1 つのバックエンドから読むチャンク列。
+
+    作成時に最初のチャンクまで読む（応答の開始までの時間でバックエンドを比べ、ヘッジするため）。
+    読み終わるか close() されると、上流の接続を閉じてルーターの処理中件数を戻す。
+    """
+
+    def __init__(self, router, backend, raw):
+        self._router = router
+        self._backend = backend
+        self._raw = raw
+        self._closed = False
+        try:
+            self._first = next(iter(raw), None)
+        except Exception:
+            self.close()
+            raise
+
+    def __iter__(self):
+        try:
+            if self._first is not None:
+                yield self._first
+            yield from self._raw
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        close = getattr(self._raw, "close", None)
+        if close is not None:
+            close()
+        self._router.release(self._backend)
+
+
+def _open(router, backend, messages, params, flow):
+    """backend に送り、応答が返り始めたら返す。失敗はルーターに記録して送出する。"""
+    stream = params.get("stream", False)
+    started = time.perf_counter()
+    try:
+        res = backend.client.chat.completions.create(model=backend.deployment, messages=messages, **params)
+    except Exception as e:
+        router.fail(backend, e)
+        router.release(backend)
+        raise
+    if stream:
+        try:
+            # 読み込みに失敗したら _BackendStream 自身が接続を閉じて処理中件数を戻す
+            res = _BackendStream(router, backend, res)
+        except Exception as e:
+            router.fail(backend, e)
+            raise
+    router.succeed(backend, time.perf_counter() - started, flow, stream)
+    if not stream:
+        router.release(backend)
+    return res
+
+
+def _discard(router, backend, estimated):
+    # ヘッジで負けた側：ストリームは閉じ、読み切った応答は使用量だけ精算する
+    def callback(future):
+        if future.exception() is not None:
+            return
+        res = future.result()
+        if isinstance(res, _BackendStream):
+            res.close()
+        else:
+            backend.limiter.settle(estimated, res.usage.total_tokens if res.usage else None)
+    return callback
+
+
+def _open_routed(router, messages, params, flow, estimated, queue_wait, tried, served):
+    """バックエンドを選んで送る。ヘッジが有効なら、応答の開始が遅いときに別のバックエンドにも送る。"""
+    stream = params.get("stream", False)
+    primary = router.choose(exclude=tried, tokens=estimated, stream=stream)
+    tried.append(primary)
+    queue_wait[0] += primary.limiter.acquire(estimated)
+    delay = router.hedge_delay(flow, stream)
+    if delay is None:
+        res = _open(router, primary, messages, params, flow)
+        served["backend"] = primary
+        return res
+
+    first = _hedge_pool.submit(_open, router, primary, messages, params, flow)
+    try:
+        res = first.result(timeout=delay)
+        served["backend"] = primary
+        return res
+    except FuturesTimeout:
+        pass
+    # クォータを待たずに送れるバックエンドがあるときだけヘッジする
+    backup = router.choose(exclude=[primary], tokens=estimated, stream=stream, require_headroom=True)
+    if backup is None:
+        res = first.result()
+        served["backend"] = primary
+        return res
+    backup.limiter.acquire(estimated)
+    router.count(backup, "hedged")
+    served["hedged"] = True
+    second = _hedge_pool.submit(_open, router, backup, messages, params, flow)
+    futures = {first: primary, second: backup}
+    errors = []
+    for future in as_completed(futures):
+        if future.exception() is not None:
+            errors.append(future.exception())
+            continue
+        served["backend"] = futures[future]
+        if futures[future] is backup:
+            router.count(backup, "hedge_wins")
+        for other, backend in futures.items():
+            if other is not future:
+                other.add_done_callback(_discard(router, backend, estimated))
+        return future.result()
+    raise errors[0]
+
+
+def call_chat(messages, stream=False, use_cache=True, flow="other", auto_continue=None, **kwargs):
+    """チャット補完を呼び出す。
+
+    stream=True の場合は ChatStream を返す。それ以外は SDK の応答オブジェクトを返す。
+    use_cache=False で呼び出し単位にキャッシュ（と同一リクエストの相乗り）を無効化できる。
+    timeout を渡すとその呼び出しだけ既定のタイムアウトを上書きする。
+    max_tokens を省略すると、DEFAULT_MAX_TOKENS にあるフローは計測から学習した予算を使う
+    （キャッシュのキーには含めない）。length で打ち切られたら auto_continue 回（既定は
+    CHAT_AUTO_CONTINUE）まで続きを依頼して繋げる。max_tokens を指定した呼び出しは、その値を
+    意図した上限として扱い、auto_continue を省略しても続きは依頼しない。
+    上流への呼び出しはバックエンドを選び、その RPM/TPM の予算内に収まるまで待つ。
+    429/5xx は別のバックエンドがあればすぐそちらへ送り直し、無ければ待ってから再試行する。
+    flow は計測用のタグ（three_methods / followup / chat / random_problem / feedback など）。
+    """
+    started_at = time.perf_counter()
+    router = get_router()
+    key = make_cache_key(_model_name(), messages, **kwargs)
+    budget_flow = BUDGET_ALIASES.get(flow, flow)
+    capped = "max_tokens" in kwargs
+    if not capped and budget_flow in DEFAULT_MAX_TOKENS:
+        default = DEFAULT_MAX_TOKENS[budget_flow]
+        aliases = [alias for alias, target in BUDGET_ALIASES.items() if target == budget_flow]
+        kwargs["max_tokens"] = budgets.max_tokens(budget_flow, default, aliases) if ADAPTIVE_BUDGET else default
+    if auto_continue is None:
+        auto_continue = 0 if capped else AUTO_CONTINUE
+    # 続きの依頼は別フローとして記録し、予算の学習（完結した応答の長さ）に混ぜない
+    continue_kwargs = {**kwargs, "use_cache": use_cache, "flow": f"{flow}_continue"}
+    if use_cache and cache_enabled:
+        entry = cache.get(key)
+        if entry is not None:
+            if stream:
+                return ChatStream.replay(
+                    entry,
+                    on_complete=lambda s: _record(
+                        flow, started_at, True, 0.0, s.usage, s.finish_reason, s.ttft, cache_hit=True, error=s.error
+                    ),
+                    started_at=started_at,
+                )
+            res = _completion_from_entry(entry)
+            _record(flow, started_at, False, 0.0, res.usage, entry["finish_reason"], cache_hit=True)
+            return res
+
+    coalesce = use_cache and COALESCE_ENABLED
+    estimated = estimate_tokens(messages, kwargs.get("max_tokens"))
+    queue_wait = [0.0]
+    served = {}                 # 実際に応答したバックエンドと、ヘッジしたかどうか
+
+    def create(**extra):
+        tried = []              # このリクエストで失敗したバックエンド（フェイルオーバーでは選ばない）
+        return call_with_retries(
+            lambda: _open_routed(router, messages, {**extra, **kwargs}, flow, estimated, queue_wait, tried, served),
+            max_retries=CHAT_MAX_RETRIES,
+            base_delay=CHAT_RETRY_BASE,
+            max_delay=CHAT_RETRY_MAX,
+            stats=retry_stats,
+            failover=lambda e: router.has_alternative(tried),
+        )
+
+    try:
+        if stream:
+            if stream_usage:
+                kwargs.setdefault("stream_options", {"include_usage": True})
+            if coalesce:
+                chunks, leader = single_flight.stream(key, lambda: create(stream=True))
+            else:
+                chunks, leader = create(stream=True), True
+
+            def on_complete(s):
+                _record(flow, started_at, True, queue_wait[0], s.usage, s.finish_reason, s.ttft,
+                        coalesced=not leader, error=s.error, served=served, max_tokens=kwargs.get("max_tokens"))
+                # 相乗りした側は上流を呼んでいないので、精算とキャッシュ保存は先頭の呼び出しだけが行う
+                if not leader or s.error is not None:
+                    return
+                served["backend"].limiter.settle(estimated, s.usage.total_tokens if s.usage else None)
+                if use_cache and cache_enabled:
+                    _store(key, s.content, s.finish_reason, s.usage)
+            first = ChatStream(chunks, on_complete=on_complete, started_at=started_at)
+            if not auto_continue:
+                return first
+            return ContinuingStream(
+                first,
+                lambda content: call_chat(_continuation_messages(messages, content), stream=True,
+                                          auto_continue=0, **continue_kwargs),
+                auto_continue,
+            )
+
+        if coalesce:
+            res, leader = single_flight.call(key, create)
+        else:
+            res, leader = create(), True
+    except Exception as e:
+        _record(flow, started_at, stream, queue_wait[0], error=e, served=served, max_tokens=kwargs.get("max_tokens"))
+        raise
+
+    choice = res.choices[0]
+    _record(flow, started_at, False, queue_wait[0], res.usage, choice.finish_reason,
+            coalesced=not leader, served=served, max_tokens=kwargs.get("max_tokens"))
+    if leader:
+        served["backend"].limiter.settle(estimated, res.usage.total_tokens if res.usage else None)
+        if use_cache and cache_enabled:
+            _store(key, choice.message.content or "", choice.finish_reason, res.usage)
+    return _continue_completion(res, messages, auto_continue, **continue_kwargs)
+
+
+def stream_chat_many(message_lists, **kwargs):
+    """複数の messages を並列にストリーミングする。
+
+    (index, delta) を到着順に返し、index 番目のストリームが終わると (index, None) を返す。
+    Streamlit の描画はメインスレッドでしか行えないため、受信だけをワーカースレッドで行う。
+    どれかが失敗したり、呼び出し側が途中で読むのをやめたりしたら、残りのストリームも止める
+    （上流が最後まで生成し終わるのを待たない）。
+    """
+    if not message_lists:
+        return
+    events = queue.Queue()
+    stop = threading.Event()
+
+    def worker(i, messages):
+        try:
+            if stop.is_set():
+                return
+            deltas = iter(call_chat(messages, stream=True, **kwargs))
+            try:
+                for delta in deltas:
+                    if stop.is_set():
+                        return
+                    events.put((i, delta))
+            finally:
+                # 途中で抜けたときも上流の接続を手放す
+                deltas.close()
+            events.put((i, None))
+        except Exception as e:
+            events.put((i, e))
+
+    pool = ThreadPoolExecutor(max_workers=len(message_lists))
+    try:
+        for i, messages in enumerate(message_lists):
+            pool.submit(worker, i, messages)
+        remaining = len(message_lists)
+        while remaining:
+            i, item = events.get()
+            if isinstance(item, Exception):
+                raise item
+            if item is None:
+                remaining -= 1
+            yield i, item
+    finally:
+        # 残りのワーカーは次の差分で止まる。ここではその終了を待たずに呼び出し側へ戻る
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def cache_stats():
+    """キャッシュのヒット／ミス件数とヒット率を返す。"""
+    stats = dict(cache.stats)
+    hits = stats["memory_hits"] + stats["disk_hits"]
+    lookups = hits + stats["misses"]
+    stats["hits"] = hits
+    stats["hit_rate"] = hits / lookups if lookups else 0.0
+    return stats
+
+
+def budget_stats():
+    """フローごとの max_tokens の予算と、その根拠を返す。"""
+    return budgets.stats()
+
+
+def throttle_stats():
+    """待ち行列の深さ・待ち時間・再試行・フェイルオーバー・相乗りの件数を返す（全バックエンドの合計）。"""
+    stats = {}
+    for backend in _router.backends if _router is not None else ():
+        for name, value in backend.limiter.stats.items():
+            stats[name] = max(stats.get(name, 0), value) if name.startswith("max_") else stats.get(name, 0) + value
+    return {**stats, **retry_stats, **single_flight.stats}
+
+
+def backend_health():
+    """バックエンドごとの健全性（EWMA レイテンシ・処理中の件数・失敗・ヘッジ）を返す。"""
+    return _router.health() if _router is not None else []
+
 
-def call_chat(messages, **kwargs):
-    return client.chat.completions.create(
-        model=deployment,
-        messages=messages,
-        **kwargs
-    )
\ No newline at end of file
+def markdown_deltas(stream):
+    """改行を Markdown の改行（末尾スペース2つ）に変換しながら差分を流す。"""
+    for delta in stream:
+        yield delta.replace("\n", "  \n")
@@ -1,62 +1,29 @@
-import os
 import streamlit as st
-from dotenv import load_dotenv
-from openai import AzureOpenAI
 from random import choice
 
-# .env の読み込み
-load_dotenv()
-
-# 環境変数
-endpoint    = os.getenv("AZURE_OPENAI_ENDPOINT")
-deployment  = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-api_key     = os.getenv("AZURE_OPENAI_API_KEY")
-api_version = os.getenv("AZURE_OPENAI_API_VERSION")
-
-# バリデーション
-if not all([endpoint, deployment, api_key, api_version]):
-    st.error("環境変数が正しく設定されていません。")
-    st.stop()
-
-# AzureOpenAI クライアント
-client = AzureOpenAI(
-    azure_endpoint=endpoint,
-    api_key=api_key,
-    api_version=api_version,
+# Azure OpenAI の呼び出しは main.py と共通のラッパー（共有クライアント・応答キャッシュ付き）を使う
+from ai_utils import call_chat, get_client
+from problem_pool import get_pool
+from training_prompts import (
+    generate_feedback_prompt,
+    generate_random_problem_prompt,
+    sample_problems,
+    system_message,
 )
 
 st.set_page_config(page_title="アルゴリズム思考トレーニングAI", layout="wide")
 st.title("🧠 アルゴリズム思考トレーニングAI")
 
-# システムメッセージ
-system_message = {
-    "role": "system",
-    "content": (
-        "あなたは開発入門者の論理的思考を育成する教育アシスタントです\n"
-        "ユーザーが提示した問題とアルゴリズムのステップに対して\n"
-        "1.構成の素晴らしさや不足を指摘\n"
-        "2.最適化や利便さの要素を含む代替案\n"
-        "3.思考を深める質問を提示\n"
-        "を旨としたコメントを日常的な例えも使いながら行ってください"
-    )
-}
-
-# サンプル
-sample_problems = [
-    "リストから最も頻繁に出現する要素を求める",
-    "配列から最大値を求める",
-    "回文かどうかを判定する",
-    "同じ値が連続するものを削除する"
-]
-
-# チャットAPI
-
-def call_chat(messages, **kwargs):
-    return client.chat.completions.create(
-        model=deployment,
-        messages=messages,
-        **kwargs
-    )
+# 環境変数の検証と共有クライアントの準備（プロセス内で 1 度だけ行われる）
+try:
+    get_client()
+except EnvironmentError:
+    st.error("環境変数が正しく設定されていません。")
+    st.stop()
+
+# ランダム問題はバックグラウンドで補充される在庫から出す（起動直後から補充を始めておく）
+problem_pool = get_pool()
+problem_pool.ensure_filled()
 
 # タブ
 tab1, tab2 = st.tabs(["1. 問題と思考を入力", "2. AIからフィードバック"])
@@ -103,15 +70,19 @@ with tab1:
             target_problem = st.session_state.selected_sample_problem
     else:
         if st.button("ランダム問題を生成する", key="generate_random"):
-            user_msg = {
-                "role": "user",
-                "content": (
-                    "開発入門者向けに、多種多様なアルゴリズム学習用の問題タイトルを「リストから最も頻繁に出現する要素を求める」のような形で1件だけ生成してください。追加でコメントやレビューなどは不要です。過去に出たような典型問題（最大値・最頻値・ソートなど）を避け、工夫や発想が求められるテーマにしてください。"
-                )
-            }
-            with st.spinner("AIが問題を考え中..."):
-                res = call_chat(messages=[system_message, user_msg], max_tokens=200, temperature=0.7)
-                st.session_state.ai_generated_problem = res.choices[0].message.content.strip().strip('"')
+            title = problem_pool.take()
+            if title is None:
+                # 在庫切れ（起動直後など）のときだけ、その場で 1 件生成する
+                with st.spinner("AIが問題を考え中..."):
+                    # タイトルは 1 行なので、改行が来たらそこで生成を止める
+                    stream = call_chat(messages=[system_message, generate_random_problem_prompt()], stream=True, use_cache=False, flow="random_problem", temperature=0.7, stop=["\n"])
+                live_area = st.empty()
+                with live_area.container():
+                    st.write_stream(stream)
+                live_area.empty()
+                title = stream.content.strip().strip('"')
+                problem_pool.mark_served(title)
+            st.session_state.ai_generated_problem = title
         st.text_input("AI生成問題タイトル", value=st.session_state.ai_generated_problem, key="ai_generated_display", disabled=True)
         target_problem = st.session_state.ai_generated_problem
 
@@ -130,21 +101,12 @@ with tab1:
         if not (target_problem and steps and reason):
             st.warning("全て入力してください")
         else:
-            comment_note = "" if user_created_problem else "問題に対するコメントは省略してください。"
-            user_msg = {
-                "role": "user",
-                "content": (
-                    f"問題: {target_problem}\n"
-                    f"思考ステップ: {steps}\n"
-                    f"考えた理由: {reason}\n"
-                    f"{comment_note}\n"
-                    "上記情報をもとに、アルゴリズムの構成を検証し、\n"
-                    "1.良い点と改善点\n2.代替案やヒント\n3.思考を深める質問\nを教えてください"
-                )
-            }
+            user_msg = generate_feedback_prompt(target_problem, steps, reason, user_created_problem)
             with st.spinner("生成中..."):
-                res = call_chat(messages=[system_message, user_msg], max_tokens=800, temperature=0.6)
-            st.session_state.feedback = res.choices[0].message.content
+                stream = call_chat(messages=[system_message, user_msg], stream=True, flow="feedback", temperature=0.6)
+            # フィードバックはタブ1のボタン直下にそのまま流し、タブ2にも結果を保存する
+            st.write_stream(stream)
+            st.session_state.feedback = stream.content
 
 
 
@@ -0,0 +1,243 @@
+# api_server.py
+#
+# core.py のフローを HTTP API として公開する（Streamlit を使わないクライアント向け）。
+# ストリーミングする処理は Server-Sent Events（text/event-stream）で返す。
+#
+#   python api_server.py --port 8080
+#
+# 状態はすべて SESSION_STORE_URL のストアに保存するため、プロセス内に持つセッション状態は無い。
+# 同じストアを共有すれば、ロードバランサーの背後で複数プロセス・複数台に増やせる。
+#
+#   POST /api/sessions                          新しいセッション         -> {"session_id", ...}
+#   GET  /api/sessions/{sid}                    状態                     -> {"problem", "methods", ...}
+#   PUT  /api/sessions/{sid}/problem            {"problem"}
+#   GET  /api/sessions/{sid}/similar            解決済みの類似問題       -> {"hits": [...]}
+#   POST /api/sessions/{sid}/methods            {"problem"?, "parallel"?}  SSE: partial / method / methods
+#   PUT  /api/sessions/{sid}/methods            {"methods": [...]}（類似問題の結果を使う）
+#   POST /api/sessions/{sid}/followup           {"method_index"}         SSE: delta / message
+#   POST /api/sessions/{sid}/chat               {"message"}              SSE: message / delta / message
+#   GET  /api/sessions/{sid}/messages?method_index=&offset=&limit=       -> {"total", "messages"}
+#   GET  /healthz
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from ai_utils import get_client
+from core import Session, find_similar
+from method_parser import Method
+
+# 上流の呼び出しはブロッキングのため、ストリームごとにこのプールのスレッドで読む
+API_WORKER_THREADS = int(os.getenv("API_WORKER_THREADS", "64"))
+
+
+def _to_json(value):
+    if isinstance(value, Method):
+        return value.to_dict()
+    raise TypeError(f"{type(value).__name__} は JSON にできません")
+
+
+def _json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=lambda v: json.dumps(v, ensure_ascii=False, default=_to_json))
+
+
+async def _read_json(request) -> dict:
+    if not request.can_read_body:
+        return {}
+    try:
+        body = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="JSON として読めません")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="JSON オブジェクトを送ってください")
+    return body
+
+
+def _session(request) -> Session:
+    return Session(request.match_info["sid"])
+
+
+# ----------------------------------------
+# SSE
+# ----------------------------------------
+async def _stream_events(request, make_events):
+    """make_events() が返す core のイベントを、ワーカースレッドで読みながら SSE で送る。
+
+    クライアントが切断したらワーカーに伝え、上流の読み込みも止める。
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancelled = threading.Event()
+    done = object()
+
+    def worker():
+        try:
+            events = make_events()
+            try:
+                for event in events:
+                    if cancelled.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, event)
+            finally:
+                events.close()
+        except ValueError as e:
+            loop.call_soon_threadsafe(queue.put_nowait, ("error", {"message": str(e), "status": 400}))
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, ("error", {"message": f"{type(e).__name__}: {e}", "status": 502}))
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream; charset=utf-8",
+        "Cache-Control": "no-cache",
+        # リバースプロキシにバッファリングさせない
+        "X-Accel-Buffering": "no",
+    })
+    await response.prepare(request)
+    future = loop.run_in_executor(request.app["executor"], worker)
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            event, data = item
+            payload = json.dumps(data, ensure_ascii=False, default=_to_json)
+            await response.write(f"event: {event}\ndata: {payload}\n\n".encode("utf-8"))
+        await response.write(b"event: end\ndata: {}\n\n")
+    finally:
+        # 切断・キャンセル時はワーカーが次のイベントで読み込みをやめる
+        cancelled.set()
+    await future
+    return response
+
+
+# ----------------------------------------
+# ハンドラー
+# ----------------------------------------
+async def create_session(request):
+    session = await asyncio.to_thread(Session)
+    return _json_response(session.to_dict(), status=201)
+
+
+async def get_session(request):
+    session = await asyncio.to_thread(_session, request)
+    return _json_response(session.to_dict())
+
+
+async def put_problem(request):
+    body = await _read_json(request)
+    session = await asyncio.to_thread(_session, request)
+    await asyncio.to_thread(session.set_problem, str(body.get("problem", "")))
+    return _json_response(session.to_dict())
+
+
+async def get_similar(request):
+    session = await asyncio.to_thread(_session, request)
+    hits = await asyncio.to_thread(find_similar, request.query.get("q", session.problem))
+    return _json_response({"hits": hits})
+
+
+async def post_methods(request):
+    body = await _read_json(request)
+    parallel = bool(body.get("parallel", True))
+
+    def make_events():
+        session = _session(request)
+        if "problem" in body:
+            session.set_problem(str(body["problem"]))
+        return session.generate_methods(parallel=parallel)
+
+    return await _stream_events(request, make_events)
+
+
+async def put_methods(request):
+    body = await _read_json(request)
+    try:
+        methods = [Method.from_dict(d) for d in body.get("methods", [])]
+    except TypeError:
+        raise web.HTTPBadRequest(text="methods の形式が正しくありません")
+    session = await asyncio.to_thread(_session, request)
+    await asyncio.to_thread(session.use_methods, methods)
+    return _json_response(session.to_dict())
+
+
+async def post_followup(request):
+    body = await _read_json(request)
+    method_idx = body.get("method_index")
+
+    def make_events():
+        return _session(request).followup(None if method_idx is None else int(method_idx))
+
+    return await _stream_events(request, make_events)
+
+
+async def post_chat(request):
+    body = await _read_json(request)
+    text = str(body.get("message", ""))
+
+    def make_events():
+        return _session(request).chat(text)
+
+    return await _stream_events(request, make_events)
+
+
+async def get_messages(request):
+    try:
+        method_idx = int(request.query.get("method_index", "0"))
+        offset = int(request.query.get("offset", "0"))
+        limit = int(request.query["limit"]) if "limit" in request.query else None
+    except ValueError:
+        raise web.HTTPBadRequest(text="method_index / offset / limit は整数で指定してください")
+    session = await asyncio.to_thread(_session, request)
+    total = await asyncio.to_thread(session.count_messages, method_idx)
+    messages = await asyncio.to_thread(session.load_messages, method_idx, offset, limit)
+    return _json_response({"thread": session.thread, "total": total, "offset": offset, "messages": messages})
+
+
+async def healthz(request):
+    return _json_response({"status": "ok"})
+
+
+def make_app() -> web.Application:
+    app = web.Application()
+    app["executor"] = ThreadPoolExecutor(max_workers=API_WORKER_THREADS, thread_name_prefix="api-stream")
+
+    async def shutdown_executor(app):
+        app["executor"].shutdown(wait=False)
+
+    app.on_cleanup.append(shutdown_executor)
+    app.add_routes([
+        web.post("/api/sessions", create_session),
+        web.get("/api/sessions/{sid}", get_session),
+        web.put("/api/sessions/{sid}/problem", put_problem),
+        web.get("/api/sessions/{sid}/similar", get_similar),
+        web.post("/api/sessions/{sid}/methods", post_methods),
+        web.put("/api/sessions/{sid}/methods", put_methods),
+        web.post("/api/sessions/{sid}/followup", post_followup),
+        web.post("/api/sessions/{sid}/chat", post_chat),
+        web.get("/api/sessions/{sid}/messages", get_messages),
+        web.get("/healthz", healthz),
+    ])
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="問題解決サポート AI の HTTP API（SSE）")
+    parser.add_argument("--host", default=os.getenv("API_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("API_PORT", "8080")))
+    args = parser.parse_args()
+
+    try:
+        get_client()
+    except EnvironmentError:
+        raise SystemExit("環境変数が正しく設定されていません。")
+    web.run_app(make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# bench/run_bench.py
+#
+# ネットワーク不要のベンチマーク。ローカルのスタブサーバーに対して実際のアプリの処理を流し、
+# 結果を JSON で書き出す。
+#
+#   python -m bench.run_bench --concurrency 1 4 8 --chat-turns 10 --out bench_results/latest.json
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.stub_server import StubConfig, start_server  # noqa: E402
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": ordered[-1],
+    }
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# ----------------------------------------
+# シナリオ：call_chat を直接呼ぶ（TTFT とエンドツーエンド）
+# ----------------------------------------
+def bench_call_chat(concurrency, requests_per_worker, max_tokens):
+    import ai_utils
+
+    ttft, total = [], []
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        for i in range(requests_per_worker):
+            messages = [{"role": "user", "content": f"ベンチマーク {worker_id}-{i}"}]
+            start = time.perf_counter()
+            first = None
+            stream = ai_utils.call_chat(messages, stream=True, use_cache=False, max_tokens=max_tokens)
+            for _ in stream:
+                if first is None:
+                    first = time.perf_counter() - start
+            with lock:
+                ttft.append(first if first is not None else time.perf_counter() - start)
+                total.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "ttft_s": percentiles(ttft),
+        "latency_s": percentiles(total),
+        "throughput_rps": len(total) / elapsed if elapsed else 0.0,
+    }
+
+
+# ----------------------------------------
+# シナリオ：Streamlit アプリを AppTest でヘッドレス実行
+# ----------------------------------------
+def _timed(samples, name, fn):
+    start = time.perf_counter()
+    fn()
+    samples.setdefault(name, []).append(time.perf_counter() - start)
+
+
+def _stub_requests():
+    base_url = os.environ["AZURE_OPENAI_ENDPOINT"]
+    with urllib.request.urlopen(base_url + "/_stats") as res:
+        return json.load(res)["requests"]
+
+
+def run_main_session(samples, chat_turns, parallel, timeout):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(ROOT, "main.py"), default_timeout=timeout)
+    _timed(samples, "initial_render", at.run)
+    at.text_area[0].input(f"毎日更新される CSV から重複を除去して登録したい ({time.perf_counter()})")
+    at.checkbox[0].set_value(parallel)
+    _timed(samples, "three_methods", lambda: at.button(key="gen_methods_btn").click().run())
+    _timed(samples, "followup", lambda: at.button(key="followup_btn").click().run())
+
+    prompt_tokens, cached_tokens = [], []
+    for turn in range(chat_turns):
+        marker = f"追加質問 {uuid.uuid4().hex}"
+        at.text_input[0].input(f"{marker}: もう少し詳しく教えてください。")
+        submit = next(b for b in at.button if b.label == "送信")
+        _timed(samples, "chat_turn", lambda: submit.click().run())
+        # 要約の呼び出しと区別するため、今回の質問で終わるリクエストをチャット本体とみなす
+        for request in reversed(_stub_requests()):
+            if marker in request["last_message"]:
+                prompt_tokens.append(request["prompt_tokens"])
+                cached_tokens.append(request.get("cached_tokens", 0))
+                break
+        # 操作なしの再実行（ウィジェット操作 1 回分の描画コスト）
+        _timed(samples, "rerun_render", at.run)
+    if at.exception:
+        raise RuntimeError(f"main.py raised: {at.exception}")
+    return prompt_tokens, cached_tokens
+
+
+def run_training_session(samples, timeout):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(ROOT, "algorism_ai_traning.py"), default_timeout=timeout)
+    _timed(samples, "initial_render", at.run)
+    at.radio[0].set_value("AIがランダムに生成")
+    at.run()
+    _timed(samples, "random_problem", lambda: at.button(key="generate_random").click().run())
+    at.text_area[0].input("1. 要素を数える 2. 最大を選ぶ")
+    at.text_area[1].input("数えてから比べると分かりやすいため")
+    _timed(samples, "feedback", lambda: at.button(key="get_feedback").click().run())
+    _timed(samples, "rerun_render", at.run)
+    if at.exception:
+        raise RuntimeError(f"algorism_ai_traning.py raised: {at.exception}")
+
+
+def _app_worker(chat_turns, parallel, timeout):
+    # 別プロセスで実行される（AppTest は同一プロセス内の並列実行に対応していないため）
+    samples, training_samples = {}, {}
+    tokens, cached = run_main_session(samples, chat_turns, parallel, timeout)
+    run_training_session(training_samples, timeout)
+    return samples, training_samples, tokens, cached
+
+
+def bench_apps(concurrency, chat_turns, parallel, timeout):
+    samples = {}
+    training_samples = {}
+    growth, cached_growth = [], []
+    with ProcessPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(_app_worker, chat_turns, parallel, timeout) for _ in range(concurrency)]
+        for future in futures:
+            local, local_training, tokens, cached = future.result()
+            for name, values in local.items():
+                samples.setdefault(name, []).extend(values)
+            for name, values in local_training.items():
+                training_samples.setdefault(name, []).extend(values)
+            growth.append(tokens)
+            cached_growth.append(cached)
+
+    return {
+        "main": {name: percentiles(values) for name, values in samples.items()},
+        "training": {name: percentiles(values) for name, values in training_samples.items()},
+        # ターンごとのチャット本体のプロンプトトークン数（セッション間の平均）
+        "chat_prompt_tokens_per_turn": [
+            statistics.fmean(values) if values else None
+            for values in ([tokens[t] for tokens in growth if len(tokens) > t] for t in range(chat_turns))
+        ],
+        # そのうちサーバー側のプロンプトキャッシュに当たったトークン数（スタブの模擬）
+        "chat_cached_tokens_per_turn": [
+            statistics.fmean(values) if values else None
+            for values in ([tokens[t] for tokens in cached_growth if len(tokens) > t] for t in range(chat_turns))
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="スタブサーバーを使ったオフラインベンチマーク")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--requests", type=int, default=5, help="call_chat シナリオの 1 ワーカーあたりのリクエスト数")
+    parser.add_argument("--chat-turns", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--tps", type=float, default=200.0)
+    parser.add_argument("--error-429", type=float, default=0.0)
+    parser.add_argument("--error-500", type=float, default=0.0)
+    parser.add_argument("--single-request", action="store_true", help="３手法を 1 リクエストで生成するモードで計測")
+    parser.add_argument("--cache", action="store_true", help="応答キャッシュを有効にしたまま計測する")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    config = StubConfig(
+        latency=args.latency, tps=args.tps, error_429=args.error_429, error_500=args.error_500, retry_after=0.5
+    )
+    server, base_url = start_server(config)
+    workdir = tempfile.mkdtemp(prefix="algorism-bench-")
+    os.environ.update({
+        "AZURE_OPENAI_ENDPOINT": base_url,
+        "AZURE_OPENAI_DEPLOYMENT": "bench",
+        "AZURE_OPENAI_API_KEY": "bench",
+        "AZURE_OPENAI_API_VERSION": "2024-10-21",
+        "CHAT_CACHE_ENABLED": "1" if args.cache else "0",
+        "CHAT_CACHE_PATH": os.path.join(workdir, "chat_cache.sqlite3"),
+        "CHAT_RETRY_BASE": "0.2",
+        "SESSION_STORE_URL": "sqlite:///" + os.path.join(workdir, "sessions.sqlite3"),
+        "METRICS_JSONL_PATH": os.path.join(workdir, "metrics.jsonl"),
+        "PROBLEM_POOL_PATH": os.path.join(workdir, "problem_pool.json"),
+        "SIMILAR_PROBLEM_PATH": os.path.join(workdir, "solved_problems.sqlite3"),
+    })
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_rev": _git_rev(),
+        "config": vars(args),
+        "runs": [],
+    }
+    for concurrency in args.concurrency:
+        print(f"concurrency={concurrency} ...", file=sys.stderr)
+        with config.lock:
+            config.requests.clear()
+        run = {
+            "concurrency": concurrency,
+            "call_chat": bench_call_chat(concurrency, args.requests, max_tokens=300),
+            "apps": bench_apps(concurrency, args.chat_turns, not args.single_request, args.timeout),
+        }
+        with config.lock:
+            run["upstream_requests"] = len(config.requests)
+        results["runs"].append(run)
+    server.shutdown()
+
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.out:
+        if os.path.dirname(args.out):
+            os.makedirs(os.path.dirname(args.out), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"wrote {args.out}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+# bench/stub_server.py
+#
+# ネットワーク不要の Azure OpenAI 互換スタブサーバー（ベンチマーク・動作確認用）。
+#   python -m bench.stub_server --port 8765 --latency 0.3 --tps 80 --error-429 0.05
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_PATH_RE = re.compile(r"^/openai/deployments/(?P<deployment>[^/]+)/chat/completions")
+
+
+# Azure OpenAI のプロンプトキャッシュと同じく、1024 トークン以上の先頭一致を 128 トークン単位で数える
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_BLOCK = 128
+
+
+def estimate_tokens(text: str) -> int:
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+
+def _method_block(label: str) -> str:
+    return (
+        f"### 手法{label}: スタブツール{label}\n"
+        "【実装手順】\n1. データを読み込む\n2. 重複を取り除く\n3. 保存する\n"
+        "【必要なライブラリ・機能】\nstub-lib\n"
+        "【メリット】\n- 速い\n"
+        "【デメリット】\n- 架空である\n"
+    )
+
+
+def default_responder(messages: list, max_tokens: int) -> str:
+    """プロンプトの内容に応じて、それらしい形の応答を返す。"""
+    prompt = messages[-1]["content"] if messages else ""
+    if "### 手法" in prompt:
+        labels = re.findall(r"^### 手法([ABC]): ツール名", prompt, re.M)
+        if "３つの解決手段" in prompt:
+            labels = ["A", "B", "C"]
+        return "\n".join(_method_block(label) for label in labels or ["A"])
+    if "問題タイトル" in prompt:
+        # バッチ生成（件数指定あり）なら件数分、そうでなければ 1 件
+        m = re.search(r"(\d+)\s*件", prompt)
+        count = int(m.group(1)) if m else 1
+        return "\n".join(f"スタブ問題 {uuid.uuid4().hex[:6]}" for _ in range(count))
+    body = "これはスタブサーバーの応答です。手順と注意点を順に説明します。\n"
+    return (body * max(1, max_tokens // estimate_tokens(body)))[: max_tokens]
+
+
+class StubConfig:
+    def __init__(self, latency=0.2, tps=100.0, error_429=0.0, error_500=0.0,
+                 retry_after=1.0, max_tokens_cap=None, responder=default_responder):
+        self.latency = latency            # 最初のトークンまでの遅延（秒）
+        self.tps = tps                    # 生成速度（トークン/秒、0 以下で即時）
+        self.error_429 = error_429        # 429 を返す確率
+        self.error_500 = error_500        # 500 を返す確率
+        self.retry_after = retry_after
+        self.max_tokens_cap = max_tokens_cap
+        self.responder = responder
+        self.lock = threading.Lock()
+        self.requests = []                # 受け付けたリクエストの記録
+        self.prefixes = set()             # これまでに見たメッセージ列の先頭部分（プロンプトキャッシュの模擬）
+
+
+def _prefix_keys(deployment, messages):
+    # messages[:1], messages[:2], ... のハッシュ（デプロイごとに別のキャッシュ）
+    digest = hashlib.sha256(deployment.encode("utf-8"))
+    keys = []
+    for msg in messages:
+        digest.update(json.dumps(msg, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+        keys.append(digest.copy().hexdigest())
+    return keys
+
+
+def cached_prompt_tokens(config, deployment, messages) -> int:
+    """以前のリクエストと先頭から一致するメッセージ分のトークン数を返し、今回の先頭部分も覚える。"""
+    keys = _prefix_keys(deployment, messages)
+    matched = 0
+    with config.lock:
+        for key, msg in zip(keys, messages):
+            if key not in config.prefixes:
+                break
+            matched += estimate_tokens(msg.get("content") or "") + 4
+        config.prefixes.update(keys)
+    if matched < PROMPT_CACHE_MIN_TOKENS:
+        return 0
+    return matched // PROMPT_CACHE_BLOCK * PROMPT_CACHE_BLOCK
+
+
+def make_handler(config: StubConfig):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.startswith("/_stats"):
+                with config.lock:
+                    self._send_json(200, {"requests": list(config.requests)})
+            else:
+                # ウォームアップ用の models.list など
+                self._send_json(200, {"object": "list", "data": []})
+
+        def do_POST(self):
+            m = _PATH_RE.match(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not m:
+                self._send_json(404, {"error": {"message": "not found"}})
+                return
+
+            roll = random.random()
+            if roll < config.error_429:
+                self._send_json(429, {"error": {"code": "429", "message": "Rate limit"}},
+                                {"Retry-After": str(config.retry_after)})
+                return
+            if roll < config.error_429 + config.error_500:
+                self._send_json(500, {"error": {"code": "500", "message": "Internal error"}})
+                return
+
+            messages = body.get("messages", [])
+            max_tokens = body.get("max_tokens") or body.get("max_completion_tokens") or 1000
+            prompt_tokens = sum(estimate_tokens(msg.get("content") or "") + 4 for msg in messages)
+            cached_tokens = cached_prompt_tokens(config, m.group("deployment"), messages)
+            text = config.responder(messages, max_tokens)
+            for stop in body.get("stop") or []:
+                if stop and stop in text:
+                    text = text[: text.index(stop)]
+            pieces = re.findall(r".{1,3}", text, re.S)
+            finish_reason = "stop"
+            if len(pieces) > max_tokens:
+                pieces = pieces[:max_tokens]
+                finish_reason = "length"
+            completion_tokens = len(pieces)
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            }
+            with config.lock:
+                config.requests.append({
+                    "time": time.time(),
+                    "deployment": m.group("deployment"),
+                    "prompt_tokens": prompt_tokens,
+                    "cached_tokens": cached_tokens,
+                    "max_tokens": max_tokens,
+                    "stream": bool(body.get("stream")),
+                    "last_message": (messages[-1].get("content") or "")[-200:] if messages else "",
+                })
+
+            time.sleep(config.latency)
+            base = {"id": "stub-" + uuid.uuid4().hex[:8], "created": int(time.time()), "model": m.group("deployment")}
+            if not body.get("stream"):
+                time.sleep(completion_tokens / config.tps if config.tps > 0 else 0)
+                self._send_json(200, {
+                    **base,
+                    "object": "chat.completion",
+                    "choices": [{"index": 0, "finish_reason": finish_reason,
+                                 "message": {"role": "assistant", "content": "".join(pieces)}}],
+                    "usage": usage,
+                })
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            def send(payload):
+                self.wfile.write(b"data: " + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n")
+                self.wfile.flush()
+
+            try:
+                chunk = {**base, "object": "chat.completion.chunk"}
+                for piece in pieces:
+                    send({**chunk, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+                    if config.tps > 0:
+                        time.sleep(1.0 / config.tps)
+                send({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    send({**chunk, "choices": [], "usage": usage})
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # クライアントが途中で切断した（キャンセル・ヘッジの負け側など）
+                pass
+
+    return Handler
+
+
+def start_server(config: StubConfig, host="127.0.0.1", port=0):
+    """バックグラウンドでスタブを起動し、(server, base_url) を返す。"""
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Azure OpenAI 互換のスタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--tps", type=float, default=100.0)
+    parser.add_argument("--error-429", type=float, default=0.0)
+    parser.add_argument("--error-500", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency, args.tps, args.error_429, args.error_500, args.retry_after)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(config))
+    print(f"stub server listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
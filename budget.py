@@ -0,0 +1,82 @@
+# budget.py
+
+import math
+import threading
+import time
+
+from metrics import percentile
+
+
+class BudgetController:
+    """フローごとの max_tokens を、記録した completion_tokens と finish_reason から決める。
+
+    計測が min_samples 件貯まるまでは呼び出し側の初期値を使い、以降は最後まで生成できた
+    （finish_reason が stop の）応答の長さの quantile 分位点に headroom を掛けた値にする。
+    length で打ち切られた割合が max_truncated_rate を超えたら、前回の予算の 1.5 倍まで広げる。
+    予算は初期値の max_factor 倍を上限、floor を下限とし、refresh 秒ごとに計算し直す。
+    """
+
+    def __init__(self, recorder, quantile=0.99, headroom=1.25, min_samples=20,
+                 max_truncated_rate=0.02, max_factor=2.0, floor=64, window=200, refresh=30.0):
+        self.recorder = recorder
+        self.quantile = quantile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.max_truncated_rate = max_truncated_rate
+        self.max_factor = max_factor
+        self.floor = floor
+        self.window = window
+        self.refresh = refresh
+        self._budgets = {}          # flow -> {"max_tokens", "default", "updated", ...}
+        self._lock = threading.Lock()
+
+    def _samples(self, flows):
+        # キャッシュ・相乗り・失敗した呼び出しは上流の生成長を表さないので除く
+        records = [
+            r for r in self.recorder.recent()
+            if r.get("flow") in flows
+            and r.get("completion_tokens") is not None
+            and not (r.get("cache_hit") or r.get("coalesced") or r.get("error"))
+        ]
+        return records[-self.window:]
+
+    def _compute(self, flows, default, previous):
+        records = self._samples(flows)
+        row = {"default": default, "samples": len(records), "truncated_rate": None, "p": None}
+        if len(records) < self.min_samples:
+            row["max_tokens"] = default
+            return row
+        finished = [r["completion_tokens"] for r in records if r.get("finish_reason") == "stop"]
+        truncated = sum(1 for r in records if r.get("finish_reason") == "length") / len(records)
+        row["truncated_rate"] = truncated
+        row["p"] = percentile(finished, self.quantile)
+        budget = math.ceil((row["p"] or default) * self.headroom)
+        if truncated > self.max_truncated_rate:
+            budget = max(budget, math.ceil(previous * 1.5))
+        row["max_tokens"] = max(self.floor, min(budget, int(default * self.max_factor)))
+        return row
+
+    def max_tokens(self, flow, default, aliases=()) -> int:
+        """flow の現在の予算を返す。default は計測が貯まるまでの初期値（上限の基準にもなる）。
+
+        aliases は同じ生成を別の名前で記録しているフローで、その計測も学習に使う。
+        """
+        now = time.monotonic()
+        with self._lock:
+            row = self._budgets.get(flow)
+            if row is not None and row["default"] == default and now - row["updated"] < self.refresh:
+                return row["max_tokens"]
+        previous = row["max_tokens"] if row is not None else default
+        row = self._compute({flow, *aliases}, default, previous)
+        row["updated"] = now
+        with self._lock:
+            self._budgets[flow] = row
+        return row["max_tokens"]
+
+    def stats(self) -> dict:
+        """管理画面用に、フローごとの予算と根拠（サンプル数・分位点・打ち切り率）を返す。"""
+        with self._lock:
+            return {
+                flow: {key: value for key, value in row.items() if key != "updated"}
+                for flow, row in sorted(self._budgets.items())
+            }
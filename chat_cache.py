@@ -0,0 +1,129 @@
+# chat_cache.py
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# ----------------------------------------
+# キー生成
+# ----------------------------------------
+# 応答内容に影響しない引数はキーに含めない
+_IGNORED_PARAMS = {"stream", "stream_options", "timeout"}
+
+
+def make_cache_key(deployment, messages, temperature=None, max_tokens=None, **params) -> str:
+    """(deployment, messages, temperature, max_tokens, その他パラメータ) の正規化ハッシュを返す。"""
+    payload = {
+        "deployment": deployment,
+        "messages": [{"role": m["role"], "content": m["content"]} for m in messages],
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "params": {k: v for k, v in params.items() if k not in _IGNORED_PARAMS},
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# ----------------------------------------
+# 2段キャッシュ（メモリ LRU + SQLite）
+# ----------------------------------------
+class ChatCache:
+    """応答キャッシュ。
+
+    値は {"content", "finish_reason", "usage"} の辞書。メモリ層は件数上限の LRU、
+    ディスク層は SQLite で、どちらも TTL を超えたエントリは返さない。
+    """
+
+    def __init__(self, path, ttl=86400, memory_items=256, disk_items=10000):
+        self.path = path
+        self.ttl = ttl
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self._memory = OrderedDict()        # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self._conn = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+    def _db(self):
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Streamlit は複数スレッドでセッションを処理するため、接続はロックで保護して共有する
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " stored_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS chat_cache_accessed ON chat_cache (accessed_at)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                stored_at, value = item
+                if now - stored_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+
+            db = self._db()
+            row = db.execute(
+                "SELECT value, stored_at FROM chat_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                if now - row[1] <= self.ttl:
+                    db.execute("UPDATE chat_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                    db.commit()
+                    value = json.loads(row[0])
+                    self._remember(key, row[1], value)
+                    self.stats["disk_hits"] += 1
+                    return value
+                db.execute("DELETE FROM chat_cache WHERE key = ?", (key,))
+                db.commit()
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO chat_cache (key, value, stored_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            self._evict_disk(db, now)
+            db.commit()
+            self.stats["writes"] += 1
+
+    def _remember(self, key, stored_at, value):
+        self._memory[key] = (stored_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _evict_disk(self, db, now):
+        # 期限切れを削除した後、件数上限を超えた分を最終アクセスが古い順に削除する
+        cur = db.execute("DELETE FROM chat_cache WHERE stored_at < ?", (now - self.ttl,))
+        self.stats["evictions"] += cur.rowcount
+        count = db.execute("SELECT COUNT(*) FROM chat_cache").fetchone()[0]
+        if count > self.disk_items:
+            cur = db.execute(
+                "DELETE FROM chat_cache WHERE key IN ("
+                " SELECT key FROM chat_cache ORDER BY accessed_at ASC LIMIT ?)",
+                (count - self.disk_items,),
+            )
+            self.stats["evictions"] += cur.rowcount
@@ -0,0 +1,125 @@
+# chat_context.py
+
+import logging
+import os
+import threading
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken が無い環境では文字数ベースの概算で数える
+    tiktoken = None
+
+from ai_utils import call_chat
+from prompts import generate_summary_prompt
+from throttle import estimate_text_tokens
+
+logger = logging.getLogger(__name__)
+
+# プロンプト全体（system + 手法説明 + 要約 + 直近の履歴）に使うトークン数の上限
+CHAT_CONTEXT_BUDGET = int(os.getenv("CHAT_CONTEXT_BUDGET", "3000"))
+# 要約 1 回あたりの出力トークン上限（＝要約メッセージの大きさの上限）
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "400"))
+TOKEN_ENCODING = os.getenv("TOKEN_ENCODING", "o200k_base")
+
+# メッセージ 1 件ごとに role などで消費される分
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+# ----------------------------------------
+# トークン数の計測
+# ----------------------------------------
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+                except Exception:
+                    # 語彙ファイルを取得できない（オフライン等）場合は概算にフォールバック
+                    _encoding = False
+    return _encoding or None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return estimate_text_tokens(text)
+
+
+def message_tokens(message: dict) -> int:
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+# ----------------------------------------
+# 要約
+# ----------------------------------------
+def new_summary_state() -> dict:
+    """手法ごとの要約状態。covered は要約に畳み込み済みの履歴件数。"""
+    return {"summary": "", "covered": 0}
+
+
+def summarize_turns(previous_summary: str, turns: list) -> str:
+    """既存の要約に新しいターンだけを追加で畳み込んだ要約を返す。"""
+    messages = [generate_summary_prompt(previous_summary, turns)]
+    # 要約の大きさは CHAT_SUMMARY_MAX_TOKENS 分しか確保していないため、打ち切られても続きは依頼しない
+    res = call_chat(messages=messages, flow="chat_summary", max_tokens=CHAT_SUMMARY_MAX_TOKENS,
+                    auto_continue=0, temperature=0.2)
+    return res.choices[0].message.content.strip()
+
+
+def _summary_message(summary: str) -> dict:
+    return {
+        "role": "system",
+        "content": "これまでの会話の要約です。\n\n" + summary,
+    }
+
+
+# ----------------------------------------
+# コンテキストの組み立て
+# ----------------------------------------
+def build_chat_messages(prefix_messages, history, summary_state, budget=None, summarize=summarize_turns, offset=0):
+    """予算内に収まるチャット用 messages を組み立てる。
+
+    history は今回のユーザー発言を末尾に含んだ履歴で、全履歴の offset 件目から始まるもの
+    （要約済みの分を読み込まずに渡せるよう）。予算を超える場合は古いターンから
+    summary_state に畳み込む。要約済みのターンは二度と要約し直さないため、要約の呼び出しは
+    予算を超えたときだけ、新しく溢れた分に対してのみ行われる。
+    """
+    if budget is None:
+        budget = CHAT_CONTEXT_BUDGET
+
+    fixed = sum(message_tokens(m) for m in prefix_messages)
+    # 要約メッセージは常に上限サイズ分を確保しておき、要約が育っても予算を超えないようにする
+    available = budget - fixed - (CHAT_SUMMARY_MAX_TOKENS + MESSAGE_OVERHEAD_TOKENS)
+
+    recent = history[summary_state["covered"] - offset:]
+    if available <= 0:
+        # 先頭部分だけで予算を使い切っている。要約しても収まらないので要約は呼ばず、
+        # これまでの要約と今回のユーザー発言だけを送る（covered は進めず、履歴はそのまま残す）
+        logger.warning("チャットの先頭部分（%d トークン）だけで予算 %d を超えています", fixed, budget)
+        recent = recent[-1:]
+    sizes = [message_tokens(m) for m in recent]
+
+    if sum(sizes) > available and len(recent) > 1:
+        # 毎ターン要約しないよう、溢れたときは予算の半分まで空ける
+        target = available // 2
+        fold = 0
+        remaining = sum(sizes)
+        # 今回のユーザー発言（末尾）は必ず残す
+        while fold < len(recent) - 1 and remaining > target:
+            remaining -= sizes[fold]
+            fold += 1
+        summary_state["summary"] = summarize(summary_state["summary"], recent[:fold])
+        summary_state["covered"] += fold
+        recent = recent[fold:]
+
+    messages = list(prefix_messages)
+    if summary_state["summary"]:
+        messages.append(_summary_message(summary_state["summary"]))
+    messages.extend({"role": m["role"], "content": m["content"]} for m in recent)
+    return messages
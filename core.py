@@ -0,0 +1,349 @@
+# core.py
+#
+# 問題 → ３手法 → 詳細フォロー → 追加チャット の流れを UI から切り離したもの。
+# Streamlit アプリ（main.py）と HTTP API（api_server.py）の両方がこのモジュールを使う。
+#
+# ストリーミングする処理は (イベント名, データ) を順に返すジェネレーターで、
+#   "partial"  {"index", "text"}           生成途中の手法のテキスト（index は並列生成時のみ）
+#   "method"   {"index", "method"}         1 件分の手法が完成した
+#   "methods"  {"methods"}                 ３手法がそろった（最後のイベント）
+#   "delta"    {"text"}                    応答テキストの差分
+#   "message"  {"method_index", "seq", "role", "content"}  履歴に追記したメッセージ
+# を返す。状態と履歴は session_store のストアに保存するため、どのプロセスからでも続きを扱える。
+
+import os
+import threading
+
+from ai_utils import COALESCE_ENABLED, cache_enabled, call_chat, stream_chat_many
+from chat_context import CHAT_CONTEXT_BUDGET, build_chat_messages, message_tokens, new_summary_state
+from method_parser import Method, MethodStreamParser
+from prompts import (
+    system_message,
+    generate_three_methods_prompt,
+    generate_single_method_prompt,
+    build_followup_messages,
+    build_session_prefix,
+)
+from session_store import get_store, new_session_id
+from similarity_index import SIMILAR_PROBLEM_ENABLED, SIMILAR_PROBLEM_THRESHOLD, get_solved_problems
+
+
+# ----------------------------------------
+# 個々のフロー（状態を持たない）
+# ----------------------------------------
+def stream_methods(problem, parallel=True):
+    """３手法を生成しながらイベントを返す。"""
+    if parallel:
+        # 手法ごとに観点を変えた 3 リクエストを同時に送り、届いた分から返す
+        message_lists = [
+            [system_message, generate_single_method_prompt(problem, idx)]
+            for idx in range(3)
+        ]
+        parsers = [MethodStreamParser(labels=label) for label in "ABC"]
+        methods = [None, None, None]
+        # 1 件分の手法を書き終えて次の見出しに進もうとしたら、そこで生成を止める
+        for idx, delta in stream_chat_many(message_lists, flow="single_method", temperature=0.7, stop=["\n### 手法"]):
+            if delta is None:
+                methods[idx] = parsers[idx].close()[0]
+                yield "method", {"index": idx, "method": methods[idx]}
+            else:
+                parsers[idx].feed(delta)
+                yield "partial", {"index": idx, "text": parsers[idx].pending_text}
+    else:
+        messages = [system_message, generate_three_methods_prompt(problem)]
+        stream = call_chat(messages=messages, stream=True, flow="three_methods", temperature=0.7)
+        # 見出しごとに手法を切り出し、完成した手法から順に返す
+        parser = MethodStreamParser()
+        for delta in stream:
+            for method in parser.feed(delta):
+                yield "method", {"index": "ABC".index(method.label), "method": method}
+            yield "partial", {"index": None, "text": parser.pending_text}
+        # 形式が崩れていてもローカルで補正し、欠けた手法は空として扱う（再リクエストはしない）
+        methods = parser.close()
+    yield "methods", {"methods": methods}
+
+
+def stream_followup(problem, method, flow="followup"):
+    messages = build_followup_messages(problem, method.to_text())
+    return call_chat(messages=messages, stream=True, flow=flow, temperature=0.7)
+
+
+def chat_prefix_messages(problem, method, followup_answer=None):
+    # 詳細フォローと同じ先頭メッセージにして、サーバー側のプレフィックスキャッシュに当てる
+    return build_session_prefix(problem, method.to_text(), followup_answer)
+
+
+def find_similar(problem, k=3):
+    """解決済みの類似問題を {"problem", "methods"(Method), "score"} のリストで返す。"""
+    if not SIMILAR_PROBLEM_ENABLED or not problem.strip():
+        return []
+    hits = get_solved_problems().search(problem, k=k, threshold=SIMILAR_PROBLEM_THRESHOLD)
+    return [
+        {
+            "problem": hit["problem"],
+            "methods": [Method.from_dict(d) for d in hit["result"]["methods"]],
+            "score": hit["score"],
+        }
+        for hit in hits
+    ]
+
+
+def similar_generation():
+    """類似検索のインデックスの世代。find_similar の結果をキャッシュするときのキーに含める。
+
+    組み立て中（結果が空になりうる間）と完成後、新しい問題を取り込んだ後で値が変わる。
+    """
+    return get_solved_problems().generation if SIMILAR_PROBLEM_ENABLED else 0
+
+
+def record_solved(problem, methods):
+    # 3 手法とも揃った結果だけを、似た問題への提示用に保存する
+    if SIMILAR_PROBLEM_ENABLED and methods and not any(method.is_empty for method in methods):
+        get_solved_problems().add(problem, {"methods": [method.to_dict() for method in methods]})
+
+
+# ----------------------------------------
+# 詳細フォローの先読み
+# ----------------------------------------
+# off: 先読みしない / selected: 選択中（未選択なら先頭）の手法だけ / all: ３手法とも
+FOLLOWUP_PREFETCH = os.getenv("FOLLOWUP_PREFETCH", "off")
+# プロセス全体で同時に先読みする件数の上限（超えた分は先読みせず、ボタンを押したときに生成する）
+FOLLOWUP_PREFETCH_MAX = int(os.getenv("FOLLOWUP_PREFETCH_MAX", "6"))
+
+
+class FollowupPrefetcher:
+    """手法が揃った時点で、詳細フォローをバックグラウンドで生成しておく。
+
+    stream_followup と同じリクエストを別スレッドで最後まで読むだけで、結果は call_chat の
+    応答キャッシュに残る。生成中にボタンが押されたら同一リクエストの相乗りで途中から受け取り、
+    不要になった先読みは読むのをやめて上流の生成を打ち切る。
+    """
+
+    def __init__(self, max_inflight):
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._running = {}          # (session_id, thread, 手法の番号) -> キャンセル用の Event
+        self._lock = threading.Lock()
+        self.stats = {"started": 0, "completed": 0, "cancelled": 0, "failed": 0, "skipped": 0}
+
+    def start(self, key, problem, method):
+        with self._lock:
+            if key in self._running:
+                return
+            if not self._slots.acquire(blocking=False):
+                self.stats["skipped"] += 1
+                return
+            cancelled = self._running[key] = threading.Event()
+            self.stats["started"] += 1
+        threading.Thread(target=self._run, args=(key, problem, method, cancelled), daemon=True).start()
+
+    def _run(self, key, problem, method, cancelled):
+        outcome = "completed"
+        try:
+            deltas = iter(stream_followup(problem, method, flow="followup_prefetch"))
+            try:
+                for _ in deltas:
+                    if cancelled.is_set():
+                        outcome = "cancelled"
+                        break
+            finally:
+                deltas.close()
+        except Exception:
+            outcome = "failed"
+        finally:
+            with self._lock:
+                self._running.pop(key, None)
+                self.stats[outcome] += 1
+            self._slots.release()
+
+    def cancel(self, session_id, thread, keep=None):
+        """session_id の先読みのうち、thread の keep 番目の手法以外を打ち切る。"""
+        with self._lock:
+            for (sid, th, idx), cancelled in self._running.items():
+                if sid == session_id and (th != thread or idx != keep):
+                    cancelled.set()
+
+
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+
+def get_prefetcher() -> FollowupPrefetcher:
+    global _prefetcher
+    if _prefetcher is None:
+        with _prefetcher_lock:
+            if _prefetcher is None:
+                _prefetcher = FollowupPrefetcher(FOLLOWUP_PREFETCH_MAX)
+    return _prefetcher
+
+
+def prefetch_enabled() -> bool:
+    # 先読みの結果は応答キャッシュと相乗りで受け渡すため、どちらかが無効なら先読みしない
+    return FOLLOWUP_PREFETCH in ("selected", "all") and cache_enabled and COALESCE_ENABLED
+
+
+# ----------------------------------------
+# セッション（状態と履歴をストアに保存する）
+# ----------------------------------------
+class Session:
+    """1 ユーザー分の状態と、それを更新するフロー。
+
+    属性を書き換えたら save() で保存する。チャット履歴は「３つの解法を生成する」ごとに進む
+    thread 番号と手法ごとの追記専用ログで、要約（chat_summaries）に畳み込み済みの分は読み込まない。
+    """
+
+    def __init__(self, session_id=None, store=None):
+        self.store = store or get_store()
+        self.session_id = session_id or new_session_id()
+        saved = self.store.get_state(self.session_id)
+        self.problem = saved.get("user_problem", "")
+        self.methods = [Method.from_dict(d) for d in saved.get("methods", [])]
+        self.selected_method_index = saved.get("selected_method_index")
+        self.followup_response = saved.get("followup_response", "")
+        self.thread = saved.get("thread", 0)
+        summaries = saved.get("chat_summaries", {})
+        self.chat_summaries = {idx: summaries.get(str(idx), new_summary_state()) for idx in range(3)}
+
+    def save(self, *keys):
+        values = {
+            "user_problem": self.problem,
+            "methods": [method.to_dict() for method in self.methods],
+            "selected_method_index": self.selected_method_index,
+            "followup_response": self.followup_response,
+            "thread": self.thread,
+            "chat_summaries": self.chat_summaries,
+        }
+        for key in keys or values:
+            self.store.set_state(self.session_id, key, values[key])
+
+    def to_dict(self) -> dict:
+        return {
+            "session_id": self.session_id,
+            "problem": self.problem,
+            "methods": [method.to_dict() for method in self.methods],
+            "selected_method_index": self.selected_method_index,
+            "followup_response": self.followup_response,
+            "thread": self.thread,
+        }
+
+    # ---- 状態の更新 ----
+    def set_problem(self, problem):
+        if problem != self.problem:
+            self.problem = problem
+            self.save("user_problem")
+
+    def start_thread(self):
+        """新しい会話を始める（以前の会話の履歴はストアに残したまま、番号だけ進める）。"""
+        self.methods = []
+        self.selected_method_index = None
+        self.followup_response = ""
+        self.thread += 1
+        self.chat_summaries = {idx: new_summary_state() for idx in range(3)}
+        self.save("methods", "selected_method_index", "followup_response", "thread", "chat_summaries")
+        if prefetch_enabled():
+            get_prefetcher().cancel(self.session_id, self.thread)
+
+    def use_methods(self, methods):
+        """生成済み（類似の問題など）の手法で新しい会話を始める。"""
+        self.start_thread()
+        self.methods = list(methods)
+        self.save("methods")
+        self.prefetch_followups()
+
+    def select_method(self, method_idx):
+        if not 0 <= method_idx < len(self.methods):
+            raise ValueError("手法の番号が正しくありません。")
+        if method_idx != self.selected_method_index:
+            self.selected_method_index = method_idx
+            self.save("selected_method_index")
+            self.prefetch_followups()
+
+    def prefetch_followups(self):
+        """FOLLOWUP_PREFETCH に従って詳細フォローを先読みする。selected では選び直した手法に切り替える。"""
+        if not prefetch_enabled() or not self.methods:
+            return
+        prefetcher = get_prefetcher()
+        sel_idx = self.selected_method_index or 0
+        if FOLLOWUP_PREFETCH == "selected":
+            prefetcher.cancel(self.session_id, self.thread, keep=sel_idx)
+            targets = [sel_idx]
+        else:
+            targets = [sel_idx] + [idx for idx in range(len(self.methods)) if idx != sel_idx]
+        for idx in targets:
+            if not self.methods[idx].is_empty:
+                prefetcher.start((self.session_id, self.thread, idx), self.problem, self.methods[idx])
+
+    # ---- 履歴 ----
+    def append_message(self, method_idx, message) -> dict:
+        seq = self.store.append_message(self.session_id, self.thread, method_idx, message)
+        return {"method_index": method_idx, "seq": seq, "role": message["role"], "content": message["content"]}
+
+    def count_messages(self, method_idx) -> int:
+        return self.store.count_messages(self.session_id, self.thread, method_idx)
+
+    def load_messages(self, method_idx, offset=0, limit=None) -> list:
+        return self.store.load_messages(self.session_id, self.thread, method_idx, offset=offset, limit=limit)
+
+    # ---- フロー ----
+    def generate_methods(self, parallel=True):
+        """３手法を生成する。最後まで読み切ると手法を保存する。"""
+        if not self.problem.strip():
+            raise ValueError("まずは解決したい問題を入力してください。")
+        self.start_thread()
+        for event, data in stream_methods(self.problem, parallel):
+            if event == "methods":
+                self.methods = data["methods"]
+                self.save("methods")
+                record_solved(self.problem, self.methods)
+                self.prefetch_followups()
+            yield event, data
+
+    def followup(self, method_idx=None):
+        """選択した手法の詳細フォローを生成し、チャット履歴の初回応答として追記する。"""
+        if method_idx is not None:
+            self.select_method(method_idx)
+        if self.selected_method_index is None:
+            raise ValueError("まずは手法を選択してください。")
+        sel_idx = self.selected_method_index
+        if prefetch_enabled():
+            # 他の手法の先読みはもう使わない。この手法の先読みがあれば、その続き（またはキャッシュ）を受け取る
+            get_prefetcher().cancel(self.session_id, self.thread, keep=sel_idx)
+        stream = stream_followup(self.problem, self.methods[sel_idx])
+        for delta in stream:
+            yield "delta", {"text": delta}
+        self.followup_response = stream.content.strip()
+        self.save("followup_response")
+        yield "message", self.append_message(sel_idx, {"role": "assistant", "content": self.followup_response})
+
+    def chat(self, text):
+        """追加の質問に答える。予算を超えた古いやり取りは要約に畳み込む。"""
+        if not text.strip():
+            raise ValueError("質問内容を入力してください。")
+        if self.selected_method_index is None:
+            raise ValueError("まずは手法を選択してください。")
+        sel_idx = self.selected_method_index
+        yield "message", self.append_message(sel_idx, {"role": "user", "content": text})
+
+        # 詳細フォローを受け取っていれば、履歴はその回答から始まる。回答は毎ターン同じ先頭部分に固定し
+        # （プレフィックスキャッシュに当てるため）、要約に畳み込むのはその後のやり取りだけにする
+        first = self.load_messages(sel_idx, limit=1)
+        followup_answer = first[0]["content"] if first and first[0]["role"] == "assistant" else None
+        summary_state = self.chat_summaries[sel_idx]
+        prefix = chat_prefix_messages(self.problem, self.methods[sel_idx], followup_answer)
+        budget = CHAT_CONTEXT_BUDGET
+        if followup_answer is not None:
+            summary_state["covered"] = max(summary_state["covered"], 1)
+            # 固定した詳細フォローのやり取りは予算の外に置く（予算は要約と直近の履歴に使う）
+            budget += sum(message_tokens(m) for m in prefix[2:])
+        # 要約に畳み込み済みのメッセージは読み込まない
+        messages = build_chat_messages(
+            prefix,
+            self.load_messages(sel_idx, offset=summary_state["covered"]),
+            summary_state,
+            budget=budget,
+            offset=summary_state["covered"],
+        )
+        self.save("chat_summaries")
+        stream = call_chat(messages=messages, stream=True, flow="chat", temperature=0.7)
+        for delta in stream:
+            yield "delta", {"text": delta}
+        yield "message", self.append_message(sel_idx, {"role": "assistant", "content": stream.content.strip()})
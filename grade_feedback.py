@@ -0,0 +1,162 @@
+# grade_feedback.py
+#
+# 記録した解答（問題・思考ステップ・理由）に対して、トレーニングアプリの
+# 「フィードバックを受け取る」と同じフィードバックを一括で生成する。
+#
+#   python grade_feedback.py submissions.jsonl --out feedback.jsonl --workers 8
+#
+# 入力は 1 行 1 件の JSONL：{"id": ..., "problem": ..., "steps": ..., "reason": ..., "user_created": false}
+# （id が無い行は行番号を id とする）。結果は 1 件終わるごとに --out へ追記し、
+# 同じ --out で再実行すると成功済みの id を飛ばして続きから処理する。
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from ai_utils import call_chat, get_client, throttle_stats
+from training_prompts import generate_feedback_prompt, system_message
+
+
+def read_submissions(path):
+    """(id, 解答) を 1 件ずつ返す。全件をメモリに載せない。"""
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                submission = json.loads(line)
+            except ValueError:
+                print(f"{path}:{lineno}: JSON として読めないため飛ばします", file=sys.stderr)
+                continue
+            yield str(submission.get("id", lineno)), submission
+
+
+def completed_ids(path) -> set:
+    """出力済みの JSONL から、フィードバックの生成に成功した id を集める（再開用）。"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 書き込み途中で止まった最終行は読み飛ばす（その id は再実行される）
+                continue
+            if not record.get("error"):
+                done.add(str(record["id"]))
+    return done
+
+
+def _ends_with_newline(path) -> bool:
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def grade(submission_id, submission, max_tokens, temperature) -> dict:
+    record = {
+        "id": submission_id,
+        "problem": submission.get("problem", ""),
+        "steps": submission.get("steps", ""),
+        "reason": submission.get("reason", ""),
+    }
+    missing = [key for key in ("problem", "steps", "reason") if not record[key]]
+    if missing:
+        record["error"] = f"未入力の項目があります: {', '.join(missing)}"
+        return record
+    user_msg = generate_feedback_prompt(
+        record["problem"], record["steps"], record["reason"], bool(submission.get("user_created"))
+    )
+    try:
+        res = call_chat(messages=[system_message, user_msg], flow="feedback_batch",
+                        max_tokens=max_tokens, temperature=temperature)
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        return record
+    choice = res.choices[0]
+    record["feedback"] = choice.message.content
+    record["finish_reason"] = choice.finish_reason
+    if res.usage is not None:
+        record["usage"] = {
+            "prompt_tokens": res.usage.prompt_tokens,
+            "completion_tokens": res.usage.completion_tokens,
+        }
+    return record
+
+
+def run(input_path, out_path, workers, max_tokens, temperature, limit=None) -> dict:
+    done = completed_ids(out_path)
+    counts = {"skipped": 0, "ok": 0, "errors": 0}
+    if os.path.dirname(out_path):
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+    start = time.perf_counter()
+    with open(out_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        # 前回が行の途中で止まっていたら、次の結果がその行に繋がらないよう改行を補う
+        if out.tell() and not _ends_with_newline(out_path):
+            out.write("\n")
+        # 書き込みはメインスレッドだけで行い、1 件ごとに flush して途中で止まっても結果を失わない
+        def write(record):
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            counts["errors" if record.get("error") else "ok"] += 1
+            processed = counts["ok"] + counts["errors"]
+            if processed % 50 == 0:
+                rate = processed / (time.perf_counter() - start)
+                print(f"{processed} 件完了（{rate:.1f} 件/秒, 失敗 {counts['errors']} 件）", file=sys.stderr)
+
+        # 投入済みで未完了の件数を workers の 2 倍までに抑え、入力が何万件でも先読みしすぎないようにする
+        pending = set()
+        submitted = 0
+        for submission_id, submission in read_submissions(input_path):
+            if submission_id in done:
+                counts["skipped"] += 1
+                continue
+            if limit is not None and submitted >= limit:
+                break
+            # 同じ id が入力に重複していても 1 回だけ処理する
+            done.add(submission_id)
+            pending.add(pool.submit(grade, submission_id, submission, max_tokens, temperature))
+            submitted += 1
+            if len(pending) >= workers * 2:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    write(future.result())
+        for future in wait(pending).done:
+            write(future.result())
+
+    counts["elapsed_s"] = time.perf_counter() - start
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="記録した解答に対するフィードバックを一括生成する")
+    parser.add_argument("input", help="解答の JSONL（id, problem, steps, reason, user_created）")
+    parser.add_argument("--out", required=True, help="結果の JSONL（既にあれば成功済みの id を飛ばして追記する）")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("GRADE_WORKERS", "8")),
+                        help="同時に処理する件数（実際の速度は AZURE_OPENAI_RPM / AZURE_OPENAI_TPM の予算で決まる）")
+    parser.add_argument("--max-tokens", type=int, default=800)
+    parser.add_argument("--temperature", type=float, default=0.6)
+    parser.add_argument("--limit", type=int, default=None, help="今回処理する最大件数")
+    args = parser.parse_args()
+
+    try:
+        get_client()
+    except EnvironmentError:
+        print("環境変数が正しく設定されていません。", file=sys.stderr)
+        sys.exit(1)
+
+    counts = run(args.input, args.out, args.workers, args.max_tokens, args.temperature, args.limit)
+    counts["throttle"] = throttle_stats()
+    print(json.dumps(counts, ensure_ascii=False, indent=2), file=sys.stderr)
+    if counts["errors"]:
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
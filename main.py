@@ -1,34 +1,125 @@
 # main.py
 
 import os
+from collections import deque
 import streamlit as st
 from dotenv import load_dotenv
 
-from ai_utils import call_chat
-from prompts import system_message, generate_three_methods_prompt, generate_followup_prompt
+from ai_utils import get_client, markdown_deltas
+from core import Session, find_similar, similar_generation
+from session_store import new_session_id
 
 # .env の読み込み
 load_dotenv()
 
+# 「最新のやり取り」に表示する件数と、過去チャット履歴タブの 1 ページあたりの件数
+RECENT_MESSAGES = int(os.getenv("CHAT_RECENT_MESSAGES", "6"))
+HISTORY_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", "10"))
+
 # ページ設定
 st.set_page_config(page_title="開発フォローAIbot", layout="wide")
 st.title("問題解決サポートAI bot")
 
+# 環境変数の検証と共有クライアントの準備（プロセス内で 1 度だけ行われる）
+try:
+    get_client()
+except EnvironmentError:
+    st.error("環境変数が正しく設定されていません。")
+    st.stop()
+
+# ------------------------------------------------------------
+# セッションの復元
+# ------------------------------------------------------------
+# 状態とチャット履歴は core.Session がストア（既定は SQLite）に保存し、URL の ?sid= で引き継ぐ。
+# 再起動後や別のレプリカに振り分けられても同じ状態に戻せる。
+sid = st.query_params.get("sid")
+if not sid:
+    sid = new_session_id()
+    st.query_params["sid"] = sid
+
+
 # ------------------------------------------------------------
-# セッションステートの初期化
+# 描画用 Markdown の事前組み立て
 # ------------------------------------------------------------
-if "user_problem" not in st.session_state:
-    st.session_state.user_problem = ""
-if "methods" not in st.session_state:
-    st.session_state.methods = []              # 手法A, B, C を格納するリスト
-if "selected_method_index" not in st.session_state:
-    st.session_state.selected_method_index = None
-if "followup_response" not in st.session_state:
-    st.session_state.followup_response = ""
-
-# 各手法の「追加チャット履歴」を保持する辞書
-if "chat_histories" not in st.session_state:
-    st.session_state.chat_histories = {0: [], 1: [], 2: []}
+# 再実行のたびに整形し直さないよう、値が変わったとき（生成・追記・復元時）に一度だけ組み立てる。
+def refresh_methods():
+    methods = session.methods                   # 手法A, B, C（method_parser.Method）を格納するリスト
+    st.session_state.method_preview = "  \n".join(method.title for method in methods)
+    st.session_state.method_details = "".join(
+        f"#### {method.title}\n\n{method.to_markdown()}\n\n---\n\n" for method in methods
+    )
+
+
+def refresh_followup():
+    st.session_state.followup_markdown = session.followup_response.replace("\n", "  \n")
+
+
+def reset_views():
+    """新しい会話に切り替わったときに、描画済みの内容を作り直す。"""
+    refresh_methods()
+    refresh_followup()
+    st.session_state.history_page = 0
+    st.session_state.recent_blocks = {}
+
+
+def message_block(number, msg):
+    content = msg["content"].replace("\n", "  \n")
+    if msg["role"] == "assistant":
+        return "**AI の応答 #{}:**  {}".format(number, content)
+    return "**You の発言 #{}:**  {}".format(number, content)
+
+
+def recent_blocks(thread, method_idx):
+    """「最新のやり取り」の描画済みブロック。初回だけストアから読み、以降は追記分だけ足していく。"""
+    blocks = st.session_state.recent_blocks
+    if (thread, method_idx) not in blocks:
+        total = session.count_messages(method_idx)
+        start = max(0, total - RECENT_MESSAGES)
+        messages = session.load_messages(method_idx, offset=start)
+        blocks[(thread, method_idx)] = deque(
+            (message_block(i + 1, msg) for i, msg in enumerate(messages, start=start)), maxlen=RECENT_MESSAGES
+        )
+    return blocks[(thread, method_idx)]
+
+
+def stream_text(events):
+    """core のイベントから応答の差分だけを流し、履歴に追記されたメッセージは描画済みブロックに足す。"""
+    # 追記より前に読み込んでおき、追記分が二重にならないようにする
+    recent_blocks(session.thread, session.selected_method_index)
+    for event, data in events:
+        if event == "delta":
+            yield data["text"]
+        elif event == "message":
+            recent_blocks(session.thread, data["method_index"]).append(message_block(data["seq"] + 1, data))
+
+
+def history_page(session_id, thread, method_idx, page):
+    """過去チャット履歴の 1 ページ分を (見出し, 本文) の組で返す。"""
+    offset = page * HISTORY_PAGE_SIZE
+    entries = []
+    for i, msg in enumerate(session.store.load_messages(session_id, thread, method_idx, offset=offset, limit=HISTORY_PAGE_SIZE), start=offset):
+        preview = msg["content"].split("\n", 1)[0]
+        title = f"{'AI' if msg['role']=='assistant' else 'You'} の発言 #{i+1}: {preview}"
+        entries.append((title, msg["content"].replace("\n", "  \n")))
+    return entries
+
+
+def move_history_page(delta):
+    """ページ送りボタンの on_click。描画より前にページを変え、ボタンの有効・無効を表示中のページに合わせる。"""
+    st.session_state.history_page = max(0, st.session_state.history_page + delta)
+
+
+# 埋まったページは追記専用の履歴では二度と変わらないため、再実行やセッションをまたいで使い回す
+cached_history_page = st.cache_data(max_entries=256, show_spinner=False)(history_page)
+
+
+if st.session_state.get("restored_sid") != sid:
+    session = st.session_state.session = Session(sid)
+    # 手法をどの問題文に対して生成したか（類似の問題の提示を出し分けるため）
+    st.session_state.methods_for = session.problem if session.methods else None
+    reset_views()
+    st.session_state.restored_sid = sid
+session = st.session_state.session
 
 # ============================================================
 # 1. 解決したい問題を入力＆３手法生成（セクション）
@@ -37,220 +128,185 @@ with st.expander("1. 解決したい問題を入力＆３手法生成", expanded
     st.write("以下のテキストエリアに「解決したい問題」を入力し、「３つの解法を生成する」ボタンを押してください。")
     user_input = st.text_area(
         "例：毎日更新される CSV から重複を除去してデータベースに登録したい",
-        value=st.session_state.user_problem,
+        value=session.problem,
         height=100
     )
-    st.session_state.user_problem = user_input
+    session.set_problem(user_input)
+
+    # 似た問題が解決済みなら、生成を待たずにその結果を使えるよう提示する
+    problem = session.problem.strip()
+    if problem and st.session_state.methods_for != session.problem:
+        # インデックスの組み立て中に検索した空の結果を使い続けないよう、世代もキーに含める
+        # （世代は検索より先に読む。検索中に組み立てが終わっても、次の再実行で検索し直す）
+        query = (problem, similar_generation())
+        if st.session_state.get("similar_query") != query:
+            st.session_state.similar_hits = find_similar(problem)
+            st.session_state.similar_query = query
+        for i, hit in enumerate(st.session_state.similar_hits):
+            with st.container(border=True):
+                st.markdown(f"**類似の問題が解決済みです**（類似度 {hit['score']:.2f}）： {hit['problem']}")
+                st.caption(" ／ ".join(method.title for method in hit["methods"]))
+                if st.button("この結果を使う", key=f"use_similar_{i}"):
+                    session.use_methods(hit["methods"])
+                    reset_views()
+                    st.session_state.methods_for = session.problem
+                    st.success("解決済みの類似問題の手法を読み込みました。次のセクションを開いてご確認ください。")
+                    break
+
+    parallel_mode = st.checkbox(
+        "手法ごとに並列で生成する（A/B/C を別々のリクエストで同時に生成）",
+        value=True,
+        key="parallel_methods"
+    )
 
     if st.button("３つの解法を生成する", key="gen_methods_btn"):
-        if not st.session_state.user_problem.strip():
+        if not session.problem.strip():
             st.warning("まずは解決したい問題を入力してください。")
         else:
-            # 既存データをクリア
-            st.session_state.methods = []
-            st.session_state.selected_method_index = None
-            st.session_state.followup_response = ""
-            for idx in range(3):
-                st.session_state.chat_histories[idx] = []
-
+            # 届いた分から各カードに表示し、完成した手法は整形済みの表示に差し替える
+            cards = [col.container(border=True).empty() for col in st.columns(3)]
+            live_area = st.empty()
             with st.spinner("AI が３つの解決手段を生成中..."):
-                messages = [
-                    system_message,
-                    generate_three_methods_prompt(st.session_state.user_problem)
-                ]
-                res = call_chat(messages=messages, max_tokens=1000, temperature=0.7)
-                ai_content = res.choices[0].message.content.strip()
-
-            # 「1. 手法A:」「2. 手法B:」「3. 手法C:」で分割
-            parts = []
-            if "2. 手法B:" in ai_content:
-                idx_b = ai_content.index("2. 手法B:")
-                parts.append(ai_content[:idx_b].strip())
-                remainder = ai_content[idx_b:].strip()
-            else:
-                parts.append(ai_content)
-                remainder = ""
-
-            if remainder and "3. 手法C:" in remainder:
-                idx_c = remainder.index("3. 手法C:")
-                parts.append(remainder[:idx_c].strip())
-                parts.append(remainder[idx_c:].strip())
-            else:
-                if remainder:
-                    parts.append(remainder)
-                parts.append("")
-
-            while len(parts) < 3:
-                parts.append("")
-
-            st.session_state.methods = parts
+                for event, data in session.generate_methods(parallel=parallel_mode):
+                    if event == "method":
+                        method = data["method"]
+                        cards[data["index"]].markdown(f"#### {method.title}\n\n{method.to_markdown()}")
+                    elif event == "partial":
+                        area = live_area if data["index"] is None else cards[data["index"]]
+                        area.markdown(data["text"].replace("\n", "  \n"))
+            live_area.empty()
+            for card in cards:
+                card.empty()
+            reset_views()
+            st.session_state.methods_for = session.problem
             st.success("３つの手法が生成されました。次のセクションを開いてご確認ください。")
 
     # 生成済みの手法があればプレビューだけ表示
-    if st.session_state.methods:
+    if session.methods:
         st.markdown("---")
         st.subheader("※ 生成済みの手法の見出しプレビュー")
-        for idx, method_text in enumerate(st.session_state.methods):
-            label = "ABC"[idx]
-            if method_text:
-                first_line = method_text.split("\n", 1)[0].strip()
-            else:
-                first_line = "(生成なし)"
-            st.write(f"{first_line}")
+        st.markdown(st.session_state.method_preview)
 
 # ============================================================
 # 2. ３つのアプローチ表示（セクション）
 # ============================================================
 with st.expander("2. AIが提案した３つのアプローチ", expanded=False):
-    if not st.session_state.methods:
+    if not session.methods:
         st.info("まずは上の「1. 解決したい問題を入力＆３手法生成」で手法を生成してください。")
     else:
         st.markdown("以下が AI が提案した３つのアプローチです。タイトルをクリックすると詳細が表示されます。")
-        for idx, method_text in enumerate(st.session_state.methods):
-            label = "ABC"[idx]
-            # フラットに見出し＋内容を表示（expander をネストしない）
-            st.markdown(f"#### 手法{label}")
-            if method_text:
-                st.markdown(method_text.replace("\n", "  \n"))
-            else:
-                st.markdown("_（未生成または分割に失敗しました）_")
-            st.markdown("---")
+        # フラットに見出し＋内容を表示（expander をネストしない）
+        st.markdown(st.session_state.method_details)
 
 # ============================================================
 # 3. 手法選択＆詳細フォロー（セクション）
 # ============================================================
 with st.expander("3. 手法選択＆詳細フォロー", expanded=False):
-    if not st.session_state.methods:
+    if not session.methods:
         st.info("まずは「1. 解決したい問題を入力＆３手法生成」で手法を生成してください。")
     else:
         st.write("実装したいアプローチを選択して、「詳細フォローを受け取る」を押してください。")
-        # 手法選択用ラジオボタン
-        options = []
-        for idx, method_text in enumerate(st.session_state.methods):
-            if method_text:
-                first_line = method_text.split("\n", 1)[0].strip()
-            else:
-                first_line = "（生成なし）"
-            options.append(first_line)
-
+        # 手法選択用ラジオボタン（見出しが重複しても区別できるよう、インデックスで選択する）
+        titles = [method.title for method in session.methods]
         choice = st.radio(
             label="▼ 手法を選択",
-            options=options,
-            index=0 if st.session_state.selected_method_index is None else st.session_state.selected_method_index,
+            options=range(len(titles)),
+            format_func=lambda i: titles[i],
+            index=0 if session.selected_method_index is None else session.selected_method_index,
             key="method_choice"
         )
-        st.session_state.selected_method_index = options.index(choice)
+        if choice != session.selected_method_index:
+            session.select_method(choice)
+            st.session_state.history_page = 0
 
         if st.button("選択した手法で詳細フォローを受け取る", key="followup_btn"):
-            sel_idx = st.session_state.selected_method_index
-            sel_method_text = st.session_state.methods[sel_idx]
-            with st.spinner("AI が詳細フォローを生成中..."):
-                messages = [
-                    system_message,
-                    generate_followup_prompt(st.session_state.user_problem, sel_method_text)
-                ]
-                res2 = call_chat(messages=messages, max_tokens=2000, temperature=0.7)
-                st.session_state.followup_response = res2.choices[0].message.content.strip()
-
-                # 詳細フォローをチャット履歴の初回応答として追加
-                st.session_state.chat_histories[sel_idx].append({
-                    "role": "assistant",
-                    "content": st.session_state.followup_response
-                })
+            # 詳細フォローは core 側でチャット履歴の初回応答として追記される
+            live_area = st.empty()
+            with live_area.container():
+                with st.spinner("AI が詳細フォローを生成中..."):
+                    st.write_stream(markdown_deltas(stream_text(session.followup())))
+            live_area.empty()
+            refresh_followup()
 
         # 詳細フォローの表示
-        if st.session_state.followup_response:
+        if session.followup_response:
             st.markdown("---")
             st.subheader("選択した手法に対する詳細フォロー")
-            st.markdown(st.session_state.followup_response.replace("\n", "  \n"))
+            st.markdown(st.session_state.followup_markdown)
 
 # ============================================================
 # タブ：4. 追加チャット＆過去チャット履歴
 # ============================================================
-tab_main, tab_history = st.tabs(["4. 追加チャット", "過去チャット履歴"])
+# 追加チャットの送信や履歴のページ送りではこの部分だけを再実行し、セクション 1〜3 は描画し直さない
+@st.fragment
+def chat_tabs():
+    tab_main, tab_history = st.tabs(["4. 追加チャット", "過去チャット履歴"])
+    sel_idx = session.selected_method_index
+    thread = session.thread
 
-# ------ タブ「4. 追加チャット」 ------
-with tab_main:
-    sel_idx = st.session_state.selected_method_index
-    if sel_idx is None:
-        st.info("まずは「3. 手法選択＆詳細フォロー」で手法を選び、詳細フォローを取得してください。")
-    else:
-        st.subheader(f"現在の選択： 手法{'ABC'[sel_idx]}")
-
-        with st.form(key="chat_form"):
-            user_chat = st.text_input(
-                "追加で質問や補足を入力してください",
-                placeholder="ここに入力して「送信」すると自動でクリアされます"
-            )
-            submit = st.form_submit_button(label="送信")
-
-            if submit:
-                if user_chat.strip():
-                    # ユーザー発言を履歴に追加
-                    st.session_state.chat_histories[sel_idx].append({
-                        "role": "user",
-                        "content": user_chat
-                    })
-
-                    # AI に投げるメッセージを構築
-                    messages = [system_message]
-                    selected_method_text = st.session_state.methods[sel_idx]
-                    messages.append({
-                        "role": "system",
-                        "content": (
-                            "以下はユーザーが選択した手法の説明です。\n\n" +
-                            selected_method_text
-                        )
-                    })
-                    # 過去のやり取りをすべて追加
-                    for msg in st.session_state.chat_histories[sel_idx]:
-                        messages.append(msg)
-                    # 今回のユーザー発言を追加
-                    messages.append({
-                        "role": "user",
-                        "content": user_chat
-                    })
-
-                    # AI 呼び出し
-                    with st.spinner("AI が応答を生成中..."):
-                        res3 = call_chat(messages=messages, max_tokens=1500, temperature=0.7)
-                        ai_reply = res3.choices[0].message.content.strip()
-
-                    # AI 応答を履歴に追加
-                    st.session_state.chat_histories[sel_idx].append({
-                        "role": "assistant",
-                        "content": ai_reply
-                    })
-                else:
-                    st.warning("質問内容を入力してください。")
-
-        # フォーム送信後に、改めて履歴を表示
-        history = st.session_state.chat_histories[sel_idx]
-        if history:
-            st.markdown("---")
-            st.subheader("最新のやり取り（クリックして詳細を確認）")
-            for i, msg in enumerate(history):
-                if msg["role"] == "assistant":
-                    content = msg["content"].replace(chr(10), "  \n")
-                    st.markdown("**AI の応答 #{}:**  {}".format(i + 1, content))
-                else:
-                    st.markdown("**You の発言 #{}:**  {}".format(i + 1, msg["content"]))
-
-# ------ タブ「過去チャット履歴」 ------
-with tab_history:
-    sel_idx = st.session_state.selected_method_index
-    if sel_idx is None:
-        st.info("まだ表示できる過去チャットはありません。まずは「4. 追加チャット」でやり取りをしてください。")
-    else:
+    # ------ タブ「4. 追加チャット」 ------
+    with tab_main:
+        if sel_idx is None:
+            st.info("まずは「3. 手法選択＆詳細フォロー」で手法を選び、詳細フォローを取得してください。")
+        else:
+            st.subheader(f"現在の選択： 手法{'ABC'[sel_idx]}")
+
+            with st.form(key="chat_form"):
+                user_chat = st.text_input(
+                    "追加で質問や補足を入力してください",
+                    placeholder="ここに入力して「送信」すると自動でクリアされます"
+                )
+                submit = st.form_submit_button(label="送信")
+
+                if submit:
+                    if user_chat.strip():
+                        # ユーザー発言と AI 応答は core 側で履歴に追記される（予算を超えた古いやり取りは要約に畳み込む）
+                        live_area = st.empty()
+                        with live_area.container():
+                            with st.spinner("AI が応答を生成中..."):
+                                st.write_stream(markdown_deltas(stream_text(session.chat(user_chat))))
+                        live_area.empty()
+                    else:
+                        st.warning("質問内容を入力してください。")
+
+            # フォーム送信後に、直近のやり取りだけを表示（全件は「過去チャット履歴」タブで）
+            blocks = recent_blocks(thread, sel_idx)
+            if blocks:
+                st.markdown("---")
+                st.subheader("最新のやり取り（クリックして詳細を確認）")
+                st.markdown("\n\n".join(blocks))
+
+    # ------ タブ「過去チャット履歴」 ------
+    with tab_history:
+        if sel_idx is None:
+            st.info("まだ表示できる過去チャットはありません。まずは「4. 追加チャット」でやり取りをしてください。")
+            return
         st.subheader(f"手法{'ABC'[sel_idx]} の過去チャット履歴一覧")
-        history = st.session_state.chat_histories[sel_idx]
+        total = session.count_messages(sel_idx)
 
-        if not history:
+        if not total:
             st.write("_まだチャットがありません。4. 追加チャットで質問してください。_")
+            return
+
+        # 表示中のページ分だけをストアから読み込む
+        pages = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+        page = st.session_state.history_page = min(st.session_state.history_page, pages - 1)
+        col_prev, col_info, col_next = st.columns([1, 2, 1])
+        col_prev.button("← 前へ", key="history_prev", disabled=page == 0,
+                        on_click=move_history_page, args=(-1,))
+        col_next.button("次へ →", key="history_next", disabled=page >= pages - 1,
+                        on_click=move_history_page, args=(1,))
+        col_info.write(f"{page + 1} / {pages} ページ（全 {total} 件）")
+
+        # 埋まったページは内容が変わらないので使い回し、書き込み途中の最終ページだけ毎回読む
+        if (page + 1) * HISTORY_PAGE_SIZE <= total:
+            entries = cached_history_page(sid, thread, sel_idx, page)
         else:
-            # 各過去メッセージを独立したセクション（expander 相当）で表示
-            for i, msg in enumerate(history):
-                preview = msg["content"].split("\n", 1)[0]
-                title = f"{'AI' if msg['role']=='assistant' else 'You'} の発言 #{i+1}: {preview}"
-                with st.expander(title):
-                    st.markdown(msg["content"].replace(chr(10), "  \n"))
+            entries = history_page(sid, thread, sel_idx, page)
+        # 各過去メッセージを独立したセクション（expander 相当）で表示
+        for title, body in entries:
+            with st.expander(title):
+                st.markdown(body)
+
+
+chat_tabs()
@@ -0,0 +1,199 @@
+# method_parser.py
+
+import re
+from dataclasses import dataclass, asdict
+
+LABELS = "ABC"
+
+# 見出し行：「### 手法A: ツール名」を基本としつつ、「1. 手法A:」「手法Ａ：」「=== 手法A ===」なども受け付ける。
+# 本文中の「手法Cと組み合わせる」などを見出しと取り違えないよう、行頭の記号（#・=・**・番号）か
+# ラベル直後のコロンのどちらかを必須にする
+_HEADER_RE = re.compile(
+    r"^\s*(?P<marker>(?:#+\s*|=+\s*|\*\*\s*)(?:\d+\s*[.．)）]\s*)?|\d+\s*[.．)）]\s*)?"
+    r"手法\s*(?P<label>[A-CＡ-Ｃ])"
+    r"(?(marker)(?=\s|[:：]|\*\*|=|$)\s*[:：]?|\s*[:：])"
+    r"\s*(?P<tool>.*?)\s*(?:=+|\*\*)?\s*$"
+)
+# 項目行：「【実装手順】」を基本としつつ、「a) 実装手順」「メリット:」なども受け付ける
+_SECTION_NAME = r"(?:実装手順|手順|必要な[^:：\s]*|ライブラリ[^:：\s]*|メリット|デメリット)"
+_SECTION_RE = re.compile(
+    r"^\s*(?:[-*]\s*)?(?:【(?P<bracket>[^】]+)】"
+    r"|[a-dａ-ｄ]\s*[)）]\s*(?P<lettered>" + _SECTION_NAME + r")\s*[:：]?"
+    r"|(?P<plain>" + _SECTION_NAME + r")\s*[:：])\s*(?P<rest>.*)$"
+)
+
+
+@dataclass
+class Method:
+    """構造化された手法 1 件。"""
+    label: str
+    tool: str = ""
+    steps: str = ""
+    libraries: str = ""
+    pros: str = ""
+    cons: str = ""
+    raw: str = ""
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.raw.strip()
+
+    @property
+    def title(self) -> str:
+        if self.is_empty:
+            return f"手法{self.label}: （生成なし）"
+        return f"手法{self.label}: {self.tool}" if self.tool else f"手法{self.label}"
+
+    def to_text(self) -> str:
+        """プロンプトに埋め込むためのテキスト表現。"""
+        return self.raw.strip()
+
+    def to_markdown(self) -> str:
+        if self.is_empty:
+            return "_（未生成または分割に失敗しました）_"
+        sections = [
+            ("実装手順", self.steps),
+            ("必要なライブラリ・機能", self.libraries),
+            ("メリット", self.pros),
+            ("デメリット", self.cons),
+        ]
+        if not any(body for _, body in sections):
+            # 項目に分解できなかった場合は本文をそのまま表示する
+            return self.raw.strip().replace("\n", "  \n")
+        lines = [f"**ツール:** {self.tool}" if self.tool else ""]
+        for name, body in sections:
+            if body:
+                lines.append(f"**{name}**  \n" + body.replace("\n", "  \n"))
+        return "\n\n".join(line for line in lines if line)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Method":
+        return cls(**data)
+
+
+def _section_key(name: str):
+    if "デメリット" in name:
+        return "cons"
+    if "メリット" in name:
+        return "pros"
+    if "ライブラリ" in name or "機能" in name or "ツール" in name:
+        return "libraries"
+    if "手順" in name:
+        return "steps"
+    return None
+
+
+def _normalize_label(label: str) -> str:
+    # 全角 Ａ-Ｃ を半角に揃える
+    return chr(ord(label) - 0xFEE0) if "Ａ" <= label <= "Ｃ" else label
+
+
+def parse_method(label: str, text: str, tool: str = "") -> Method:
+    """見出し行を除いた手法本文を項目ごとに分解する。"""
+    method = Method(label=label, tool=tool)
+    current = None
+    buffers = {"steps": [], "libraries": [], "pros": [], "cons": []}
+    for line in text.split("\n"):
+        m = _SECTION_RE.match(line)
+        key = _section_key(m.group("bracket") or m.group("lettered") or m.group("plain")) if m else None
+        if key is not None:
+            current = key
+            if m.group("rest").strip():
+                buffers[current].append(m.group("rest").strip())
+        elif current is not None:
+            buffers[current].append(line.rstrip())
+        elif line.strip() and not method.tool:
+            # 見出しにツール名が無い場合は最初の行をツール名とみなす
+            method.tool = line.strip()
+    for key, lines in buffers.items():
+        setattr(method, key, "\n".join(lines).strip())
+    if tool or text.strip():
+        header = f"手法{label}: {tool}\n" if tool else f"手法{label}: "
+        method.raw = (header + text.strip()).strip()
+    return method
+
+
+class MethodStreamParser:
+    """ストリーミング中のテキストから手法を逐次取り出すパーサー。
+
+    feed() に差分を渡すと、次の手法の見出しが届いた時点で直前の手法が完成したとみなして返す。
+    close() で残りを確定し、欠けた手法は空の Method で補う（再リクエストはしない）。
+    labels は期待する手法のラベル。手法ごとに個別に生成する場合は 1 文字だけ渡す。
+    """
+
+    def __init__(self, labels: str = LABELS):
+        self.labels = labels
+        self.buffer = ""            # 改行が届いていない末尾
+        self.current = None         # (label, tool, [lines])
+        self.preamble = []          # 最初の見出しより前の行
+        self.methods = {}           # label -> Method
+
+    @property
+    def pending_text(self) -> str:
+        """まだ完成していない手法のテキスト（表示用）。"""
+        if self.current is None:
+            return "\n".join(self.preamble + [self.buffer])
+        label, tool, lines = self.current
+        return "\n".join([f"手法{label}: {tool}"] + lines + [self.buffer])
+
+    def feed(self, delta: str) -> list:
+        self.buffer += delta
+        completed = []
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            method = self._consume_line(line)
+            if method is not None:
+                completed.append(method)
+        return completed
+
+    def close(self) -> list:
+        """残りを確定し、labels 順に並んだ Method のリストを返す。"""
+        if self.buffer:
+            self._consume_line(self.buffer)
+            self.buffer = ""
+        self._finish_current()
+
+        if not self.methods and "".join(self.preamble).strip():
+            # 見出しが 1 つも無い場合は全文を先頭の手法として扱う
+            label = self.labels[0]
+            self.methods[label] = parse_method(label, "\n".join(self.preamble))
+        return [self.methods.get(label) or Method(label=label) for label in self.labels]
+
+    def _next_label(self, label: str):
+        # 期待外・重複したラベルは、まだ埋まっていない次のラベルに読み替える
+        if label in self.labels and label not in self.methods and (
+            self.current is None or self.current[0] != label
+        ):
+            return label
+        taken = set(self.methods) | ({self.current[0]} if self.current else set())
+        for candidate in self.labels:
+            if candidate not in taken:
+                return candidate
+        return None
+
+    def _consume_line(self, line):
+        m = _HEADER_RE.match(line)
+        if m:
+            label = self._next_label(_normalize_label(m.group("label")))
+            if label is not None:
+                finished = self._finish_current()
+                self.current = (label, m.group("tool").strip(), [])
+                return finished
+        if self.current is None:
+            self.preamble.append(line)
+        else:
+            self.current[2].append(line)
+        return None
+
+    def _finish_current(self):
+        if self.current is None:
+            return None
+        label, tool, lines = self.current
+        self.current = None
+        method = parse_method(label, "\n".join(lines), tool=tool)
+        self.methods[label] = method
+        return method
+
@@ -0,0 +1,259 @@
+# metrics.py
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 既知のフロー名を画面の流れの順に並べたもの（集計の表示順に使う。これ以外の名前も記録できる）
+FLOWS = ("three_methods", "followup", "followup_prefetch", "chat", "chat_summary", "random_problem", "random_problem_batch", "feedback", "feedback_batch")
+
+
+# 別の名前で記録しているが、集計では元のフローにまとめるもの（並列生成の 1 手法分 -> ３手法の生成）
+FLOW_ALIASES = {"single_method": "three_methods"}
+
+
+def flow_group(flow):
+    """集計に使うフロー名。FLOW_ALIASES の別名（と、その続きの依頼）は元のフローに読み替える。"""
+    base, suffix = (flow[: -len("_continue")], "_continue") if flow.endswith("_continue") else (flow, "")
+    return FLOW_ALIASES.get(base, base) + suffix
+
+
+def flow_order(flow):
+    """集計の並び順のキー。既知のフローは FLOWS の順、続きの依頼（<フロー名>_continue）は元のフローの直後。"""
+    base = flow[: -len("_continue")] if flow.endswith("_continue") else flow
+    known = base in FLOWS
+    return (not known, FLOWS.index(base) if known else 0, base, flow)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class MetricsRecorder:
+    """呼び出しごとの計測値を記録し、JSONL と Prometheus 形式で出力する。
+
+    直近 window 件はメモリに保持し、管理画面のローリングパーセンタイルに使う。
+    JSONL は jsonl_max_bytes を超えたら <path>.1 … <path>.<jsonl_backups> へ順に送り、古いものから消す。
+    """
+
+    # 起動時に JSONL から読み込む末尾の大きさ（1 件あたりの上限の目安 × window）
+    TAIL_BYTES_PER_RECORD = 2048
+
+    def __init__(self, jsonl_path=None, prom_path=None, window=2000,
+                 prompt_price_per_1k=0.0, completion_price_per_1k=0.0, cached_prompt_price_per_1k=None,
+                 jsonl_max_bytes=20 * 1024 * 1024, jsonl_backups=3):
+        self.jsonl_path = jsonl_path
+        self.jsonl_max_bytes = jsonl_max_bytes
+        self.jsonl_backups = jsonl_backups
+        self.prom_path = prom_path
+        self.prompt_price_per_1k = prompt_price_per_1k
+        self.completion_price_per_1k = completion_price_per_1k
+        # サーバー側のプロンプトキャッシュに当たった分の単価（指定が無ければ通常の単価）
+        self.cached_prompt_price_per_1k = (
+            prompt_price_per_1k if cached_prompt_price_per_1k is None else cached_prompt_price_per_1k
+        )
+        self._recent = deque(maxlen=window)
+        self._totals = {}           # flow -> 累計カウンター
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._prom_written_at = 0.0
+
+    # ---- 記録 ----
+    def estimate_cost(self, prompt_tokens, completion_tokens, cached_tokens=0) -> float:
+        cached = cached_tokens or 0
+        return (
+            ((prompt_tokens or 0) - cached) * self.prompt_price_per_1k
+            + cached * self.cached_prompt_price_per_1k
+            + (completion_tokens or 0) * self.completion_price_per_1k
+        ) / 1000.0
+
+    def record(self, record: dict):
+        """1 回分の計測値を記録する。upstream=False（キャッシュ・相乗り）の呼び出しは費用 0 とする。"""
+        record.setdefault("ts", time.time())
+        upstream = not (record.get("cache_hit") or record.get("coalesced"))
+        record["cost"] = (
+            self.estimate_cost(record.get("prompt_tokens"), record.get("completion_tokens"), record.get("cached_tokens"))
+            if upstream else 0.0
+        )
+        with self._lock:
+            self._ensure_loaded()
+            self._recent.append(record)
+            self._add_totals(record, upstream)
+            if self.jsonl_path:
+                self._append_jsonl(record)
+        if self.prom_path and time.time() - self._prom_written_at >= 1.0:
+            self.write_prometheus(self.prom_path)
+
+    def _add_totals(self, record, upstream):
+        totals = self._totals.setdefault(flow_group(record.get("flow", "other")), {
+            "calls": 0, "errors": 0, "cache_hits": 0, "coalesced": 0,
+            "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "cost": 0.0, "latency_s": 0.0,
+        })
+        totals["calls"] += 1
+        totals["errors"] += 1 if record.get("error") else 0
+        totals["cache_hits"] += 1 if record.get("cache_hit") else 0
+        totals["coalesced"] += 1 if record.get("coalesced") else 0
+        totals["latency_s"] += record.get("latency_s") or 0.0
+        if upstream:
+            totals["prompt_tokens"] += record.get("prompt_tokens") or 0
+            totals["cached_tokens"] += record.get("cached_tokens") or 0
+            totals["completion_tokens"] += record.get("completion_tokens") or 0
+            totals["cost"] += record["cost"]
+
+    def _append_jsonl(self, record):
+        if os.path.dirname(self.jsonl_path):
+            os.makedirs(os.path.dirname(self.jsonl_path), exist_ok=True)
+        with open(self.jsonl_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            size = f.tell()
+        if self.jsonl_max_bytes and size >= self.jsonl_max_bytes:
+            self._rotate_jsonl()
+
+    def _rotate_jsonl(self):
+        # 同じファイルに書く別プロセスが先に回していれば、見つからないファイルは飛ばす
+        try:
+            for i in range(self.jsonl_backups, 0, -1):
+                src = f"{self.jsonl_path}.{i - 1}" if i > 1 else self.jsonl_path
+                if os.path.exists(src):
+                    os.replace(src, f"{self.jsonl_path}.{i}")
+            if not self.jsonl_backups:
+                os.remove(self.jsonl_path)
+        except OSError:
+            pass
+
+    def _ensure_loaded(self):
+        # 再起動直後も管理画面に直近の値が出るよう、JSONL の末尾を読み込んでおく
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.jsonl_path or not os.path.exists(self.jsonl_path):
+            return
+        # ファイル全体は読まず、末尾の window 件分だけを読む
+        with open(self.jsonl_path, "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+            start = max(0, size - self._recent.maxlen * self.TAIL_BYTES_PER_RECORD)
+            f.seek(start)
+            if start:
+                f.readline()        # 途中から読み始めた行は捨てる
+            tail = deque(f, maxlen=self._recent.maxlen)
+        for line in tail:
+            try:
+                self._recent.append(json.loads(line))
+            except ValueError:
+                continue
+
+    # ---- 集計 ----
+    def recent(self, flow=None, since=None) -> list:
+        with self._lock:
+            self._ensure_loaded()
+            records = list(self._recent)
+        return [
+            r for r in records
+            if (flow is None or r.get("flow") == flow) and (since is None or r.get("ts", 0) >= since)
+        ]
+
+    def summary(self, since=None) -> dict:
+        """フローごとのローリング集計（p50/p90/p99 など）を返す。"""
+        by_flow = {}
+        for r in self.recent(since=since):
+            by_flow.setdefault(flow_group(r.get("flow", "other")), []).append(r)
+        result = {}
+        for flow in sorted(by_flow, key=flow_order):
+            records = by_flow[flow]
+            row = {"calls": len(records)}
+            for field in ("queue_wait_s", "ttft_s", "latency_s", "completion_tokens"):
+                values = [r[field] for r in records if r.get(field) is not None]
+                for q in (0.5, 0.9, 0.99):
+                    row[f"{field}_p{int(q * 100)}"] = percentile(values, q)
+            row["prompt_tokens_mean"] = (
+                sum(r.get("prompt_tokens") or 0 for r in records) / len(records)
+            )
+            row["cache_hit_rate"] = sum(1 for r in records if r.get("cache_hit")) / len(records)
+            # 上流に送ったプロンプトのうち、サーバー側のプレフィックスキャッシュに当たったトークンの割合
+            upstream = [
+                r for r in records
+                if r.get("prompt_tokens") and not (r.get("cache_hit") or r.get("coalesced"))
+            ]
+            prompt_total = sum(r["prompt_tokens"] for r in upstream)
+            row["prompt_cache_rate"] = (
+                sum(r.get("cached_tokens") or 0 for r in upstream) / prompt_total if prompt_total else None
+            )
+            row["error_rate"] = sum(1 for r in records if r.get("error")) / len(records)
+            row["truncated_rate"] = sum(1 for r in records if r.get("finish_reason") == "length") / len(records)
+            row["cost"] = sum(r.get("cost") or 0.0 for r in records)
+            result[flow] = row
+        return result
+
+    # ---- Prometheus ----
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            totals = {flow: dict(values) for flow, values in self._totals.items()}
+        counters = [
+            ("algorism_chat_calls_total", "calls", "チャット呼び出し回数"),
+            ("algorism_chat_errors_total", "errors", "失敗した呼び出し回数"),
+            ("algorism_chat_cache_hits_total", "cache_hits", "キャッシュから返した回数"),
+            ("algorism_chat_coalesced_total", "coalesced", "同一リクエストに相乗りした回数"),
+            ("algorism_chat_prompt_tokens_total", "prompt_tokens", "上流に送ったプロンプトトークン数"),
+            ("algorism_chat_cached_prompt_tokens_total", "cached_tokens", "プロンプトのうちサーバー側のキャッシュに当たったトークン数"),
+            ("algorism_chat_completion_tokens_total", "completion_tokens", "上流で生成されたトークン数"),
+            ("algorism_chat_cost_total", "cost", "推定費用"),
+            ("algorism_chat_latency_seconds_sum", "latency_s", "レイテンシの合計（秒）"),
+        ]
+        for name, field, help_text in counters:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for flow, values in sorted(totals.items()):
+                lines.append(f'{name}{{flow="{flow}"}} {values[field]}')
+
+        for metric, field in (("latency_seconds", "latency_s"), ("ttft_seconds", "ttft_s"),
+                              ("queue_wait_seconds", "queue_wait_s")):
+            name = f"algorism_chat_{metric}"
+            lines.append(f"# TYPE {name} summary")
+            by_flow = {}
+            for r in self.recent():
+                if r.get(field) is not None:
+                    by_flow.setdefault(flow_group(r.get("flow", "other")), []).append(r[field])
+            for flow, values in sorted(by_flow.items()):
+                for q in (0.5, 0.9, 0.99):
+                    lines.append(f'{name}{{flow="{flow}",quantile="{q}"}} {percentile(values, q)}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        self._prom_written_at = time.time()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp, path)
+
+
+def serve_prometheus(recorder, port, host="0.0.0.0"):
+    """/metrics で Prometheus 形式のテキストを返す HTTP サーバーをバックグラウンドで起動する。"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = recorder.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,138 @@
+# pages/admin_metrics.py
+
+import hmac
+import os
+import time
+import streamlit as st
+
+from ai_utils import backend_health, budget_stats, cache_stats, metrics, throttle_stats
+from core import FOLLOWUP_PREFETCH, get_prefetcher
+
+st.set_page_config(page_title="管理：呼び出しメトリクス", layout="wide")
+st.title("🔧 管理：呼び出しメトリクス")
+
+# ------------------------------------------------------------
+# アクセス制限（ADMIN_PASSWORD を設定したときだけ、パスワードを入力した人に表示する）
+# ------------------------------------------------------------
+ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "")
+if not ADMIN_PASSWORD:
+    st.info("管理画面は無効です。環境変数 ADMIN_PASSWORD を設定すると利用できます。")
+    st.stop()
+if not st.session_state.get("admin_authenticated"):
+    password = st.text_input("管理者パスワード", type="password")
+    if not password:
+        st.stop()
+    if not hmac.compare_digest(password.encode("utf-8"), ADMIN_PASSWORD.encode("utf-8")):
+        st.error("パスワードが違います。")
+        st.stop()
+    st.session_state.admin_authenticated = True
+
+# ------------------------------------------------------------
+# 集計期間
+# ------------------------------------------------------------
+windows = {"直近 15 分": 15 * 60, "直近 1 時間": 60 * 60, "直近 24 時間": 24 * 60 * 60, "保持している全件": None}
+window_label = st.radio("集計期間", list(windows), horizontal=True)
+seconds = windows[window_label]
+since = time.time() - seconds if seconds else None
+
+if st.button("再読み込み"):
+    st.rerun()
+
+# ------------------------------------------------------------
+# フローごとのローリングパーセンタイル
+# ------------------------------------------------------------
+st.subheader("フロー別（レイテンシは秒）")
+summary = metrics.summary(since=since)
+if not summary:
+    st.info("この期間の呼び出しはまだありません。")
+else:
+    rows = []
+    for flow, row in summary.items():
+        rows.append({
+            "flow": flow,
+            "calls": row["calls"],
+            "queue p50": row["queue_wait_s_p50"],
+            "queue p99": row["queue_wait_s_p99"],
+            "TTFT p50": row["ttft_s_p50"],
+            "TTFT p90": row["ttft_s_p90"],
+            "TTFT p99": row["ttft_s_p99"],
+            "latency p50": row["latency_s_p50"],
+            "latency p90": row["latency_s_p90"],
+            "latency p99": row["latency_s_p99"],
+            "prompt tokens (mean)": round(row["prompt_tokens_mean"]),
+            "prompt cached": None if row["prompt_cache_rate"] is None else f"{row['prompt_cache_rate']:.0%}",
+            "completion p90": row["completion_tokens_p90"],
+            "cache hit": f"{row['cache_hit_rate']:.0%}",
+            "truncated": f"{row['truncated_rate']:.0%}",
+            "errors": f"{row['error_rate']:.0%}",
+            "cost": round(row["cost"], 4),
+        })
+    st.dataframe(rows, use_container_width=True, hide_index=True)
+
+# ------------------------------------------------------------
+# フローごとの出力トークン予算（max_tokens）
+# ------------------------------------------------------------
+st.subheader("出力トークンの予算")
+budgets = budget_stats()
+if not budgets:
+    st.info("まだ予算を計算したフローはありません。")
+else:
+    st.dataframe([
+        {
+            "flow": flow,
+            "max_tokens": row["max_tokens"],
+            "default": row["default"],
+            "samples": row["samples"],
+            "completion quantile": row["p"],
+            "truncated": None if row["truncated_rate"] is None else f"{row['truncated_rate']:.0%}",
+        }
+        for flow, row in budgets.items()
+    ], use_container_width=True, hide_index=True)
+
+# ------------------------------------------------------------
+# バックエンド（デプロイ）ごとの状態
+# ------------------------------------------------------------
+st.subheader("バックエンド")
+backends = backend_health()
+if not backends:
+    st.info("まだ呼び出しがありません。")
+else:
+    st.dataframe([
+        {
+            "name": b["name"],
+            "deployment": b["deployment"],
+            "weight": b["weight"],
+            "status": "OK" if b["healthy"] and not b["blocked_s"] else f"停止中（残り {b['blocked_s']:.0f} 秒）",
+            "EWMA TTFT": b["ewma_ttft_s"],
+            "EWMA latency": b["ewma_latency_s"],
+            "in flight": b["inflight"],
+            "queue": b["queue_depth"],
+            "quota left": f"{b['headroom']:.0%}",
+            "requests": b["requests"],
+            "failures": b["failures"],
+            "429": b["rate_limited"],
+            "hedged": b["hedged"],
+            "hedge wins": b["hedge_wins"],
+        }
+        for b in backends
+    ], use_container_width=True, hide_index=True)
+
+# ------------------------------------------------------------
+# キャッシュ・スロットリング
+# ------------------------------------------------------------
+col_cache, col_throttle, col_prefetch = st.columns(3)
+with col_cache:
+    st.subheader("応答キャッシュ")
+    st.json(cache_stats())
+with col_throttle:
+    st.subheader("レート制限・再試行・相乗り")
+    st.json(throttle_stats())
+with col_prefetch:
+    st.subheader(f"詳細フォローの先読み（{FOLLOWUP_PREFETCH}）")
+    st.json(get_prefetcher().stats)
+
+with st.expander("Prometheus 形式"):
+    st.code(metrics.render_prometheus(), language="text")
+
+with st.expander("直近の呼び出し（新しい順に 50 件）"):
+    st.dataframe(list(reversed(metrics.recent(since=since)))[:50], use_container_width=True)
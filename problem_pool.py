@@ -0,0 +1,229 @@
+# problem_pool.py
+
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import deque
+
+from ai_utils import call_chat
+from training_prompts import generate_problem_batch_prompt, sample_problems, system_message
+
+PROBLEM_POOL_PATH = os.getenv("PROBLEM_POOL_PATH", ".cache/problem_pool.json")
+# 1 回の呼び出しで生成する件数と、補充を始める残り件数
+PROBLEM_POOL_BATCH = int(os.getenv("PROBLEM_POOL_BATCH", "20"))
+PROBLEM_POOL_LOW_WATERMARK = int(os.getenv("PROBLEM_POOL_LOW_WATERMARK", "10"))
+PROBLEM_POOL_MAX = int(os.getenv("PROBLEM_POOL_MAX", "100"))
+# 文字 2-gram の Jaccard 係数がこれ以上なら同じ問題の言い換えとみなす
+PROBLEM_SIMILARITY_THRESHOLD = float(os.getenv("PROBLEM_SIMILARITY_THRESHOLD", "0.5"))
+# 重複判定のために覚えておく出題済みタイトルの件数
+PROBLEM_SERVED_HISTORY = 500
+
+
+# ----------------------------------------
+# 類似判定
+# ----------------------------------------
+_LIST_MARK_RE = re.compile(r"^\s*(?:[-*・●]|\d+[.)．、]|[（(]\d+[)）])\s*")
+
+
+def clean_title(line: str) -> str:
+    """箇条書きの記号や番号、括弧・引用符を取り除いたタイトルを返す。"""
+    title = _LIST_MARK_RE.sub("", line).strip()
+    return title.strip("\"'「」『』 　")
+
+
+def char_ngrams(text: str, n=2) -> set:
+    text = re.sub(r"\s+", "", text)
+    if len(text) < n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+# ----------------------------------------
+# 問題プール
+# ----------------------------------------
+class ProblemPool:
+    """AI が生成した問題タイトルの在庫。
+
+    take() はメモリ上の在庫から即座に 1 件返し、残りが low_watermark を下回ったら
+    バックグラウンドで batch 件ずつ補充する。在庫と出題済みの履歴は JSON に保存し、再起動後も引き継ぐ。
+    """
+
+    def __init__(self, path, generate, exclude=(), batch=20, low_watermark=10, max_items=100,
+                 threshold=0.5):
+        self.path = path
+        self.generate = generate            # generate(count, avoid) -> タイトル文字列のリスト
+        self.batch = batch
+        self.low_watermark = low_watermark
+        self.max_items = max_items
+        self.threshold = threshold
+        self._exclude = [char_ngrams(title) for title in exclude]
+        self._items = deque()
+        self._served = deque(maxlen=PROBLEM_SERVED_HISTORY)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._refilling = False
+        self._loaded = False
+        self.stats = {"served": 0, "empty": 0, "generated": 0, "duplicates": 0, "refills": 0, "errors": 0}
+
+    # ---- 永続化 ----
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._items.extend(data.get("items", []))
+        self._served.extend(data.get("served", []))
+
+    def _save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # UI スレッドの take() と補充スレッドの保存が重ならないよう、書き出しは 1 つずつ行う。
+        # 一時ファイルは呼び出しごとに別名にし、同じファイルを使う別プロセスとも衝突しないようにする
+        with self._save_lock:
+            with self._lock:
+                data = {"items": list(self._items), "served": list(self._served), "saved_at": time.time()}
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory or ".",
+                                             prefix=os.path.basename(self.path) + ".", suffix=".tmp",
+                                             delete=False) as f:
+                json.dump(data, f, ensure_ascii=False)
+            try:
+                os.replace(f.name, self.path)
+            except OSError:
+                os.remove(f.name)
+                raise
+
+    # ---- 取り出し ----
+    def __len__(self):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._items)
+
+    def take(self):
+        """在庫から 1 件取り出す。在庫が無ければ None（補充は裏で始まる）。"""
+        with self._lock:
+            self._ensure_loaded()
+            title = self._items.popleft() if self._items else None
+            if title is None:
+                self.stats["empty"] += 1
+            else:
+                self._served.append(title)
+                self.stats["served"] += 1
+        if title is not None:
+            self._save()
+        self.ensure_filled()
+        return title
+
+    def mark_served(self, title):
+        """在庫を経由せずに出題したタイトル（在庫切れ時の直接生成など）も重複判定に含める。"""
+        with self._lock:
+            self._ensure_loaded()
+            self._served.append(title)
+        self._save()
+
+    # ---- 補充 ----
+    def ensure_filled(self):
+        """残りが low_watermark を下回っていれば、バックグラウンドで補充を始める。"""
+        with self._lock:
+            self._ensure_loaded()
+            if self._refilling or len(self._items) >= self.low_watermark:
+                return
+            self._refilling = True
+        threading.Thread(target=self._refill_loop, daemon=True).start()
+
+    def _refill_loop(self):
+        try:
+            while True:
+                with self._lock:
+                    if len(self._items) >= max(self.low_watermark, min(self.max_items, self.low_watermark + self.batch)):
+                        return
+                if not self.refill():
+                    return
+        finally:
+            with self._lock:
+                self._refilling = False
+
+    def refill(self) -> int:
+        """1 バッチ生成して在庫に加え、追加できた件数を返す。"""
+        with self._lock:
+            self.stats["refills"] += 1
+            # 直近の出題と在庫を「避けるテーマ」として渡す（プロンプトが長くなりすぎない範囲で）
+            avoid = list(self._served)[-10:] + list(self._items)[-10:]
+        try:
+            titles = self.generate(self.batch, avoid)
+        except Exception:
+            with self._lock:
+                self.stats["errors"] += 1
+            return 0
+        added = self.add(titles)
+        self._save()
+        return added
+
+    def add(self, titles) -> int:
+        """類似の問題（サンプル・出題済み・在庫・同じバッチ内）を除いて在庫に加える。"""
+        added = 0
+        with self._lock:
+            self._ensure_loaded()
+            known = self._exclude + [char_ngrams(t) for t in list(self._served) + list(self._items)]
+            for title in titles:
+                title = clean_title(title)
+                if not title:
+                    continue
+                self.stats["generated"] += 1
+                grams = char_ngrams(title)
+                if any(jaccard(grams, other) >= self.threshold for other in known):
+                    self.stats["duplicates"] += 1
+                    continue
+                if len(self._items) >= self.max_items:
+                    break
+                self._items.append(title)
+                known.append(grams)
+                added += 1
+        return added
+
+
+def generate_problem_batch(count, avoid) -> list:
+    messages = [system_message, generate_problem_batch_prompt(count, avoid)]
+    # バッチごとに違う問題が欲しいのでキャッシュは使わない
+    res = call_chat(messages=messages, use_cache=False, flow="random_problem_batch",
+                    max_tokens=40 * count, temperature=0.9)
+    return res.choices[0].message.content.splitlines()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProblemPool:
+    """プロセス内で共有する問題プールを返す。"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProblemPool(
+                    path=PROBLEM_POOL_PATH,
+                    generate=generate_problem_batch,
+                    exclude=sample_problems,
+                    batch=PROBLEM_POOL_BATCH,
+                    low_watermark=PROBLEM_POOL_LOW_WATERMARK,
+                    max_items=PROBLEM_POOL_MAX,
+                    threshold=PROBLEM_SIMILARITY_THRESHOLD,
+                )
+    return _pool
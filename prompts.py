@@ -12,6 +12,20 @@ system_message = {
     )
 }
 
+# 手法 1 件分の出力フォーマット（method_parser.py がこの区切りで読み取る）
+METHOD_FORMAT = (
+    "### 手法{label}: ツール名\n"
+    "【実装手順】\n"
+    "（番号付きの手順）\n"
+    "【必要なライブラリ・機能】\n"
+    "（ライブラリや機能の例）\n"
+    "【メリット】\n"
+    "（箇条書き）\n"
+    "【デメリット】\n"
+    "（箇条書き）\n"
+)
+
+
 def generate_three_methods_prompt(user_problem: str) -> dict:
     content = (
         "以下の「ユーザーの課題」に対して、適切な３つの解決手段を提示してください。\n\n"
@@ -19,14 +33,12 @@ def generate_three_methods_prompt(user_problem: str) -> dict:
         f"{user_problem}\n\n"
         "―――――――――――――――\n"
         "＜出力フォーマット＞\n"
-        "1. 手法A:ツール名\n"
-        "   a) 実装手順\n"
-        "   b) 必要なライブラリや機能例\n"
-        "   c) メリット\n"
-        "   d) デメリット\n\n"
-        "2. 手法B: ・・・（同様のフォーマット）\n\n"
-        "3. 手法C: ・・・\n\n"
+        + METHOD_FORMAT.format(label="A") +
+        "\n"
+        "### 手法B: ・・・（同様のフォーマット）\n\n"
+        "### 手法C: ・・・\n\n"
         "※手法A/B/C はそれぞれ異なるツールや実装フローになるようにしてください。\n"
+        "※見出し行（### 手法X:）と【】で囲んだ項目名は、プログラムで読み取るため一字一句このまま出力してください。\n"
         "各手法の前書きは書かずフォーマットに沿った形での出力をお願いします。"
         )
     return {"role": "user", "content": content}
@@ -34,18 +46,100 @@ def generate_three_methods_prompt(user_problem: str) -> dict:
 
 
 # ----------------------------------------
-# ステップ4用：選択された手法に対する詳細フォローを依頼するプロンプト
-# （変更なし）
+# 手法ごとの並列生成用プロンプト
 # ----------------------------------------
-def generate_followup_prompt(user_problem: str, selected_method: str) -> dict:
+# 並列リクエストは互いの出力を参照できないため、手法ごとに観点を固定して重複を避ける
+METHOD_PERSPECTIVES = [
+    "プログラミング言語とライブラリを使って自前で実装するアプローチ",
+    "既存のツール・サービス（ノーコード／ローコード、表計算、クラウドの機能など）を活用するアプローチ",
+    "データベースやワークフロー基盤など、仕組みや運用フローで解決するアプローチ",
+]
+
+
+def generate_single_method_prompt(user_problem: str, index: int) -> dict:
+    label = "ABC"[index]
+    others = "、".join(
+        f"手法{'ABC'[i]}（{p}）" for i, p in enumerate(METHOD_PERSPECTIVES) if i != index
+    )
     content = (
-        f"以下の情報をもとに、ユーザーが選択した手法をさらに詳細に解説してください。\n\n"
+        "以下の「ユーザーの課題」に対して、指定した観点の解決手段を１つだけ提示してください。\n\n"
         f"【ユーザーの課題】\n"
         f"{user_problem}\n\n"
-        f"【選択された手法】\n"
-        f"{selected_method}\n\n"
+        f"【観点】\n"
+        f"{METHOD_PERSPECTIVES[index]}\n\n"
         "―――――――――――――――\n"
-        "この手法を実装する際の具体的な手順や注意点、擬似コードまたは例示的なコードスニペットを2000文字以内で示してください。\n"
-        "また、よくあるつまずきポイントとその対策も合わせて説明してください。\n"
+        "＜出力フォーマット＞\n"
+        + METHOD_FORMAT.format(label=label) +
+        "\n"
+        f"※他の手法として {others} が別途提示されるため、それらと重ならないツールや実装フローにしてください。\n"
+        "※見出し行（### 手法X:）と【】で囲んだ項目名は、プログラムで読み取るため一字一句このまま出力してください。\n"
+        "前書きは書かずフォーマットに沿った形での出力をお願いします。"
+    )
+    return {"role": "user", "content": content}
+
+
+# ----------------------------------------
+# 詳細フォロー・追加チャット用：セッションで共通の先頭メッセージ
+# ----------------------------------------
+# Azure OpenAI は先頭から一致するプロンプトをサーバー側でキャッシュする（prompt_tokens_details.cached_tokens）。
+# 詳細フォローと追加チャットは、同じセッションなら常に
+#   system_message → セッションの文脈（課題と選択した手法） → 詳細フォローの依頼 → 詳細フォローの回答 → …
+# の順で、1 文字も変えずに送る。追加チャットは詳細フォローの会話の続きで、詳細フォローの回答までを
+# 毎ターン変わらない先頭部分として固定する（要約には畳み込まない）ため、2 ターン目以降はその全体が
+# キャッシュに当たる。
+FOLLOWUP_INSTRUCTION = (
+    "上記の課題と選択された手法について、さらに詳細に解説してください。\n"
+    "この手法を実装する際の具体的な手順や注意点、擬似コードまたは例示的なコードスニペットを2000文字以内で示してください。\n"
+    "また、よくあるつまずきポイントとその対策も合わせて説明してください。\n"
+)
+
+
+def session_context_message(user_problem: str, selected_method: str) -> dict:
+    content = (
+        "以下は、ユーザーの課題と、ユーザーが選択した手法です。\n\n"
+        f"【ユーザーの課題】\n"
+        f"{user_problem}\n\n"
+        f"【選択された手法】\n"
+        f"{selected_method}\n"
+    )
+    return {"role": "system", "content": content}
+
+
+def build_followup_messages(user_problem: str, selected_method: str) -> list:
+    """ステップ4用：選択された手法の詳細フォローを依頼する messages。"""
+    return [
+        system_message,
+        session_context_message(user_problem, selected_method),
+        {"role": "user", "content": FOLLOWUP_INSTRUCTION},
+    ]
+
+
+def build_session_prefix(user_problem: str, selected_method: str, followup_answer: str = None) -> list:
+    """追加チャットの先頭に付ける、毎ターン変わらない messages。
+
+    詳細フォローを受け取っていれば、その依頼と回答までを含める（詳細フォローの会話の続きとして送る）。
+    """
+    if followup_answer is None:
+        return [system_message, session_context_message(user_problem, selected_method)]
+    return build_followup_messages(user_problem, selected_method) + [
+        {"role": "assistant", "content": followup_answer}
+    ]
+
+
+# ----------------------------------------
+# 追加チャット用：古いやり取りを要約に畳み込むプロンプト
+# ----------------------------------------
+def generate_summary_prompt(previous_summary: str, turns: list) -> dict:
+    transcript = "\n\n".join(
+        f"{'AI' if m['role'] == 'assistant' else 'ユーザー'}: {m['content']}" for m in turns
+    )
+    content = (
+        "以下は「これまでの要約」と、その後に続く「新しいやり取り」です。\n"
+        "新しいやり取りの内容を要約に統合し、更新後の要約だけを出力してください。\n"
+        "ユーザーの疑問点・AI が示した結論や手順・コードの要点など、後の質問に答えるために必要な情報を優先して残してください。\n\n"
+        f"【これまでの要約】\n"
+        f"{previous_summary or '（なし）'}\n\n"
+        f"【新しいやり取り】\n"
+        f"{transcript}\n"
     )
     return {"role": "user", "content": content}
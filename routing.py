@@ -0,0 +1,171 @@
+# routing.py
+
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+import openai
+
+from metrics import percentile
+from throttle import RateLimiter, retry_after_seconds
+
+# サーキットブレーカーの対象にする失敗（バックエンド側の故障）。タイムアウトは APIConnectionError に含まれる。
+# 400 などのリクエスト自体の問題は、どのバックエンドに送っても同じなので数えない
+BACKEND_ERRORS = (openai.InternalServerError, openai.APIConnectionError, httpx.TransportError)
+
+
+# ----------------------------------------
+# バックエンド（1 つのエンドポイント + デプロイ）
+# ----------------------------------------
+class Backend:
+    """1 つのデプロイへの接続と、その健全性の記録。
+
+    ewma は応答が返り始めるまでの秒数（ストリーミングは最初のチャンク、それ以外は応答全体）の
+    指数移動平均で、ストリーミングかどうかで分けて持つ。
+    """
+
+    def __init__(self, name, deployment, client, weight=1.0, limiter=None):
+        self.name = name
+        self.deployment = deployment
+        self.client = client
+        self.weight = weight
+        self.limiter = limiter or RateLimiter()
+        self.ewma = {True: None, False: None}
+        self.inflight = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0        # サーキットが開いている（選ばない）期限
+        self.stats = {"requests": 0, "failures": 0, "rate_limited": 0, "hedged": 0, "hedge_wins": 0}
+
+    def latency(self, stream):
+        value = self.ewma[stream]
+        return value if value is not None else self.ewma[not stream]
+
+
+class Router:
+    """直近のレイテンシと残りのクォータでバックエンドを選ぶ。
+
+    スコアは weight × 残りクォータの割合 ÷ EWMA レイテンシ ÷ (1 + 処理中の件数) で、
+    スコアに比例した確率で選ぶ（遅いバックエンドにも少しずつ流して EWMA を更新し続ける）。
+    5xx・接続エラー・タイムアウトが failure_threshold 回続いたバックエンドは cooldown 秒間選ばない。
+    429 は Retry-After の間そのバックエンドの limiter だけを止める。
+    """
+
+    def __init__(self, backends, alpha=0.2, failure_threshold=3, cooldown=30.0,
+                 hedge_percentile=0.0, hedge_min_samples=20):
+        if not backends:
+            raise ValueError("バックエンドが 1 つもありません")
+        self.backends = list(backends)
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._samples = {}          # (flow, stream) -> 直近のレイテンシ（ヘッジの待ち時間用）
+        self._lock = threading.Lock()
+
+    # ---- 選択 ----
+    def _available(self, backend, now):
+        return backend.open_until <= now and backend.limiter.headroom() > 0
+
+    def choose(self, exclude=(), tokens=0, stream=True, require_headroom=False):
+        """バックエンドを 1 つ選ぶ。require_headroom=True で、クォータを待たずに使えるものが無ければ None。
+
+        選んだバックエンドは処理中として数えるため、使い終わったら release() を呼ぶ。
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude] or list(self.backends)
+            usable = [b for b in candidates if self._available(b, now)]
+            if require_headroom:
+                usable = [b for b in usable if b.limiter.headroom(tokens) > 0]
+                if not usable:
+                    return None
+            if usable:
+                known = [b.latency(stream) for b in usable if b.latency(stream) is not None]
+                # まだ計測の無いバックエンドは、計測済みの最速と同じとみなして試す
+                default = min(known) if known else 1.0
+                scores = []
+                for b in usable:
+                    latency = b.latency(stream)
+                    if latency is None:
+                        latency = default
+                    headroom = max(b.limiter.headroom(tokens), 0.05)
+                    scores.append(b.weight * headroom / max(latency, 0.05) / (1 + b.inflight))
+                backend = random.choices(usable, weights=scores)[0]
+            else:
+                # どれも止まっているなら、一番早く空きそうなものを選ぶ（limiter の acquire で待つ）
+                backend = min(candidates, key=lambda b: max(b.open_until - now, b.limiter.blocked_for()))
+            backend.inflight += 1
+            backend.stats["requests"] += 1
+            return backend
+
+    def has_alternative(self, exclude) -> bool:
+        now = time.monotonic()
+        return any(b not in exclude and self._available(b, now) for b in self.backends)
+
+    # ---- 結果の記録 ----
+    def succeed(self, backend, latency, flow=None, stream=True):
+        with self._lock:
+            backend.consecutive_failures = 0
+            prev = backend.ewma[stream]
+            backend.ewma[stream] = latency if prev is None else prev + self.alpha * (latency - prev)
+            if flow is not None:
+                self._samples.setdefault((flow, stream), deque(maxlen=200)).append(latency)
+
+    def fail(self, backend, error):
+        if not isinstance(error, (openai.RateLimitError, *BACKEND_ERRORS)):
+            return
+        with self._lock:
+            backend.stats["failures"] += 1
+            if isinstance(error, openai.RateLimitError):
+                # クォータ切れはバックエンドの故障ではないので、サーキットは開かずに待つだけにする
+                backend.stats["rate_limited"] += 1
+                backend.limiter.block_for(retry_after_seconds(error) or 1.0)
+                return
+            backend.consecutive_failures += 1
+            if backend.consecutive_failures >= self.failure_threshold:
+                backend.open_until = time.monotonic() + self.cooldown
+
+    def release(self, backend):
+        with self._lock:
+            backend.inflight -= 1
+
+    def count(self, backend, key):
+        with self._lock:
+            backend.stats[key] += 1
+
+    # ---- ヘッジ ----
+    def hedge_delay(self, flow, stream):
+        """このフローの応答開始までの時間の hedge_percentile 分位点（秒）。ヘッジしないなら None。"""
+        if not self.hedge_percentile or len(self.backends) < 2:
+            return None
+        with self._lock:
+            samples = list(self._samples.get((flow, stream), ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return percentile(samples, self.hedge_percentile)
+
+    # ---- 集計 ----
+    def health(self) -> list:
+        """管理画面用に、バックエンドごとの状態を返す。"""
+        now = time.monotonic()
+        rows = []
+        with self._lock:
+            for b in self.backends:
+                rows.append({
+                    "name": b.name,
+                    "deployment": b.deployment,
+                    "weight": b.weight,
+                    "healthy": b.open_until <= now,
+                    "ewma_ttft_s": b.ewma[True],
+                    "ewma_latency_s": b.ewma[False],
+                    "inflight": b.inflight,
+                    "consecutive_failures": b.consecutive_failures,
+                    "blocked_s": max(b.open_until - now, b.limiter.blocked_for(), 0.0),
+                    "headroom": b.limiter.headroom(),
+                    "queue_depth": b.limiter.stats["queue_depth"],
+                    **b.stats,
+                })
+        return rows
@@ -0,0 +1,187 @@
+# session_store.py
+
+import abc
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+
+# ----------------------------------------
+# ストアのインターフェース
+# ----------------------------------------
+class SessionStore(abc.ABC):
+    """セッション（ユーザー）単位の状態とチャット履歴の保存先。
+
+    状態はキーごとの JSON 値、メッセージは (session_id, thread, method_idx) ごとの追記専用ログ。
+    thread は「３つの解法を生成する」ごとに進む会話の番号で、古い会話も消さずに残す。
+    """
+
+    @abc.abstractmethod
+    def get_state(self, session_id: str) -> dict:
+        ...
+
+    @abc.abstractmethod
+    def set_state(self, session_id: str, key: str, value):
+        ...
+
+    @abc.abstractmethod
+    def append_message(self, session_id: str, thread: int, method_idx: int, message: dict) -> int:
+        """メッセージを追記し、その会話内での通し番号（0 始まり）を返す。"""
+
+    @abc.abstractmethod
+    def count_messages(self, session_id: str, thread: int, method_idx: int) -> int:
+        ...
+
+    @abc.abstractmethod
+    def load_messages(self, session_id: str, thread: int, method_idx: int, offset=0, limit=None) -> list:
+        """通し番号 offset から最大 limit 件を古い順に返す。"""
+
+
+class MemorySessionStore(SessionStore):
+    """プロセス内だけで保持するストア（テスト・単一プロセス用）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+        self._messages = {}
+
+    def get_state(self, session_id):
+        with self._lock:
+            return dict(self._states.get(session_id, {}))
+
+    def set_state(self, session_id, key, value):
+        with self._lock:
+            # 保存後に呼び出し側で値を書き換えても影響しないよう JSON 経由で複製する
+            self._states.setdefault(session_id, {})[key] = json.loads(json.dumps(value))
+
+    def append_message(self, session_id, thread, method_idx, message):
+        with self._lock:
+            log = self._messages.setdefault((session_id, thread, method_idx), [])
+            log.append(dict(message))
+            return len(log) - 1
+
+    def count_messages(self, session_id, thread, method_idx):
+        with self._lock:
+            return len(self._messages.get((session_id, thread, method_idx), []))
+
+    def load_messages(self, session_id, thread, method_idx, offset=0, limit=None):
+        with self._lock:
+            log = self._messages.get((session_id, thread, method_idx), [])
+            end = None if limit is None else offset + limit
+            return [dict(m) for m in log[offset:end]]
+
+
+class SQLiteSessionStore(SessionStore):
+    """SQLite に保存するストア（既定）。"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            # 複数プロセス（レプリカ）から同じファイルを読み書きしても待たされにくくする
+            try:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.OperationalError:
+                # 別のプロセスが同時に切り替えている。WAL はファイルに記録されるのでそちらに任せる
+                pass
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_state ("
+                " session_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " updated_at REAL NOT NULL, PRIMARY KEY (session_id, key))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_messages ("
+                " session_id TEXT NOT NULL, thread INTEGER NOT NULL, method_idx INTEGER NOT NULL,"
+                " seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL,"
+                " created_at REAL NOT NULL, PRIMARY KEY (session_id, thread, method_idx, seq))"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get_state(self, session_id):
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT key, value FROM session_state WHERE session_id = ?", (session_id,)
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def set_state(self, session_id, key, value):
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO session_state (session_id, key, value, updated_at) VALUES (?, ?, ?, ?)",
+                (session_id, key, json.dumps(value, ensure_ascii=False), time.time()),
+            )
+            db.commit()
+
+    def append_message(self, session_id, thread, method_idx, message):
+        with self._lock:
+            db = self._db()
+            # 連番は INSERT と同じ文で採番する（同じファイルを共有する別プロセスと重ならないように）
+            cur = db.execute(
+                "INSERT INTO chat_messages (session_id, thread, method_idx, seq, role, content, created_at)"
+                " SELECT ?, ?, ?, COALESCE(MAX(seq) + 1, 0), ?, ?, ? FROM chat_messages"
+                " WHERE session_id = ? AND thread = ? AND method_idx = ?",
+                (session_id, thread, method_idx, message["role"], message["content"], time.time(),
+                 session_id, thread, method_idx),
+            )
+            # コミットまでは書き込みロックを持っているので、採番した値をそのまま読み返せる
+            seq = db.execute("SELECT seq FROM chat_messages WHERE rowid = ?", (cur.lastrowid,)).fetchone()[0]
+            db.commit()
+            return seq
+
+    def count_messages(self, session_id, thread, method_idx):
+        with self._lock:
+            return self._db().execute(
+                "SELECT COUNT(*) FROM chat_messages WHERE session_id = ? AND thread = ? AND method_idx = ?",
+                (session_id, thread, method_idx),
+            ).fetchone()[0]
+
+    def load_messages(self, session_id, thread, method_idx, offset=0, limit=None):
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT role, content FROM chat_messages"
+                " WHERE session_id = ? AND thread = ? AND method_idx = ? AND seq >= ?"
+                " ORDER BY seq LIMIT ?",
+                (session_id, thread, method_idx, offset, -1 if limit is None else limit),
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+
+# ----------------------------------------
+# ストアの選択
+# ----------------------------------------
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> SessionStore:
+    """SESSION_STORE_URL に応じたストアを返す（プロセス内で共有）。
+
+    sqlite:///<path>（既定: sqlite:///.cache/sessions.sqlite3）または memory://
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                url = os.getenv("SESSION_STORE_URL", "sqlite:///.cache/sessions.sqlite3")
+                if url.startswith("sqlite:///"):
+                    _store = SQLiteSessionStore(url[len("sqlite:///"):])
+                elif url.startswith("memory://"):
+                    _store = MemorySessionStore()
+                else:
+                    raise ValueError(f"未対応の SESSION_STORE_URL です: {url}")
+    return _store
@@ -0,0 +1,315 @@
+# similarity_index.py
+
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+
+import numpy as np
+
+# ----------------------------------------
+# 特徴量（文字 n-gram）
+# ----------------------------------------
+NGRAM_SIZES = (2, 3)
+_IGNORED_CHARS_RE = re.compile(r"[\s、。，．,.!?！？「」『』（）()\[\]【】・:：;；\"']+")
+
+
+def normalize_text(text: str) -> str:
+    """全角・半角や大文字小文字、空白・句読点の違いを吸収する。"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _IGNORED_CHARS_RE.sub("", text)
+
+
+def text_ngrams(text: str) -> set:
+    text = normalize_text(text)
+    grams = set()
+    for n in NGRAM_SIZES:
+        grams.update(text[i:i + n] for i in range(len(text) - n + 1))
+    if not grams and text:
+        grams.add(text)
+    return grams
+
+
+# ----------------------------------------
+# 転置インデックス（TF-IDF + コサイン類似度）
+# ----------------------------------------
+class SimilarityIndex:
+    """文字 n-gram の TF-IDF ベクトルでコサイン類似度の上位 k 件を返すインデックス。
+
+    n-gram ごとに文書番号の配列（転置リスト）を持ち、検索時は問い合わせに含まれる n-gram の
+    リストだけを np.bincount で集計する。追加は転置リストへの追記だけで済む。
+    文書ベクトルのノルムは追加時の IDF で計算し、件数が一定割合増えたらまとめて計算し直す。
+    """
+
+    # この割合だけ文書が増えたら、IDF の変化に合わせてノルムを計算し直す
+    RENORM_GROWTH = 0.1
+
+    def __init__(self):
+        self._vocab = {}            # n-gram -> 番号
+        self._postings = []         # n-gram 番号 -> 文書番号の array('i')
+        self._norms = array("d")    # 文書番号 -> ベクトルのノルム
+        self._docs = 0
+        self._normed_at = 0         # 最後にノルムを計算し直した時点の文書数
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._docs
+
+    def _idf(self, df):
+        return math.log((self._docs + 1) / (df + 1)) + 1.0
+
+    def _postings_of(self, gram):
+        gid = self._vocab.get(gram)
+        if gid is None:
+            gid = self._vocab[gram] = len(self._postings)
+            self._postings.append(array("i"))
+        return self._postings[gid]
+
+    def add(self, text) -> int:
+        """文書を追加し、その文書番号を返す。"""
+        grams = text_ngrams(text)
+        with self._lock:
+            doc_id = self._docs
+            self._docs += 1
+            norm = 0.0
+            for gram in grams:
+                docs = self._postings_of(gram)
+                docs.append(doc_id)
+                norm += self._idf(len(docs)) ** 2
+            self._norms.append(math.sqrt(norm))
+            if self._docs > 100 and self._docs - self._normed_at > self._docs * self.RENORM_GROWTH:
+                self._renorm()
+        return doc_id
+
+    def add_many(self, texts) -> int:
+        """まとめて追加し、最初の文書番号を返す。ノルムは 1 文書ずつではなく最後にまとめて計算する。"""
+        grams_list = [text_ngrams(text) for text in texts]
+        with self._lock:
+            first = self._docs
+            for grams in grams_list:
+                for gram in grams:
+                    self._postings_of(gram).append(self._docs)
+                self._docs += 1
+            if self._docs > first:
+                self._renorm()
+        return first
+
+    def _renorm(self):
+        # 転置リストを 1 本につなげ、文書ごとの IDF の二乗和を np.bincount でまとめて求める
+        lengths = np.fromiter((len(docs) for docs in self._postings), dtype=np.int64, count=len(self._postings))
+        doc_ids = (
+            np.concatenate([np.frombuffer(docs, dtype=np.int32) for docs in self._postings])
+            if self._postings else np.zeros(0, dtype=np.int32)
+        )
+        idf = np.log((self._docs + 1) / (lengths + 1)) + 1.0
+        norms = np.bincount(doc_ids, weights=np.repeat(idf * idf, lengths), minlength=self._docs)
+        self._norms = array("d", np.sqrt(norms))
+        self._normed_at = self._docs
+
+    def _scores(self, grams):
+        # 転置リストとノルムは追記される配列のため、ビュー（np.frombuffer）はロック中のこの関数内だけで使う
+        doc_lists, weights = [], []
+        query_norm = 0.0
+        for gram in grams:
+            idf_q = self._idf(0)
+            gid = self._vocab.get(gram)
+            if gid is not None:
+                docs = self._postings[gid]
+                idf_q = self._idf(len(docs))
+                doc_lists.append(np.frombuffer(docs, dtype=np.int32))
+                weights.append(idf_q * idf_q)
+            query_norm += idf_q * idf_q
+        if not doc_lists:
+            return None
+        scores = np.bincount(
+            np.concatenate(doc_lists),
+            weights=np.repeat(weights, [len(d) for d in doc_lists]),
+            minlength=self._docs,
+        )
+        return scores / (np.frombuffer(self._norms, dtype=np.float64) * math.sqrt(query_norm) + 1e-12)
+
+    def search(self, text, k=5) -> list:
+        """(文書番号, 類似度) を類似度の高い順に最大 k 件返す。"""
+        grams = text_ngrams(text)
+        with self._lock:
+            scores = self._scores(grams) if self._docs else None
+        if scores is None:
+            return []
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), min(1.0, float(scores[i]))) for i in top if scores[i] > 0]
+
+
+# ----------------------------------------
+# 解決済みの問題の保存先
+# ----------------------------------------
+class SolvedProblemStore:
+    """解決済みの問題と生成結果を SQLite に保存し、類似の問題を検索する。
+
+    インデックスは最初の利用時にバックグラウンドで SQLite の全件から組み立てる。組み立て中の検索は
+    build_wait 秒だけ待ち、間に合わなければ類似なしとして返す（画面の操作を止めない）。
+    以降はインデックスに取り込んだ最大の id より後の行だけを読み込んで追加する。検索時は
+    refresh_interval 秒ごとに確認するので、同じファイルを使う別のプロセスが保存した問題も見つかる。
+    """
+
+    def __init__(self, path, build_wait=0.2, refresh_interval=5.0):
+        self.path = path
+        self.build_wait = build_wait
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._conn = None
+        self._index = None
+        self._row_ids = []          # 文書番号 -> SQLite の id
+        self._by_text = {}          # 正規化した問題文 -> 文書番号（全く同じ問題は上書きする）
+        self._last_id = 0           # インデックスに取り込んだ最大の id
+        self._refreshed_at = 0.0
+        self._building = False
+        self._ready = threading.Event()
+        self.generation = 0         # 組み立ての完了や新しい行の取り込みで増える（検索結果のキャッシュのキー）
+
+    def _db(self):
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            try:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.OperationalError:
+                # 別のプロセスが同時に切り替えている（WAL はファイルに記録される）
+                pass
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS solved_problems ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, problem TEXT NOT NULL,"
+                " result TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    # ---- インデックスの組み立て ----
+    def _wait_index(self) -> bool:
+        """インデックスの組み立てを（まだなら）始め、build_wait 秒まで待つ。使える状態なら True。"""
+        with self._lock:
+            if self._index is None and not self._building:
+                self._db()
+                self._building = True
+                threading.Thread(target=self._build, daemon=True).start()
+        return self._ready.wait(self.build_wait)
+
+    def _build(self):
+        # 検索や保存を止めないよう、ロックの外で自前の接続から読み込んで組み立てる
+        index, row_ids, by_text, last_id = SimilarityIndex(), [], {}, 0
+        try:
+            conn = sqlite3.connect(self.path)
+            try:
+                rows = conn.execute("SELECT id, problem FROM solved_problems ORDER BY id").fetchall()
+            finally:
+                conn.close()
+            texts = []
+            for row_id, problem in rows:
+                key = normalize_text(problem)
+                if key in by_text:
+                    row_ids[by_text[key]] = row_id
+                else:
+                    by_text[key] = len(texts)
+                    texts.append(problem)
+                    row_ids.append(row_id)
+            index.add_many(texts)
+            last_id = rows[-1][0] if rows else 0
+        except Exception:
+            # 組み立てられなければ空から始め、下の _refresh で 1 件ずつ取り込む
+            index, row_ids, by_text, last_id = SimilarityIndex(), [], {}, 0
+        with self._lock:
+            self._index, self._row_ids, self._by_text, self._last_id = index, row_ids, by_text, last_id
+            self._building = False
+            self.generation += 1
+            # 組み立て中に保存された分を取り込む
+            self._refresh(force=True)
+        self._ready.set()
+
+    def _refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._refreshed_at < self.refresh_interval:
+            return
+        self._refreshed_at = now
+        rows = self._db().execute(
+            "SELECT id, problem FROM solved_problems WHERE id > ? ORDER BY id", (self._last_id,)
+        ).fetchall()
+        for row_id, problem in rows:
+            key = normalize_text(problem)
+            if key in self._by_text:
+                self._row_ids[self._by_text[key]] = row_id
+            else:
+                self._by_text[key] = self._index.add(problem)
+                self._row_ids.append(row_id)
+            self._last_id = row_id
+        if rows:
+            self.generation += 1
+
+    # ---- 保存・検索 ----
+    def __len__(self):
+        if not self._wait_index():
+            return 0
+        with self._lock:
+            self._refresh()
+            return len(self._index)
+
+    def add(self, problem, result):
+        """問題と生成結果（JSON にできる値）を保存する。インデックスには次の検索から含まれる。"""
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT INTO solved_problems (problem, result, created_at) VALUES (?, ?, ?)",
+                (problem, json.dumps(result, ensure_ascii=False), time.time()),
+            )
+            db.commit()
+            if self._index is not None:
+                self._refresh(force=True)
+
+    def search(self, problem, k=3, threshold=0.0) -> list:
+        """類似度が threshold 以上の {"problem", "result", "score"} を類似度の高い順に返す。
+
+        インデックスを組み立てている途中（build_wait 秒で終わらなかった場合）は空のリストを返す。
+        """
+        if not self._wait_index():
+            return []
+        with self._lock:
+            self._refresh()
+            hits = [(self._row_ids[doc_id], score) for doc_id, score in self._index.search(problem, k)]
+            results = []
+            for row_id, score in hits:
+                if score < threshold:
+                    continue
+                row = self._db().execute(
+                    "SELECT problem, result FROM solved_problems WHERE id = ?", (row_id,)
+                ).fetchone()
+                if row is not None:
+                    results.append({"problem": row[0], "result": json.loads(row[1]), "score": score})
+        return results
+
+
+# ----------------------------------------
+# 共有インスタンス
+# ----------------------------------------
+SIMILAR_PROBLEM_ENABLED = os.getenv("SIMILAR_PROBLEM_ENABLED", "1") != "0"
+SIMILAR_PROBLEM_PATH = os.getenv("SIMILAR_PROBLEM_PATH", ".cache/solved_problems.sqlite3")
+# この類似度（0〜1 のコサイン類似度）以上の解決済み問題を「類似の問題」として提示する
+SIMILAR_PROBLEM_THRESHOLD = float(os.getenv("SIMILAR_PROBLEM_THRESHOLD", "0.5"))
+
+_solved = None
+_solved_lock = threading.Lock()
+
+
+def get_solved_problems() -> SolvedProblemStore:
+    """プロセス内で共有する解決済み問題の保存先を返す。"""
+    global _solved
+    if _solved is None:
+        with _solved_lock:
+            if _solved is None:
+                _solved = SolvedProblemStore(SIMILAR_PROBLEM_PATH)
+    return _solved
@@ -0,0 +1,84 @@
+# tests/test_chat_context.py
+
+import logging
+
+import pytest
+
+import chat_context
+from chat_context import CHAT_SUMMARY_MAX_TOKENS, MESSAGE_OVERHEAD_TOKENS, build_chat_messages, new_summary_state
+
+PREFIX = [{"role": "system", "content": "s" * 96}]
+RESERVED = CHAT_SUMMARY_MAX_TOKENS + MESSAGE_OVERHEAD_TOKENS
+# 先頭部分（100）と要約の確保分を除いて、100 文字のメッセージ（104 トークン）が 4 件まで入る
+BUDGET = 100 + RESERVED + 4 * 104 + 50
+
+
+@pytest.fixture(autouse=True)
+def one_token_per_char(monkeypatch):
+    monkeypatch.setattr(chat_context, "count_tokens", len)
+
+
+def turn(i):
+    return {"role": "user" if i % 2 == 0 else "assistant", "content": f"{i:03d}" + "x" * 97}
+
+
+class Summarizer:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, previous, turns):
+        self.calls.append([t["content"][:3] for t in turns])
+        return f"{previous}+{len(turns)}"
+
+
+def test_under_budget_sends_everything_without_summarizing():
+    summarize = Summarizer()
+    history = [turn(i) for i in range(4)]
+    state = new_summary_state()
+    messages = build_chat_messages(PREFIX, history, state, budget=BUDGET, summarize=summarize)
+    assert messages == PREFIX + history
+    assert summarize.calls == []
+    assert state == new_summary_state()
+
+
+def test_overflow_folds_the_oldest_turns_once():
+    summarize = Summarizer()
+    history = [turn(i) for i in range(5)]
+    state = new_summary_state()
+    messages = build_chat_messages(PREFIX, history, state, budget=BUDGET, summarize=summarize)
+    # 予算の半分まで空ける：古い 3 件を畳み込み、今回の発言を含む 2 件を残す
+    assert summarize.calls == [["000", "001", "002"]]
+    assert state["covered"] == 3
+    assert messages[0] == PREFIX[0]
+    assert messages[1]["role"] == "system" and messages[1]["content"].endswith("+3")
+    assert messages[2:] == history[3:]
+
+
+def test_offset_history_is_not_summarized_again():
+    summarize = Summarizer()
+    full = [turn(i) for i in range(9)]
+    state = new_summary_state()
+    build_chat_messages(PREFIX, full[:5], state, budget=BUDGET, summarize=summarize)
+    # 次のターンからは要約済みの分を読み込まずに渡す
+    offset = state["covered"]
+    messages = build_chat_messages(PREFIX, full[offset:7], state, budget=BUDGET, summarize=summarize, offset=offset)
+    assert summarize.calls == [["000", "001", "002"]]
+    assert messages[2:] == full[3:7]
+    messages = build_chat_messages(PREFIX, full[offset:9], state, budget=BUDGET, summarize=summarize, offset=offset)
+    # 新しく溢れた分だけを、これまでの要約に追加で畳み込む
+    assert summarize.calls == [["000", "001", "002"], ["003", "004", "005", "006"]]
+    assert state["covered"] == 7
+    assert messages[1]["content"].endswith("+3+4")
+    assert messages[2:] == full[7:9]
+
+
+def test_prefix_over_budget_skips_summarizing_and_keeps_the_latest_turn(caplog):
+    summarize = Summarizer()
+    history = [turn(i) for i in range(5)]
+    state = new_summary_state()
+    with caplog.at_level(logging.WARNING, logger="chat_context"):
+        messages = build_chat_messages(PREFIX, history, state, budget=RESERVED, summarize=summarize)
+    assert summarize.calls == []
+    assert state["covered"] == 0
+    assert messages == PREFIX + history[-1:]
+    assert "予算" in caplog.text
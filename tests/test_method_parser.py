@@ -0,0 +1,82 @@
+# tests/test_method_parser.py
+
+from method_parser import MethodStreamParser, parse_method
+
+RESPONSE = """### 手法A: Python (pandas)
+【実装手順】
+1. CSV を読み込む
+2. drop_duplicates で重複を除く
+手法Cと組み合わせることもできます。
+【メリット】
+手軽に書ける
+【デメリット】
+大きなファイルではメモリを使う
+
+### 手法B: Excel
+【実装手順】
+1. 「重複の削除」を使う
+
+### 手法C: SQL
+【実装手順】
+1. 一時テーブルに取り込む
+2. SELECT DISTINCT で登録する
+"""
+
+
+def parse(text, labels="ABC", chunk=None):
+    parser = MethodStreamParser(labels)
+    if chunk is None:
+        parser.feed(text)
+    else:
+        for i in range(0, len(text), chunk):
+            parser.feed(text[i:i + chunk])
+    return parser.close()
+
+
+def test_body_line_mentioning_another_method_is_not_a_header():
+    a, b, c = parse(RESPONSE)
+    assert a.tool == "Python (pandas)"
+    assert "手法Cと組み合わせることもできます。" in a.steps
+    assert a.pros == "手軽に書ける"
+    assert a.cons == "大きなファイルではメモリを使う"
+    assert b.tool == "Excel"
+    assert b.steps == "1. 「重複の削除」を使う"
+    assert c.tool == "SQL"
+    assert "SELECT DISTINCT" in c.steps
+
+
+def test_streamed_in_small_chunks_matches_whole_text():
+    assert parse(RESPONSE, chunk=3) == parse(RESPONSE)
+
+
+def test_header_variants():
+    text = "\n".join([
+        "1. 手法A: VBA",
+        "【実装手順】",
+        "マクロを書く",
+        "**手法Ｂ**",
+        "Power Query",
+        "=== 手法C ===",
+        "手順: 手で直す",
+    ])
+    a, b, c = parse(text)
+    assert (a.tool, a.steps) == ("VBA", "マクロを書く")
+    assert b.tool == "Power Query"
+    assert c.steps == "手で直す"
+
+
+def test_colon_makes_a_bare_label_a_header():
+    a, b, c = parse("手法A：grep\n手法B: awk\n")
+    assert (a.tool, b.tool, c.is_empty) == ("grep", "awk", True)
+
+
+def test_without_headers_the_whole_text_is_the_first_method():
+    (a,) = parse("pandas を使う\n【メリット】\n速い", labels="A")
+    assert a.tool == "pandas を使う"
+    assert a.pros == "速い"
+
+
+def test_parse_method_sections():
+    method = parse_method("A", "a) 実装手順: 読み込む\nメリット: 速い\nデメリット：遅い", tool="pandas")
+    assert (method.steps, method.pros, method.cons) == ("読み込む", "速い", "遅い")
+    assert method.raw.startswith("手法A: pandas")
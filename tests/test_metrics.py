@@ -0,0 +1,42 @@
+# tests/test_metrics.py
+
+import json
+
+from metrics import MetricsRecorder
+
+
+def test_jsonl_rotates_and_keeps_a_bounded_number_of_backups(tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    recorder = MetricsRecorder(jsonl_path=str(path), jsonl_max_bytes=2000, jsonl_backups=2)
+    for i in range(200):
+        recorder.record({"flow": "chat", "latency_s": 0.1, "i": i})
+    names = sorted(p.name for p in tmp_path.iterdir())
+    assert names == ["metrics.jsonl", "metrics.jsonl.1", "metrics.jsonl.2"]
+    assert all(p.stat().st_size < 2200 for p in tmp_path.iterdir())
+
+
+def test_restart_loads_only_the_tail(tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(5000):
+            f.write(json.dumps({"flow": "chat", "latency_s": 0.1, "i": i}) + "\n")
+    recorder = MetricsRecorder(jsonl_path=str(path), window=100)
+    records = recorder.recent()
+    assert [r["i"] for r in records] == list(range(4900, 5000))
+
+
+def test_summary_follows_the_flow_order():
+    recorder = MetricsRecorder()
+    for flow in ("other", "chat_continue", "feedback", "chat", "three_methods"):
+        recorder.record({"flow": flow, "latency_s": 1.0})
+    assert list(recorder.summary()) == ["three_methods", "chat", "chat_continue", "feedback", "other"]
+
+
+def test_parallel_method_calls_are_grouped_under_three_methods():
+    recorder = MetricsRecorder()
+    for flow in ("single_method", "single_method", "single_method_continue", "three_methods"):
+        recorder.record({"flow": flow, "latency_s": 1.0, "prompt_tokens": 10, "completion_tokens": 5})
+    summary = recorder.summary()
+    assert list(summary) == ["three_methods", "three_methods_continue"]
+    assert summary["three_methods"]["calls"] == 3
+    assert "flow=\"single_method\"" not in recorder.render_prometheus()
@@ -0,0 +1,143 @@
+# tests/test_session_store.py
+
+import threading
+
+import pytest
+
+import core
+import session_store
+from core import Session
+from method_parser import Method
+from session_store import MemorySessionStore, SessionStore, SQLiteSessionStore, get_store
+
+
+@pytest.fixture
+def fresh_store(monkeypatch):
+    """get_store() の共有インスタンスを作り直させる。"""
+    monkeypatch.setattr(session_store, "_store", None)
+
+
+def test_base_class_cannot_be_instantiated():
+    with pytest.raises(TypeError):
+        SessionStore()
+
+    class Partial(SessionStore):
+        def get_state(self, session_id):
+            return {}
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_sqlite_round_trip_survives_reopen(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    store = SQLiteSessionStore(path)
+    store.set_state("s1", "user_problem", "重複を除去したい")
+    store.set_state("s1", "methods", [{"label": "A", "body": "手順"}])
+    store.set_state("s1", "user_problem", "上書き")
+    assert [store.append_message("s1", 0, 1, {"role": r, "content": f"m{i}"})
+            for i, r in enumerate(["user", "assistant", "user"])] == [0, 1, 2]
+    # 別の会話・別の手法は独立に 0 から採番される
+    assert store.append_message("s1", 1, 1, {"role": "user", "content": "x"}) == 0
+    assert store.append_message("s1", 0, 2, {"role": "user", "content": "y"}) == 0
+
+    reopened = SQLiteSessionStore(path)
+    assert reopened.get_state("s1") == {"user_problem": "上書き", "methods": [{"label": "A", "body": "手順"}]}
+    assert reopened.get_state("other") == {}
+    assert reopened.count_messages("s1", 0, 1) == 3
+    assert reopened.load_messages("s1", 0, 1) == [
+        {"role": "user", "content": "m0"}, {"role": "assistant", "content": "m1"}, {"role": "user", "content": "m2"},
+    ]
+    assert reopened.load_messages("s1", 0, 1, offset=1, limit=1) == [{"role": "assistant", "content": "m1"}]
+    assert reopened.append_message("s1", 0, 1, {"role": "assistant", "content": "m3"}) == 3
+
+
+def test_memory_url_selects_memory_store(monkeypatch, fresh_store):
+    monkeypatch.setenv("SESSION_STORE_URL", "memory://")
+    store = get_store()
+    assert isinstance(store, MemorySessionStore)
+    assert get_store() is store
+
+    value = {"items": [1, 2]}
+    store.set_state("s1", "k", value)
+    value["items"].append(3)
+    assert store.get_state("s1") == {"k": {"items": [1, 2]}}
+    assert [store.append_message("s1", 0, 0, {"role": "user", "content": str(i)}) for i in range(3)] == [0, 1, 2]
+    assert store.count_messages("s1", 0, 0) == 3
+    assert store.load_messages("s1", 0, 0, offset=2) == [{"role": "user", "content": "2"}]
+
+
+def test_unknown_url_is_rejected(monkeypatch, fresh_store):
+    monkeypatch.setenv("SESSION_STORE_URL", "redis://localhost")
+    with pytest.raises(ValueError):
+        get_store()
+
+
+def test_session_is_restored_from_sid(tmp_path):
+    store = SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"))
+    session = Session(store=store)
+    session.set_problem("毎日更新される CSV の重複を除去したい")
+    session.methods = [Method(label="A", tool="pandas", steps="drop_duplicates を使う", raw="### 手法A: ツール名\npandas")]
+    session.selected_method_index = 0
+    session.thread = 2
+    session.save()
+    store.append_message(session.session_id, 2, 0, {"role": "user", "content": "続きは？"})
+
+    # 別のプロセスから同じ sid で開き直した場合と同じく、新しいストアのインスタンスから復元する
+    restored = Session(session.session_id, store=SQLiteSessionStore(store.path))
+    assert restored.to_dict() == session.to_dict()
+    assert restored.store.load_messages(restored.session_id, restored.thread, 0) == [
+        {"role": "user", "content": "続きは？"},
+    ]
+
+
+def test_app_restores_session_from_sid_query_param(monkeypatch, fresh_store):
+    from streamlit.testing.v1 import AppTest
+
+    # クライアントを作るだけで通信はしない
+    for name, value in [("AZURE_OPENAI_ENDPOINT", "http://127.0.0.1:9"), ("AZURE_OPENAI_API_KEY", "k"),
+                        ("AZURE_OPENAI_DEPLOYMENT", "d"), ("AZURE_OPENAI_API_VERSION", "2024-10-21")]:
+        monkeypatch.setenv(name, value)
+    monkeypatch.setenv("SESSION_STORE_URL", "memory://")
+    monkeypatch.setattr(core, "SIMILAR_PROBLEM_ENABLED", False)
+    session = Session(store=get_store())
+    session.set_problem("ログから障害の兆候を見つけたい")
+
+    at = AppTest.from_file("../main.py", default_timeout=30)
+    at.query_params["sid"] = session.session_id
+    at.run()
+    assert not at.exception
+    assert at.session_state.restored_sid == session.session_id
+    assert at.text_area[0].value == "ログから障害の兆候を見つけたい"
+
+
+def test_concurrent_appends_get_distinct_contiguous_seqs(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    # 同じファイルを共有する複数のレプリカを、接続を分けたインスタンスで模す
+    stores = [SQLiteSessionStore(path) for _ in range(4)]
+    stores[0].count_messages("s1", 0, 0)  # テーブルを先に作っておく
+    per_thread = 25
+    seqs, errors = [], []
+
+    def worker(store, n):
+        try:
+            for i in range(per_thread):
+                seqs.append(store.append_message("s1", 0, 0, {"role": "user", "content": f"{n}-{i}"}))
+        except Exception as e:  # pragma: no cover - 失敗時に内容を出すため
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(stores[n % len(stores)], n)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=30)
+
+    assert not errors
+    total = per_thread * len(threads)
+    assert sorted(seqs) == list(range(total))
+    messages = stores[0].load_messages("s1", 0, 0)
+    assert len(messages) == total
+    # 同じスレッドからの追記は書いた順に並ぶ
+    for n in range(len(threads)):
+        mine = [m["content"] for m in messages if m["content"].startswith(f"{n}-")]
+        assert mine == [f"{n}-{i}" for i in range(per_thread)]
@@ -0,0 +1,333 @@
+# tests/test_throttle.py
+
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+
+import throttle
+from throttle import RateLimiter, SingleFlight, call_with_retries, retry_after_seconds
+
+
+def _run(target, *args):
+    result = {}
+
+    def wrapper():
+        try:
+            result["value"] = target(*args)
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=wrapper, daemon=True)
+    thread.start()
+    return thread, result
+
+
+def _rate_limit_error(headers=None):
+    request = httpx.Request("POST", "https://example.invalid/chat/completions")
+    response = httpx.Response(429, headers=headers or {}, request=request)
+    return openai.RateLimitError("rate limited", response=response, body=None)
+
+
+# ----------------------------------------
+# SingleFlight.call
+# ----------------------------------------
+def test_identical_calls_share_one_upstream_call():
+    flight = SingleFlight()
+    entered, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        entered.set()
+        release.wait(5)
+        return "result"
+
+    leader, leader_result = _run(flight.call, "key", fn)
+    entered.wait(5)
+    follower, follower_result = _run(flight.call, "key", fn)
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert calls == [1]
+    assert leader_result["value"] == ("result", True)
+    assert follower_result["value"] == ("result", False)
+    assert flight.stats == {"leaders": 1, "coalesced": 1}
+    assert not flight._calls
+
+
+def test_call_error_reaches_followers_and_is_forgotten():
+    flight = SingleFlight()
+    entered, release = threading.Event(), threading.Event()
+
+    def fn():
+        entered.set()
+        release.wait(5)
+        raise ValueError("boom")
+
+    leader, leader_result = _run(flight.call, "key", fn)
+    entered.wait(5)
+    follower, follower_result = _run(flight.call, "key", fn)
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert isinstance(leader_result["error"], ValueError)
+    assert follower_result["error"] is leader_result["error"]
+    # 失敗した呼び出しは残らず、次の呼び出しは新しい先頭になる
+    assert flight.call("key", lambda: "again") == ("again", True)
+
+
+# ----------------------------------------
+# SingleFlight.stream
+# ----------------------------------------
+def test_stream_followers_replay_the_same_chunks():
+    flight = SingleFlight()
+    opened = []
+
+    def upstream():
+        opened.append(1)
+        return iter(["a", "b", "c"])
+
+    leader, is_leader = flight.stream("key", upstream)
+    follower, is_follower_leader = flight.stream("key", upstream)
+    assert (is_leader, is_follower_leader) == (True, False)
+    assert next(leader) == "a"
+    assert list(follower) == ["a", "b", "c"]
+    assert list(leader) == ["b", "c"]
+    assert opened == [1]
+    assert not flight._streams
+
+
+def test_stream_open_error_is_raised_and_forgotten():
+    flight = SingleFlight()
+
+    def broken():
+        raise ValueError("cannot open")
+
+    with pytest.raises(ValueError):
+        flight.stream("key", broken)
+    assert not flight._streams
+    chunks, is_leader = flight.stream("key", lambda: iter(["ok"]))
+    assert is_leader and list(chunks) == ["ok"]
+
+
+def test_stream_read_error_reaches_followers():
+    flight = SingleFlight()
+
+    def upstream():
+        yield "a"
+        raise ValueError("broken stream")
+
+    leader, _ = flight.stream("key", upstream)
+    follower, _ = flight.stream("key", upstream)
+    with pytest.raises(ValueError):
+        list(leader)
+    assert next(follower) == "a"
+    with pytest.raises(ValueError):
+        next(follower)
+    assert not flight._streams
+
+
+def test_stream_closed_by_everyone_closes_upstream():
+    flight = SingleFlight()
+    closed = []
+
+    def upstream():
+        try:
+            yield "a"
+            yield "b"
+        finally:
+            closed.append(1)
+
+    leader, _ = flight.stream("key", upstream)
+    follower, _ = flight.stream("key", upstream)
+    assert next(leader) == "a"
+    leader.close()
+    # まだ読んでいる購読者がいる間は打ち切らない
+    assert not closed
+    assert list(follower) == ["a", "b"]
+
+    leader, _ = flight.stream("key", upstream)
+    assert next(leader) == "a"
+    leader.close()
+    assert closed == [1, 1]
+    assert not flight._streams
+
+
+def test_unread_subscription_close_releases_it():
+    flight = SingleFlight()
+    leader, _ = flight.stream("key", lambda: iter(["a", "b"]))
+    follower, _ = flight.stream("key", lambda: iter(["a", "b"]))
+    follower.close()
+    leader.close()
+    # 全員がやめたので打ち切られ、次の呼び出しは新しく開く
+    assert "key" not in flight._streams
+    chunks, is_leader = flight.stream("key", lambda: iter(["new"]))
+    assert is_leader and list(chunks) == ["new"]
+
+
+def test_leader_finishing_while_follower_subscribes_does_not_deadlock():
+    flight = SingleFlight()
+    last_read = threading.Event()
+
+    def upstream():
+        yield "a"
+        # 先頭が最後の読み込み（StopIteration）の途中にいる間に、後続が相乗りしてくる
+        last_read.set()
+        time.sleep(0.2)
+
+    def leader():
+        chunks, is_leader = flight.stream("key", upstream)
+        assert is_leader
+        return list(chunks)
+
+    def follower():
+        last_read.wait()
+        chunks, _ = flight.stream("key", lambda: iter(["fresh"]))
+        return list(chunks)
+
+    def other_key():
+        last_read.wait()
+        time.sleep(0.05)
+        chunks, _ = flight.stream("other", lambda: iter(["x"]))
+        return list(chunks)
+
+    threads = [_run(leader), _run(follower), _run(other_key)]
+    for thread, _ in threads:
+        thread.join(5)
+    assert not any(thread.is_alive() for thread, _ in threads)
+    (_, leader_result), (_, follower_result), (_, other_result) = threads
+    assert leader_result["value"] == ["a"]
+    assert follower_result["value"] in (["a"], ["fresh"])
+    assert other_result["value"] == ["x"]
+    assert not flight._streams
+
+
+def test_slow_upstream_read_does_not_block_other_keys():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def slow():
+        yield "a"
+        release.wait(5)
+        yield "b"
+
+    leader_chunks, _ = flight.stream("slow", slow)
+    assert next(leader_chunks) == "a"
+    reader, _ = _run(lambda: next(leader_chunks))
+    time.sleep(0.05)
+    # 先頭が上流の読み込みで待っている間も、相乗りと別のキーの呼び出しはすぐ返る
+    started = time.monotonic()
+    follower, is_leader = flight.stream("slow", slow)
+    other, _ = flight.stream("other", lambda: iter(["x"]))
+    assert not is_leader
+    assert list(other) == ["x"]
+    assert time.monotonic() - started < 1.0
+    release.set()
+    reader.join(5)
+    assert list(follower) == ["a", "b"]
+
+
+# ----------------------------------------
+# RateLimiter
+# ----------------------------------------
+def test_limiter_waits_when_the_request_budget_is_spent():
+    limiter = RateLimiter(rpm=600)
+    limiter._requests = 0.0
+    waited = limiter.acquire()
+    # 600 rpm なら 1 件分は 0.1 秒で貯まる
+    assert 0.05 <= waited < 1.0
+    assert limiter.stats["acquired"] == 1
+    assert limiter.stats["queue_depth"] == 0
+
+
+def test_limiter_settle_refunds_overestimated_tokens():
+    limiter = RateLimiter(tpm=1000)
+    assert limiter.acquire(tokens=800) < 0.05
+    assert limiter.headroom(tokens=500) == 0.0
+    limiter.settle(estimated=800, actual=200)
+    assert limiter.headroom(tokens=500) > 0.5
+    # 精算でバケットの容量を超えない
+    limiter.settle(estimated=5000, actual=0)
+    assert limiter._tokens == 1000
+
+
+def test_limiter_block_for_stops_everything():
+    limiter = RateLimiter()
+    limiter.block_for(0.2)
+    assert limiter.headroom() == 0.0
+    assert 0.1 < limiter.blocked_for() <= 0.2
+    assert limiter.acquire() >= 0.15
+
+
+# ----------------------------------------
+# call_with_retries
+# ----------------------------------------
+def test_retry_after_headers():
+    assert retry_after_seconds(_rate_limit_error({"retry-after-ms": "1500"})) == 1.5
+    assert retry_after_seconds(_rate_limit_error({"retry-after": "3"})) == 3.0
+    assert retry_after_seconds(_rate_limit_error()) is None
+    assert retry_after_seconds(ValueError()) is None
+
+
+def test_retries_wait_at_least_retry_after_and_block_the_limiter(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(throttle.time, "sleep", sleeps.append)
+    limiter = RateLimiter()
+    errors = [_rate_limit_error({"retry-after": "7"})]
+    stats = {"retries": 0, "rate_limited": 0}
+
+    def fn():
+        if errors:
+            raise errors.pop()
+        return "ok"
+
+    assert call_with_retries(fn, limiter=limiter, stats=stats) == "ok"
+    assert sleeps and sleeps[0] >= 7
+    assert limiter.blocked_for() > 6
+    assert stats == {"retries": 1, "rate_limited": 1}
+
+
+def test_retries_give_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(throttle.time, "sleep", lambda seconds: None)
+    calls = []
+
+    def fn():
+        calls.append(1)
+        raise _rate_limit_error()
+
+    with pytest.raises(openai.RateLimitError):
+        call_with_retries(fn, max_retries=2)
+    assert len(calls) == 3
+
+
+def test_non_retryable_errors_are_raised_at_once():
+    calls = []
+
+    def fn():
+        calls.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        call_with_retries(fn)
+    assert calls == [1]
+
+
+def test_failover_retries_immediately_without_counting(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(throttle.time, "sleep", sleeps.append)
+    errors = [_rate_limit_error(), _rate_limit_error()]
+    stats = {"retries": 0, "rate_limited": 0}
+
+    def fn():
+        if errors:
+            raise errors.pop()
+        return "ok"
+
+    assert call_with_retries(fn, max_retries=0, stats=stats, failover=lambda e: True) == "ok"
+    assert sleeps == []
+    assert stats["failovers"] == 2 and stats["retries"] == 0
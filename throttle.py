@@ -0,0 +1,396 @@
+# throttle.py
+
+import random
+import threading
+import time
+
+import openai
+
+# 再試行の対象とするエラー（429・5xx・接続エラー・タイムアウト）
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APIConnectionError,
+)
+
+
+# ----------------------------------------
+# トークンバケット（RPM / TPM）
+# ----------------------------------------
+class RateLimiter:
+    """1 分あたりのリクエスト数（rpm）とトークン数（tpm）を予算化するトークンバケット。
+
+    0 を指定した側は無制限として扱う。acquire() は両方のバケットに空きができるまで待つ。
+    """
+
+    def __init__(self, rpm=0, tpm=0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self.stats = {
+            "queue_depth": 0,
+            "max_queue_depth": 0,
+            "acquired": 0,
+            "waited": 0,
+            "total_wait_s": 0.0,
+            "max_wait_s": 0.0,
+        }
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+
+    def acquire(self, tokens=0) -> float:
+        """予算を確保し、待った秒数を返す。"""
+        # 1 回で TPM を超える見積もりは満杯のバケットで通す（永久に待たないように）
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+        start = time.monotonic()
+        with self._lock:
+            self.stats["queue_depth"] += 1
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.stats["queue_depth"])
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = self._blocked_until - now
+                    if wait <= 0:
+                        need_req = 1 - self._requests if self.rpm else 0
+                        need_tok = tokens - self._tokens if self.tpm else 0
+                        if need_req <= 0 and need_tok <= 0:
+                            if self.rpm:
+                                self._requests -= 1
+                            if self.tpm:
+                                self._tokens -= tokens
+                            break
+                        wait = max(
+                            need_req * 60.0 / self.rpm if self.rpm else 0,
+                            need_tok * 60.0 / self.tpm if self.tpm else 0,
+                        )
+                time.sleep(min(max(wait, 0.01), 1.0))
+        finally:
+            waited = time.monotonic() - start
+            with self._lock:
+                self.stats["queue_depth"] -= 1
+                self.stats["acquired"] += 1
+                if waited > 0.01:
+                    self.stats["waited"] += 1
+                self.stats["total_wait_s"] += waited
+                self.stats["max_wait_s"] = max(self.stats["max_wait_s"], waited)
+        return waited
+
+    def settle(self, estimated, actual):
+        """実際の使用トークン数が分かったら、見積もりとの差を精算する。"""
+        if not self.tpm or actual is None:
+            return
+        with self._lock:
+            self._tokens = min(self.tpm, self._tokens + estimated - actual)
+
+    def headroom(self, tokens=0) -> float:
+        """今すぐ使える予算の割合（0〜1）。tokens を確保できない・Retry-After で止まっているなら 0。"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._blocked_until > now:
+                return 0.0
+            ratios = [1.0]
+            if self.rpm:
+                ratios.append(self._requests / self.rpm if self._requests >= 1 else 0.0)
+            if self.tpm:
+                ratios.append(self._tokens / self.tpm if self._tokens >= min(tokens, self.tpm) else 0.0)
+            return max(0.0, min(ratios))
+
+    def blocked_for(self) -> float:
+        """Retry-After で止まっている残り秒数。"""
+        with self._lock:
+            return max(0.0, self._blocked_until - time.monotonic())
+
+    def block_for(self, seconds):
+        """Retry-After を受けたら、その間は全リクエストを止める。"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+def estimate_text_tokens(text: str) -> int:
+    """トークン数の概算（日本語などの非 ASCII 文字は 1 文字 1 トークン、ASCII は 4 文字 1 トークン）。"""
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+
+def estimate_tokens(messages, max_tokens=None) -> int:
+    """TPM 予算用の概算（メッセージ 1 件ごとに role などの分として 4 を足す）。"""
+    total = sum(estimate_text_tokens(message.get("content") or "") + 4 for message in messages)
+    return total + (max_tokens or 0)
+
+
+# ----------------------------------------
+# 再試行（ジッター付き指数バックオフ）
+# ----------------------------------------
+def retry_after_seconds(error):
+    """エラー応答の Retry-After（retry-after-ms / retry-after）を秒で返す。無ければ None。"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def call_with_retries(fn, limiter=None, max_retries=4, base_delay=1.0, max_delay=30.0, stats=None,
+                      failover=None):
+    """fn() を再試行付きで呼び出す。Retry-After があればそれ以上待ち、limiter 全体も止める。
+
+    failover(e) が True を返したときは、待たずに（再試行回数も数えずに）すぐ呼び直す。
+    別のバックエンドに切り替えられる場合に使う。
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except RETRYABLE_ERRORS as e:
+            if failover is not None and failover(e):
+                if stats is not None:
+                    stats["failovers"] = stats.get("failovers", 0) + 1
+                continue
+            if attempt >= max_retries:
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+            retry_after = retry_after_seconds(e)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+                if limiter is not None:
+                    limiter.block_for(retry_after)
+            if stats is not None:
+                stats["retries"] += 1
+                if isinstance(e, openai.RateLimitError):
+                    stats["rate_limited"] += 1
+            attempt += 1
+            time.sleep(delay)
+
+
+# ----------------------------------------
+# 同一リクエストの相乗り（single-flight）
+# ----------------------------------------
+class _CallFlight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class StreamAbandoned(Exception):
+    """購読者が全員読むのをやめたため、上流のストリームを閉じた。"""
+
+
+class _StreamFlight:
+    """上流のチャンク列を複数の購読者で共有する。
+
+    先行している購読者が上流から次のチャンクを読み、他の購読者はそれを再生する。
+    最後まで読まずに全員が購読をやめたら、上流の接続を閉じて生成を打ち切る。
+
+    _lock は状態（items・done・error・購読者数）を読み書きする間だけ持ち、その間に他のロックは取らない。
+    上流からの読み込みは _read_lock だけを持って行い、on_finish はどのロックも持たずに呼ぶ
+    （SingleFlight のロックと逆順に取り合わないように）。
+    """
+
+    def __init__(self, on_finish):
+        self._chunks = None
+        self._on_finish = on_finish
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._subscribers = 0
+        self.ready = threading.Event()
+        self.items = []
+        self.done = False
+        self.error = None
+        self.started = time.monotonic()
+
+    def start(self, chunks):
+        self._chunks = iter(chunks)
+        self.ready.set()
+
+    def fail(self, error):
+        with self._lock:
+            self.error = error
+        self._on_finish()
+        self.ready.set()
+
+    def subscribe(self):
+        """購読を始める。全員がやめて打ち切られた後なら None。
+
+        読み始める前に数えておき、相乗りした直後に先頭がやめても打ち切られないようにする。
+        """
+        with self._lock:
+            if isinstance(self.error, StreamAbandoned):
+                return None
+            self._subscribers += 1
+        return _Subscription(self)
+
+    def _unsubscribe(self):
+        with self._lock:
+            self._subscribers -= 1
+            abandoned = not self._subscribers and not self.done and self.error is None
+            if abandoned:
+                self.error = StreamAbandoned()
+        if abandoned:
+            self._on_finish()
+            close = getattr(self._chunks, "close", None)
+            if close is not None:
+                close()
+
+    def _replay(self):
+        self.ready.wait()
+        i = 0
+        while True:
+            with self._lock:
+                if i < len(self.items):
+                    item = self.items[i]
+                elif self.error is not None:
+                    raise self.error
+                elif self.done:
+                    return
+                else:
+                    item = _PENDING
+            if item is _PENDING:
+                self._fetch(i)
+                continue
+            i += 1
+            yield item
+
+    def _fetch(self, i):
+        # 上流を読むのは 1 人ずつ。待っている間に他の購読者が i 番目を読み終えていれば何もしない
+        finished = False
+        with self._read_lock:
+            with self._lock:
+                if i < len(self.items) or self.done or self.error is not None:
+                    return
+            try:
+                item = next(self._chunks)
+            except StopIteration:
+                with self._lock:
+                    self.done = True
+                finished = True
+            except Exception as e:
+                with self._lock:
+                    self.error = e
+                finished = True
+            else:
+                with self._lock:
+                    self.items.append(item)
+        if finished:
+            self._on_finish()
+
+
+_PENDING = object()
+
+
+class _Subscription:
+    """_StreamFlight の購読 1 件。読み終える・失敗する・close() のいずれかで購読をやめる。
+
+    一度も読まずに close() しても購読者数は戻る。
+    """
+
+    def __init__(self, flight):
+        self._flight = flight
+        self._items = flight._replay()
+        self._active = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._items)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self._active:
+            self._active = False
+            self._items.close()
+            self._flight._unsubscribe()
+
+
+class SingleFlight:
+    """同じキーで同時に走っているリクエストを 1 本にまとめる。"""
+
+    # 誰にも読まれず放置されたストリームに新しい呼び出しを相乗りさせない時間
+    STALE_AFTER = 300.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._streams = {}
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    def call(self, key, fn):
+        """(結果, 先頭の呼び出しかどうか) を返す。後続は先頭の fn() の結果を待って共有する。"""
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._calls[key] = _CallFlight()
+                self.stats["leaders"] += 1
+            else:
+                self.stats["coalesced"] += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, False
+        try:
+            flight.result = fn()
+            return flight.result, True
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            flight.event.set()
+
+    def stream(self, key, open_stream):
+        """(チャンクのイテレータ, 先頭の呼び出しかどうか) を返す。
+
+        先頭の呼び出しは open_stream() で上流を開く。後続は接続確立を待ってから同じチャンクを読む。
+        """
+        with self._lock:
+            flight = self._streams.get(key)
+            if flight is not None and time.monotonic() - flight.started < self.STALE_AFTER:
+                subscription = flight.subscribe()
+                if subscription is not None:
+                    self.stats["coalesced"] += 1
+                    return subscription, False
+            self.stats["leaders"] += 1
+            flight = _StreamFlight(on_finish=lambda: self._forget(key, flight))
+            # 先頭の購読も登録前に数え、後続が相乗りしてすぐやめても打ち切られないようにする
+            subscription = flight.subscribe()
+            self._streams[key] = flight
+        try:
+            flight.start(open_stream())
+        except Exception as e:
+            flight.fail(e)
+            subscription.close()
+            raise
+        return subscription, True
+
+    def _forget(self, key, flight):
+        with self._lock:
+            if self._streams.get(key) is flight:
+                del self._streams[key]
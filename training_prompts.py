@@ -0,0 +1,65 @@
+# training_prompts.py
+
+# ----------------------------------------
+# アルゴリズム思考トレーニング用のシステムメッセージ
+# ----------------------------------------
+system_message = {
+    "role": "system",
+    "content": (
+        "あなたは開発入門者の論理的思考を育成する教育アシスタントです\n"
+        "ユーザーが提示した問題とアルゴリズムのステップに対して\n"
+        "1.構成の素晴らしさや不足を指摘\n"
+        "2.最適化や利便さの要素を含む代替案\n"
+        "3.思考を深める質問を提示\n"
+        "を旨としたコメントを日常的な例えも使いながら行ってください"
+    )
+}
+
+# サンプル（AI 生成の問題はこれらと似たものを除外する）
+sample_problems = [
+    "リストから最も頻繁に出現する要素を求める",
+    "配列から最大値を求める",
+    "回文かどうかを判定する",
+    "同じ値が連続するものを削除する"
+]
+
+
+# ----------------------------------------
+# ランダム問題の生成
+# ----------------------------------------
+def generate_random_problem_prompt() -> dict:
+    content = (
+        "開発入門者向けに、多種多様なアルゴリズム学習用の問題タイトルを「リストから最も頻繁に出現する要素を求める」のような形で1件だけ生成してください。追加でコメントやレビューなどは不要です。過去に出たような典型問題（最大値・最頻値・ソートなど）を避け、工夫や発想が求められるテーマにしてください。"
+    )
+    return {"role": "user", "content": content}
+
+
+def generate_problem_batch_prompt(count: int, avoid: list) -> dict:
+    """問題タイトルをまとめて count 件生成させるプロンプト。avoid に挙げたものとは別のテーマにさせる。"""
+    avoid_lines = "\n".join(f"- {title}" for title in avoid)
+    content = (
+        f"開発入門者向けに、多種多様なアルゴリズム学習用の問題タイトルを {count} 件生成してください。\n"
+        "「リストから最も頻繁に出現する要素を求める」のような形で、1 行に 1 件ずつ、"
+        "番号・記号・説明を付けずにタイトルだけを出力してください。\n"
+        "過去に出たような典型問題（最大値・最頻値・ソートなど）を避け、工夫や発想が求められるテーマにし、"
+        "同じテーマの言い換えは含めないでください。\n\n"
+        f"【出題済みのため避けるテーマ】\n"
+        f"{avoid_lines or '（なし）'}\n"
+    )
+    return {"role": "user", "content": content}
+
+
+# ----------------------------------------
+# フィードバック（アプリのボタンと一括採点 CLI の共通）
+# ----------------------------------------
+def generate_feedback_prompt(problem: str, steps: str, reason: str, user_created_problem=False) -> dict:
+    comment_note = "" if user_created_problem else "問題に対するコメントは省略してください。"
+    content = (
+        f"問題: {problem}\n"
+        f"思考ステップ: {steps}\n"
+        f"考えた理由: {reason}\n"
+        f"{comment_note}\n"
+        "上記情報をもとに、アルゴリズムの構成を検証し、\n"
+        "1.良い点と改善点\n2.代替案やヒント\n3.思考を深める質問\nを教えてください"
+    )
+    return {"role": "user", "content": content}